@@ -1,74 +1,434 @@
-import bcrypt
-from flask import Flask, request, jsonify
-import mysql.connector
-import os
-from mailserver import send_confirmation_email
+from flask import Flask, Blueprint, Response, request, jsonify, g
+from werkzeug.middleware.proxy_fix import ProxyFix
+import datetime, json, math, os, queue, re, sqlite3, threading, time
+from mailqueue import MailQueue
+from encoding import encode_response, compress_response
+from dbpool import ConnectionPool
+from storage import MySQLStorage, SQLiteStorage, StorageError, DuplicateError
+from replication import ReplicatedStorage
+from querylog import QueryLog
+from identity import UserResolver
+from membership import MembershipIndex
+from idempotency import IdempotencyStore
+from changelog import ChangeLogCompactor, net_changes
+from ratelimit import RateLimit, ConcurrencyLimiter, create_rate_limiter
+from auth import SessionTokens, load_secret_key
+from hashing import PasswordHasher, HasherBusyError
+from jobs import ScheduleJobs, JobQueueFullError
+from rostercache import create_roster_cache, plain_rows
+from schedulecodec import encode_schedule, decode_day, employee_slots
+from metrics import registry, REQUESTS, REQUEST_SECONDS, THROTTLED
+from events import RosterEvents, TooManyStreamsError
 
-app = Flask(__name__)
+# routes of the API, registered on the application made by create_app()
+api = Blueprint('api', __name__)
 
-# function to establish connection with the MySQL database
-def connect_to_db():
-    try:
-        connection = mysql.connector.connect(
-            host=os.environ.get('DB_HOST'),
-            user=os.environ.get('DB_USER'),
-            password=os.environ.get('DB_PASSWORD'),
-            database=os.environ.get('DB_NAME')
+# columns of employee_data that clients may request from /data/get
+EMPLOYEE_COLUMNS = ['user_id', 'employee_id', 'employee_name', 'working_time', 'student_or_second_job']
+# largest page of employees a client can ask for
+MAX_PAGE_SIZE = 1000
+
+# token buckets per client and route pattern as (requests per second, burst), routes not listed are not limited.
+# Bursts cover a full sync of a large roster and an outbox flushed after working offline
+RATE_LIMITS = {
+    '/login': (0.2, 10),
+    '/login/refresh': (0.1, 5),
+    '/register': (0.05, 5),
+    '/register/check': (2, 20),
+    '/data/checkemployee': (2, 20),
+    '/data/get': (5, 60),
+    '/data/changes': (5, 30),
+    '/data/add': (20, 200),
+    '/data/update': (20, 200),
+    '/data/delete': (20, 200),
+    '/data/stream': (0.2, 5),
+    '/schedule/jobs': (0.05, 5),
+    '/schedule/jobs/<job_id>': (2, 30),
+    '/schedules': (2, 20),
+    '/schedules/<int:schedule_id>': (5, 50),
+    '/schedules/<int:schedule_id>/employees/<employee_id>': (10, 100),
+}
+# routes outside the concurrency caps: probes and metrics must answer when the process is busy,
+# roster streams hold a thread for minutes and have their own cap (STREAM_MAX_CONNECTIONS)
+UNCAPPED_ROUTES = ('/healthz', '/readyz', '/metrics', '/data/stream')
+
+@api.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# log every request with the ID sent by the client, so a slow call can be traced on both sides
+@api.after_app_request
+def log_request(response):
+    request_id = request.headers.get('X-Request-ID', '-')
+    duration = (time.perf_counter() - g.request_started) * 1000
+    print(f"[{request_id}] {request.method} {request.path} {response.status_code} {duration:.1f} ms")
+
+    # labelled with the route pattern, not the path, so IDs in paths do not make new series
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    REQUEST_SECONDS.observe(duration / 1000, route=route)
+
+    response.headers['X-Request-ID'] = request_id
+    # lets the client tell time spent in the API apart from time spent on the network
+    response.headers['Server-Timing'] = f"app;dur={duration:.1f}"
+    return response
+
+# timings of every statement, the ones slower than SLOW_QUERY_MS are logged
+query_log = QueryLog(
+    slow_threshold=float(os.environ.get('SLOW_QUERY_MS', 100)) / 1000,
+    max_statements=int(os.environ.get('QUERY_LOG_STATEMENTS', 500))
+)
+
+def mysql_storage(address, pool_size):
+    """MySQLStorage with its own pool on "host" or "host:port", all servers share DB_USER, DB_PASSWORD and DB_NAME"""
+    host, _, port = (address or '').partition(':')
+    return MySQLStorage(ConnectionPool(
+        size=pool_size,
+        checkout_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        health_check_interval=float(os.environ.get('DB_POOL_HEALTH_CHECK', 30)),
+        **({"host": host} if host else {}),
+        **({"port": int(port)} if port else {}),
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASSWORD'),
+        database=os.environ.get('DB_NAME')
+    ), query_log=query_log)
+
+# database of the API, MySQL through a pool of connections shared by all requests or a local SQLite file
+if os.environ.get('STORAGE_BACKEND', 'mysql') == 'sqlite':
+    storage = SQLiteStorage(
+        path=os.environ.get('SQLITE_PATH', 'schedule_creator.db'),
+        busy_timeout=float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5)),
+        query_log=query_log
+    )
+else:
+    storage = mysql_storage(os.environ.get('DB_HOST'), int(os.environ.get('DB_POOL_SIZE', 10)))
+    # read replicas of the MySQL primary, reads that may be served by them are routed in connect_to_db()
+    replica_hosts = [host.strip() for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host.strip()]
+    if replica_hosts:
+        storage = ReplicatedStorage(
+            storage,
+            [mysql_storage(host, int(os.environ.get('DB_REPLICA_POOL_SIZE', os.environ.get('DB_POOL_SIZE', 10))))
+             for host in replica_hosts],
+            max_lag=float(os.environ.get('DB_REPLICA_MAX_LAG', 5)),
+            check_interval=float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 1)),
+            redis_url=os.environ.get('REDIS_URL')
         )
-        return connection
-    except mysql.connector.Error as err:
+
+# cache of user IDs by email, saves the extra lookup query on every /data request
+users = UserResolver(
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 300))
+)
+
+# signs the session tokens and the stored fingerprints of idempotent requests
+secret_key = load_secret_key()
+
+# answers of write requests sent with an Idempotency-Key, a retried write gets the first answer instead of running twice
+write_results = IdempotencyStore(
+    storage,
+    secret_key,
+    ttl=float(os.environ.get('IDEMPOTENCY_TTL', 24*3600)),
+    lease=float(os.environ.get('IDEMPOTENCY_LEASE', 120))
+)
+
+# keeps /data/changes answerable for clients that synced within the retention
+roster_log = ChangeLogCompactor(
+    storage,
+    retention=float(os.environ.get('ROSTER_LOG_RETENTION', 30*24*3600)),
+    max_changes=int(os.environ.get('ROSTER_LOG_MAX_CHANGES', 10000)),
+    interval=float(os.environ.get('ROSTER_LOG_COMPACT_INTERVAL', 3600))
+)
+
+# RATE_LIMIT_SCALE multiplies every limit, 0 turns rate limiting off
+rate_limit_scale = float(os.environ.get('RATE_LIMIT_SCALE', 1))
+rate_limits = create_rate_limiter(
+    os.environ.get('REDIS_URL'),
+    {route: RateLimit(rate * rate_limit_scale, burst * rate_limit_scale)
+     for route, (rate, burst) in RATE_LIMITS.items()} if rate_limit_scale > 0 else {}
+)
+
+# by default as many requests as the pool has connections, more would only wait for one
+active_requests = ConcurrencyLimiter(
+    max_active=int(os.environ.get('MAX_ACTIVE_REQUESTS', os.environ.get('DB_POOL_SIZE', 10))),
+    max_per_client=int(os.environ.get('MAX_CLIENT_REQUESTS', max(1, int(os.environ.get('WEB_THREADS', 4)) // 2)))
+)
+
+# every taken username and email, /register/check answers from memory once they are loaded
+registered_names = MembershipIndex(storage, refresh_interval=float(os.environ.get('REGISTER_INDEX_REFRESH', 600)))
+
+# cached results of roster reads, dropped on every write to the roster. Without REDIS_URL every
+# process has its own cache and sees writes made through other processes only after ROSTER_CACHE_TTL
+roster_cache = create_roster_cache(
+    os.environ.get('REDIS_URL'),
+    max_bytes=int(os.environ.get('ROSTER_CACHE_BYTES', 64*1024*1024)),
+    ttl=float(os.environ.get('ROSTER_CACHE_TTL', 5))
+)
+
+# roster changes pushed to the clients of the same user over /data/stream, through Redis to every process if REDIS_URL is set.
+# Each open stream holds one of the WEB_THREADS threads, by default streams may take half of them
+roster_events = RosterEvents(
+    max_streams=int(os.environ.get('STREAM_MAX_CONNECTIONS', max(1, int(os.environ.get('WEB_THREADS', 4)) // 2))),
+    redis_url=os.environ.get('REDIS_URL')
+)
+# seconds a stream stays open before the client has to reconnect, and between keepalive comments
+STREAM_DURATION = float(os.environ.get('STREAM_DURATION', 300))
+STREAM_KEEPALIVE = 15
+
+# emails are sent by background workers from a persistent outbox
+mail_queue = MailQueue(
+    outbox_path=os.environ.get('MAIL_OUTBOX', 'mail_outbox.db'),
+    workers=int(os.environ.get('MAIL_WORKERS', 2))
+)
+
+# bcrypt runs in worker processes, BCRYPT_ROUNDS can be raised or lowered per deployment
+hasher = PasswordHasher(
+    workers=int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 1)),
+    max_queue=int(os.environ.get('BCRYPT_MAX_QUEUE', 32)),
+    rounds=int(os.environ.get('BCRYPT_ROUNDS', 12))
+)
+
+# signed session tokens issued by /login
+tokens = SessionTokens(
+    secret_key,
+    access_ttl=int(os.environ.get('ACCESS_TOKEN_TTL', 3600)),
+    refresh_ttl=int(os.environ.get('REFRESH_TOKEN_TTL', 30*24*3600))
+)
+
+# schedules are generated by worker processes, SCHEDULE_WORKERS jobs run at once in each server process
+schedule_jobs = ScheduleJobs(
+    storage,
+    workers=int(os.environ.get('SCHEDULE_WORKERS', 2)),
+    max_pending=int(os.environ.get('SCHEDULE_MAX_PENDING', 20)),
+    timeout=float(os.environ.get('SCHEDULE_TIMEOUT', 600))
+)
+
+# paths of requests made on behalf of one user
+USER_PATHS = ('/data/', '/schedule/', '/schedules')
+
+# check the session token of /data and schedule requests, requests without one are identified by their email
+@api.before_app_request
+def authenticate():
+    g.user_id = None
+    token = tokens.from_request()
+    if token is None or not request.path.startswith(USER_PATHS):
+        return None
+
+    claims = tokens.verify_access(token)
+    if claims is None:
+        return jsonify({"message": "Invalid or expired token"}), 401
+    # the token decides whose data is used, a request naming another user must not fall back to it
+    email = requested_email()
+    if email is not None and str(email).casefold() != str(claims['email']).casefold():
+        return jsonify({"message": "Token does not belong to this user"}), 403
+    g.user_id = claims['uid']
+
+def requested_email():
+    """Return the user_email of the query, form or JSON body of the request, None if it names no user"""
+    email = request.args.get('user_email') or request.form.get('user_email')
+    if email is None and request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            email = data.get('user_email') or data.get('email')
+    return email
+
+# turn away requests over the client's rate limit or the concurrency caps before they wait for a thread or connection
+@api.before_app_request
+def limit_request():
+    if request.url_rule is None:
+        return None
+    route = request.url_rule.rule
+    # clients without a session token are told apart by address, the email they send is their own choice
+    client = f"user:{g.user_id}" if g.user_id is not None else f"ip:{request.remote_addr}"
+
+    wait = rate_limits.acquire(client, route)
+    if wait:
+        THROTTLED.inc(route=route, reason='rate')
+        return jsonify({"message": "Too many requests, slow down"}), 429, {"Retry-After": str(math.ceil(wait))}
+
+    if route in UNCAPPED_ROUTES:
+        return None
+    refused = active_requests.acquire(client)
+    if refused is not None:
+        THROTTLED.inc(route=route, reason=refused)
+        return jsonify({"message": "Server busy, try again"}), 429, {"Retry-After": "1"}
+    g.request_slot = client
+
+@api.teardown_app_request
+def release_request_slot(exception=None):
+    client = g.pop('request_slot', None)
+    if client is not None:
+        active_requests.release(client)
+
+def resolve_user_id(db, user_email):
+    """Return the ID of the requesting user, from the session token if there is one (authenticate checked it is theirs)"""
+    if g.user_id is not None:
+        return g.user_id
+    return users.user_id(db, user_email)
+
+# function to get a repository on the database, close() releases its connection.
+# read_only repositories may be on a replica that has every write of the requesting user
+def connect_to_db(read_only=False):
+    try:
+        if read_only and g.user_id is not None:
+            repository = storage.read_repository(g.user_id)
+        elif read_only and not request.path.startswith(USER_PATHS):
+            repository = storage.read_repository()
+        else:
+            # without a session token the user is only known after a query, their writes could not be told apart
+            repository = storage.repository()
+    except StorageError as err:
         # log the error and return None if connection fails
         print(f"Error: {err}")
         return None
 
+    # remembered so the connection goes back to the pool even if the route raises
+    g.setdefault('db_connections', []).append(repository)
+    return repository
+
+@api.teardown_app_request
+def release_db_connections(exception=None):
+    for repository in g.pop('db_connections', []):
+        repository.close()
+
+# endpoint with the state of the connection pool
+@api.route('/pool/stats', methods=['GET'])
+def pool_stats():
+    return jsonify(storage.metrics()), 200
+
+# endpoint with the metrics of this process in the Prometheus text format
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@registry.collector
+def service_metrics():
+    """Statistics the pool, mail queue and caches keep anyway, read when /metrics is scraped"""
+    families = []
+    pool_metrics = storage.metrics()
+    for name in ('size', 'in_use', 'idle'):
+        if name in pool_metrics:
+            families.append((f"db_pool_{name}", 'gauge', f"Connections of the pool: {name}", [({}, pool_metrics[name])]))
+    for name in ('checkouts', 'timeouts', 'reconnects', 'wait_seconds'):
+        if name in pool_metrics:
+            families.append((f"db_pool_{name}_total", 'counter', f"Connection pool {name}", [({}, pool_metrics[name])]))
+
+    replication = pool_metrics.get('replication')
+    if replication is not None:
+        families.append(("db_replica_lag_seconds", 'gauge', "Replication lag at the last check, -1 if the replica is not replicating",
+                         [({"replica": index}, replica['lag'] if replica['lag'] is not None else -1)
+                          for index, replica in enumerate(replication['replicas'])]))
+        families.append(("db_replica_usable", 'gauge', "1 if reads may go to the replica",
+                         [({"replica": index}, int(replica['usable'])) for index, replica in enumerate(replication['replicas'])]))
+        families.append(("db_reads_total", 'counter', "Read-only repositories handed out by target",
+                         [({"target": "primary"}, replication['primary_reads']), ({"target": "replica"}, replication['replica_reads'])]))
+        families.append(("db_replica_errors_total", 'counter', "Failed replica checks and connections", [({}, replication['replica_errors'])]))
+
+    mail_metrics = mail_queue.metrics()
+    families.append(("mail_queue_depth", 'gauge', "Emails waiting to be sent", [({}, mail_metrics['depth'])]))
+    families.append(("mail_emails_total", 'counter', "Emails by outcome",
+                     [({"outcome": outcome}, mail_metrics[outcome]) for outcome in ('sent', 'retried', 'failed')]))
+
+    event_metrics = roster_events.metrics()
+    families.append(("roster_streams", 'gauge', "Open roster event streams", [({}, event_metrics['streams'])]))
+    families.append(("roster_events_total", 'counter', "Roster events by outcome",
+                     [({"outcome": outcome}, event_metrics[outcome]) for outcome in ('published', 'delivered', 'dropped_streams')]))
+
+    write_metrics = write_results.metrics()
+    families.append(("idempotent_writes_total", 'counter', "Writes sent with an Idempotency-Key by outcome",
+                     [({"outcome": outcome}, write_metrics[outcome]) for outcome in ('executed', 'replayed', 'in_progress', 'mismatched')]))
+
+    request_metrics = active_requests.metrics()
+    families.append(("api_active_requests", 'gauge', "Requests running inside the concurrency caps", [({}, request_metrics['active'])]))
+    families.append(("api_active_requests_peak", 'gauge', "Most requests that ran at once since the start", [({}, request_metrics['peak'])]))
+    families.append(("api_active_requests_max", 'gauge', "Cap on requests running at once", [({}, request_metrics['max_active'])]))
+
+    log_metrics = roster_log.metrics()
+    families.append(("roster_log_compactions_total", 'counter', "Runs of the roster change log compaction", [({}, log_metrics['compactions'])]))
+    families.append(("roster_log_deleted_total", 'counter', "Roster changes deleted by compaction", [({}, log_metrics['deleted'])]))
+
+    index_metrics = registered_names.metrics()
+    families.append(("register_index_users", 'gauge', "Users in the membership index of /register/check", [({}, index_metrics['users'])]))
+    families.append(("register_index_checks_total", 'counter', "Availability checks by how they were answered",
+                     [({"source": "index"}, index_metrics['answered']), ({"source": "database"}, index_metrics['unavailable'])]))
+
+    caches = {"users": users.cache.metrics(), "rosters": roster_cache.metrics()}
+    families.append(("cache_hits_total", 'counter', "Cache lookups answered from the cache",
+                     [({"cache": cache}, values['hits']) for cache, values in caches.items()]))
+    families.append(("cache_misses_total", 'counter', "Cache lookups that missed",
+                     [({"cache": cache}, values['misses']) for cache, values in caches.items()]))
+    families.append(("cache_hit_ratio", 'gauge', "Share of lookups answered from the cache since the start",
+                     [({"cache": cache}, round(values['hits'] / max(1, values['hits'] + values['misses']), 4))
+                      for cache, values in caches.items()]))
+    return families
+
+# endpoint with the statements that took the most time in this process, ?order=total, max or count
+@api.route('/db/queries', methods=['GET'])
+def query_stats():
+    order = request.args.get('order', 'total')
+    if order not in ('total', 'max', 'count'):
+        return jsonify({"message": "Invalid order"}), 400
+    return jsonify({"statements": query_log.top(request.args.get('limit', 20, type=int), order)}), 200
+
+# endpoint with the hit and miss counts of the caches
+@api.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({"users": users.cache.metrics(), "rosters": roster_cache.metrics(), "register_index": registered_names.metrics()}), 200
+
 # endpoint to handle user registration
-@app.route('/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
+@write_results.idempotent
 def register():
     data = request.json
     username = data.get('username')
     email = data.get('email')
     password = data.get('password')
 
-    # hash the provided password
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    # hash the provided password in the hashing pool
+    try:
+        hashed_password = hasher.hash(password)
+    except HasherBusyError:
+        return jsonify({"message": "Server busy, try again"}), 503, {"Retry-After": "1"}
 
     db = connect_to_db()
     if db is None:
         # return error if connection to the database fails
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
-
     try:
         # insert the new user into the database
-        cursor.execute("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
-                       (username, email, hashed_password))
-        db.commit()
+        db.add_user(username, email, hashed_password)
+        registered_names.add('username', username)
+        registered_names.add('email', email)
 
-        # send a confirmation email upon successful registration
-        send_confirmation_email(email)
+        # queue a confirmation email upon successful registration, it is sent in the background
+        try:
+            mail_queue.send_confirmation_email(email)
+        except (ValueError, sqlite3.Error) as err:
+            # the user is stored already, a missing email must not turn the registration into an error
+            print(f"Confirmation email not sent: {err}")
 
         return jsonify({"message": "User registered successfully!"}), 201
-    except mysql.connector.Error as err:
-        # handle cases where a duplicate entry is found (username or email already exists)
-        if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
-            if 'username' in err.msg:
-                return jsonify({"message": "Username already exists"}), 409
-            elif 'email' in err.msg:
-                return jsonify({"message": "Email already exists"}), 409
-            else:
-                return jsonify({"message": "Duplicate entry error"}), 409
+    except DuplicateError as err:
+        # handle cases where a duplicate entry is found (username or email already exists),
+        # the index may not know it yet if it was registered through another process
+        if 'username' in str(err):
+            registered_names.add('username', username)
+            return jsonify({"message": "Username already exists"}), 409
+        elif 'email' in str(err):
+            registered_names.add('email', email)
+            return jsonify({"message": "Email already exists"}), 409
         else:
-            # log other database errors
-            print(f"Error: {err}")
-            return jsonify({"message": "Registration failed due to a database error"}), 500
+            return jsonify({"message": "Duplicate entry error"}), 409
+    except StorageError as err:
+        # log other database errors
+        print(f"Error: {err}")
+        return jsonify({"message": "Registration failed due to a database error"}), 500
     finally:
-        # close the database cursor and connection
-        cursor.close()
+        # release the database connection
         db.close()
 
 # endpoint to check if a username or email is already taken
-@app.route('/register/check', methods=['POST'])
+@api.route('/register/check', methods=['POST'])
 def check_availability():
     data = request.json
     field_type = data.get('type')
@@ -78,30 +438,28 @@ def check_availability():
     if field_type not in ['username', 'email']:
         return jsonify({"message": "Invalid field type"}), 400
 
-    db = connect_to_db()
-    if db is None:
-        return jsonify({"message": "Database connection failed"}), 500
-
-    cursor = db.cursor()
+    # answered from memory, the database is only asked while the index is loading
+    result = registered_names.contains(field_type, value)
+    if result is None:
+        db = connect_to_db(read_only=True)
+        if db is None:
+            return jsonify({"message": "Database connection failed"}), 500
 
-    try:
-        # query the database to check if the username or email already exists
-        query = f"SELECT 1 FROM users WHERE {field_type} = %s"
-        cursor.execute(query, (value,))
-        result = cursor.fetchone()
+        try:
+            # query the database to check if the username or email already exists
+            result = db.user_exists(field_type, value)
+        except StorageError as err:
+            return jsonify({"message": f"Database error: {err}"}), 500
+        finally:
+            db.close()
 
-        if result:
-            return jsonify({"message": f"{field_type} already exists"}), 409
-        else:
-            return jsonify({"message": f"{field_type} is available"}), 200
-    except mysql.connector.Error as err:
-        return jsonify({"message": f"Database error: {err}"}), 500
-    finally:
-        cursor.close()
-        db.close()
+    if result:
+        return jsonify({"message": f"{field_type} already exists"}), 409
+    else:
+        return jsonify({"message": f"{field_type} is available"}), 200
 
 # endpoint for user login
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     data = request.json
     email = data.get('email')
@@ -111,109 +469,178 @@ def login():
     if db is None:
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
-
     try:
-        # retrieve the hashed password from the database for the given email
-        cursor.execute("SELECT password FROM users WHERE email = %s", (email,))
-        result = cursor.fetchone()
-
-        if result:
-            stored_password_hash = result[0]
-
-            # ensure the password hash is encoded properly
-            if isinstance(stored_password_hash, str):
-                stored_password_hash = stored_password_hash.encode('utf-8')
-
-            # check if the provided password matches the stored hash
-            if bcrypt.checkpw(password.encode('utf-8'), stored_password_hash):
-                return jsonify({"message": "Login successful!"}), 200
-            else:
-                return jsonify({"message": "Invalid credentials"}), 401
-        else:
-            return jsonify({"message": "User not found"}), 404
-    except mysql.connector.Error as err:
+        # retrieve the user ID and hashed password from the database for the given email
+        result = db.credentials(email)
+    except StorageError as err:
         print(f"Database error: {err}")
         return jsonify({"message": "Failed to log in"}), 500
+    finally:
+        # released before bcrypt runs, waiting logins must not hold pool connections and block roster reads
+        db.close()
+
+    if not result:
+        return jsonify({"message": "User not found"}), 404
+    user_id, stored_password_hash = result
+
+    try:
+        # check if the provided password matches the stored hash
+        if not hasher.verify(password, stored_password_hash):
+            return jsonify({"message": "Invalid credentials"}), 401
+        # upgrade hashes made with an outdated work factor while the password is at hand
+        new_password_hash = hasher.hash(password) if hasher.needs_rehash(stored_password_hash) else None
+    except HasherBusyError:
+        return jsonify({"message": "Server busy, try again"}), 503, {"Retry-After": "1"}
     except Exception as e:
         print(f"Unexpected error: {e}")
         return jsonify({"message": "An unexpected error occurred"}), 500
-    finally:
-        cursor.close()
-        db.close()
+
+    if new_password_hash is not None:
+        db = connect_to_db()
+        if db is not None:
+            try:
+                db.set_password(user_id, new_password_hash)
+            except StorageError as err:
+                # the old hash still works, it is upgraded on a later login
+                print(f"Password hash not upgraded: {err}")
+            finally:
+                db.close()
+
+    # the client keeps the refresh token, so next launches skip the password check
+    return jsonify({"message": "Login successful!", **tokens.issue(user_id, email)}), 200
+
+# endpoint exchanging a refresh token for new tokens, no database access or password check needed
+@api.route('/login/refresh', methods=['POST'])
+def refresh_session():
+    data = request.json
+    claims = tokens.verify_refresh(data.get('refresh_token'))
+
+    if claims is None:
+        return jsonify({"message": "Invalid or expired session"}), 401
+    return jsonify({"message": "Session refreshed", **tokens.issue(claims['uid'], claims['email'])}), 200
 
 # endpoint to check if an employee table exists for a user
-@app.route('/data/checkemployee', methods=['POST'])
+@api.route('/data/checkemployee', methods=['POST'])
 def checkIfEmployeeTableExists():
     data = request.json
     user_email = data.get('user_email')
 
-    db = connect_to_db()
+    db = connect_to_db(read_only=True)
     if db is None:
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
-
     try:
-        # fetch the user ID using the provided email
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-        user_id = cursor.fetchone()[0]
-    except Exception as e:
-        raise e
+        # resolve the user ID from the session token or the provided email, usually without a query
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
 
-    try:
-        # check if there is an employee table for the given user ID
-        query = f"SELECT 1 FROM employee_data WHERE user_id = %s"
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchall()
+        # check if there is an employee table for the given user ID, the answer is cached until the roster changes
+        result = roster_cache.get(user_id, 'exists')
+        if result is None:
+            generation = roster_cache.generation(user_id)
+            result = db.has_employees(user_id)
+            roster_cache.set(user_id, 'exists', result, generation)
 
         if result:
             return jsonify({"message": "Employee table exists"}), 200
         else:
             return jsonify({"message": "User has no employee record"}), 410
-    except mysql.connector.Error as err:
+    except StorageError as err:
         return jsonify({"message": f"Database error: {err}"}), 500
     finally:
-        cursor.close()
         db.close()
 
 # endpoint to retrieve employee data for a user
-@app.route('/data/get', methods=['POST'])
+@api.route('/data/get', methods=['POST'])
 def getData():
     data = request.json
     user_email = data.get('user_email')
+    # optional projection, all columns are returned if the client does not ask for specific ones
+    columns = data.get('columns') or EMPLOYEE_COLUMNS
+    # optional keyset pagination, the page starts after the employee ID given as cursor
+    limit = data.get('limit')
+    after = data.get('after')
 
-    db = connect_to_db()
+    if not isinstance(columns, list) or any(column not in EMPLOYEE_COLUMNS for column in columns):
+        return jsonify({"message": "Invalid columns"}), 400
+    if limit is not None and (not isinstance(limit, int) or limit < 1 or 'employee_id' not in columns):
+        return jsonify({"message": "Invalid page request"}), 400
+
+    db = connect_to_db(read_only=True)
     if db is None:
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
-
     try:
-        # get the user ID from the provided email
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-        user_id = cursor.fetchone()[0]
-    except Exception as e:
-        raise e
+        # resolve the user ID from the session token or the provided email, usually without a query
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
 
-    try:
-        # retrieve all employee data for the given user ID
-        query = f"SELECT * FROM employee_data WHERE user_id = %s"
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchall()
+        # the same page of the same roster is served from the cache until the roster changes
+        key = json.dumps([columns, limit, after])
+        payload = roster_cache.get(user_id, key)
+        if payload is None:
+            generation = roster_cache.generation(user_id)
 
-        if result:
-            return jsonify({"result": result}), 200
+            # read before the rows, a write in between is sent again by /data/changes instead of being missed
+            version = db.roster_version(user_id)[0]
+            # retrieve the requested columns of employee data for the given user ID
+            result = plain_rows(db.employees(user_id, columns, min(limit, MAX_PAGE_SIZE) if limit is not None else None, after))
+
+            payload = {"columns": columns, "result": result, "version": version}
+            if limit is not None:
+                # a full page means there may be more rows after its last employee
+                payload["next_cursor"] = result[-1][columns.index('employee_id')] if len(result) == min(limit, MAX_PAGE_SIZE) else None
+            roster_cache.set(user_id, key, payload, generation)
+
+        # an empty page after a cursor is the end of the roster, not a missing table
+        if payload["result"] or (limit is not None and after is not None):
+            return encode_response(payload, 200)
         else:
-            return jsonify({"message": f"No employee table"}), 409
-    except mysql.connector.Error as err:
+            return jsonify({"message": f"No employee table", "version": payload["version"]}), 409
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        db.close()
+
+# endpoint with the changes to a roster since the version the client has, collapsed to the rows to store and delete
+@api.route('/data/changes', methods=['GET'])
+def get_roster_changes():
+    user_email = request.args.get('user_email')
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({"message": "Invalid version"}), 400
+
+    db = connect_to_db(read_only=True)
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
+
+    try:
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
+
+        version, compacted_through = db.roster_version(user_id)
+        if since < compacted_through or since > version:
+            return jsonify({"message": "Version no longer available, fetch the whole roster", "version": version}), 410
+        changes = db.roster_changes(user_id, since, MAX_PAGE_SIZE)
+        # versions have no gaps, without the change right after `since` it was compacted away meanwhile
+        first = changes[0][0] if changes else version + 1
+        if first != since + 1:
+            return jsonify({"message": "Version no longer available, fetch the whole roster", "version": version}), 410
+
+        upserts, deletes = net_changes(changes)
+        return encode_response({"version": changes[-1][0] if changes else since, "upserts": plain_rows(upserts),
+                                "deletes": deletes, "more": len(changes) == MAX_PAGE_SIZE}, 200)
+    except StorageError as err:
         return jsonify({"message": f"Database error: {err}"}), 500
     finally:
-        cursor.close()
         db.close()
 
 # endpoint to add a new employee record
-@app.route('/data/add', methods=['POST'])
+@api.route('/data/add', methods=['POST'])
+@write_results.idempotent
 def add_employee():
     data = request.json
     user_email = data.get('user_email')
@@ -226,31 +653,30 @@ def add_employee():
     if db is None:
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
-
     try:
-        # fetch the user ID using the provided email
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-        user_id = cursor.fetchone()[0]
-
-    except Exception as e:
-        raise
+        # resolve the user ID from the session token or the provided email, usually without a query
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
 
-    try:
         # insert the new employee record into the employee_data table
-        cursor.execute("INSERT INTO employee_data (user_id, employee_id, employee_name, working_time, student_or_second_job) VALUES (%s, %s, %s, %s, %s)",
-                       (user_id, emp_id, emp_name, work_time, student_second_job))
-        db.commit()
+        version = db.add_employee(user_id, emp_id, emp_name, work_time, student_second_job)
+        roster_cache.invalidate(user_id)
+        storage.wrote(user_id)
+        roster_events.publish(user_id, {"action": "add", "employee_id": emp_id, "employee_name": emp_name,
+                                        "work_time": work_time, "student_or_second_job": student_second_job})
 
-        return jsonify({"message": "Employee added successfully!"}), 201
-    except Exception as e:
-        raise e
+        return jsonify({"message": "Employee added successfully!", "version": version}), 201
+    except DuplicateError:
+        return jsonify({"message": "An employee with this ID already exists"}), 409
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
     finally:
-        cursor.close()
         db.close()
 
 # endpoint to delete an employee record
-@app.route('/data/delete', methods=['POST'])
+@api.route('/data/delete', methods=['POST'])
+@write_results.idempotent
 def delete_employee():
     data = request.json
     user_email = data.get('user_email')
@@ -261,30 +687,27 @@ def delete_employee():
     if db is None:
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
-
     try:
-        # fetch the user ID using the provided email
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-        user_id = cursor.fetchone()[0]
-    except Exception as e:
-        raise
+        # resolve the user ID from the session token or the provided email, usually without a query
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
 
-    try:
         # delete the employee record matching the user ID and employee ID
-        cursor.execute("DELETE FROM employee_data WHERE user_id = %s AND employee_id = %s",
-                       (user_id, emp_id))
-        db.commit()
+        version = db.delete_employee(user_id, emp_id)
+        roster_cache.invalidate(user_id)
+        storage.wrote(user_id)
+        roster_events.publish(user_id, {"action": "delete", "employee_id": emp_id})
 
-        return jsonify({"message": "Employee deleted successfully!"}), 201
-    except Exception as e:
-        raise e
+        return jsonify({"message": "Employee deleted successfully!", "version": version}), 201
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
     finally:
-        cursor.close()
         db.close()
 
 # endpoint to update an employee record
-@app.route('/data/update', methods=['POST'])
+@api.route('/data/update', methods=['POST'])
+@write_results.idempotent
 def update_employee_data():
     data = request.json
     user_email = data.get('user_email')
@@ -298,29 +721,316 @@ def update_employee_data():
     if db is None:
         return jsonify({"message": "Database connection failed"}), 500
 
-    cursor = db.cursor()
+    try:
+        # resolve the user ID from the session token or the provided email, usually without a query
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
+
+        # update the employee record with new data
+        version = db.update_employee(user_id, old_emp_id, emp_id, emp_name, work_time, student_second_job)
+        roster_cache.invalidate(user_id)
+        storage.wrote(user_id)
+        roster_events.publish(user_id, {"action": "update", "old_employee_id": old_emp_id, "employee_id": emp_id,
+                                        "employee_name": emp_name, "work_time": work_time,
+                                        "student_or_second_job": student_second_job})
+
+        return jsonify({"message": "Employee updated successfully!", "version": version}), 201
+    except DuplicateError:
+        return jsonify({"message": "An employee with this ID already exists"}), 409
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        db.close()
+
+# server-sent events stream of the changes to the user's roster, in the payload format of /data/add, update and delete
+@api.route('/data/stream', methods=['GET'])
+def stream_roster_changes():
+    user_email = request.args.get('user_email')
+
+    db = connect_to_db(read_only=True)
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
+    try:
+        user_id = resolve_user_id(db, user_email)
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        # the stream holds a thread but no database connection
+        db.close()
+    if user_id is None:
+        return jsonify({"message": "User not found"}), 404
 
     try:
-        # fetch the user ID using the provided email
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-        user_id = cursor.fetchone()[0]
+        stream = roster_events.subscribe(user_id)
+    except TooManyStreamsError:
+        return jsonify({"message": "Server busy, try again"}), 503, {"Retry-After": "30"}
 
-    except Exception as e:
-        raise
+    def events():
+        deadline = time.monotonic() + STREAM_DURATION
+        try:
+            # reconnect after 5 s if the connection drops
+            yield "retry: 5000\n\n"
+            while time.monotonic() < deadline and not shutting_down.is_set():
+                try:
+                    event = stream.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # comment lines keep proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield f"event: roster\ndata: {json.dumps(event)}\n\n"
+        finally:
+            roster_events.unsubscribe(user_id, stream)
+
+    return Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# endpoint queueing the generation of a schedule from the uploaded availability and RPT files
+@api.route('/schedule/jobs', methods=['POST'])
+@write_results.idempotent
+def submit_schedule_job():
+    user_email = request.form.get('user_email')
+    # optional "YYYY-MM" the schedule is saved for
+    month = request.form.get('month')
+    availability = request.files.get('availability')
+    rpt = request.files.get('rpt')
+
+    if availability is None or rpt is None:
+        return jsonify({"message": "availability and rpt files are required"}), 400
+    if month is not None and not valid_month(month):
+        return jsonify({"message": "Invalid month"}), 400
+
+    db = connect_to_db()
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
 
     try:
-        # update the employee record with new data
-        cursor.execute("UPDATE employee_data SET employee_id = %s, employee_name = %s, working_time = %s, student_or_second_job = %s WHERE user_id = %s AND employee_id = %s",
-                       (emp_id, emp_name, work_time, student_second_job, user_id, old_emp_id))
-        db.commit()
+        # resolve the user ID from the session token or the provided email, usually without a query
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
 
-        return jsonify({"message": "Employee updated successfully!"}), 201
-    except Exception as e:
-        raise e
+        # the worker gets the roster with the job, it needs no database access of its own
+        roster = [[str(employee_id), name, str(working_time), student] for employee_id, name, working_time, student
+                  in db.employees(user_id, EMPLOYEE_COLUMNS[1:])]
+        if not roster:
+            return jsonify({"message": "No employee table"}), 409
+
+        job_id = schedule_jobs.submit(user_id, user_email, availability.read(), rpt.read(), roster, month)
+        return jsonify({"message": "Schedule job queued", "job_id": job_id, "status": "queued"}), 202
+    except JobQueueFullError:
+        return jsonify({"message": "Server busy, try again"}), 503, {"Retry-After": "10"}
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        db.close()
+
+# endpoint with the status of a schedule job and the schedule once it is done
+@api.route('/schedule/jobs/<job_id>', methods=['GET'])
+def get_schedule_job(job_id):
+    user_email = request.args.get('user_email')
+
+    db = connect_to_db()
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
+
+    try:
+        user_id = resolve_user_id(db, user_email)
+        job = db.job(job_id)
+
+        # jobs of other users are reported as missing
+        if job is None or user_id is None or job[0] != user_id:
+            return jsonify({"message": "Job not found"}), 404
+
+        _, status, result, error = job
+        response = {"job_id": job_id, "status": status}
+        if status == 'done':
+            response["schedule"] = json.loads(result)
+            response["schedule_id"] = db.schedule_for_job(job_id)
+        elif status == 'failed':
+            response["message"] = error
+        return jsonify(response), 200
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        db.close()
+
+def valid_month(month):
+    return isinstance(month, str) and re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", month) is not None
+
+def date_range():
+    """Return the optional from and to dates of the request as "YYYY-MM-DD", raises ValueError if one is invalid"""
+    return tuple(datetime.date.fromisoformat(request.args[name]).isoformat() if request.args.get(name) else None
+                 for name in ('from', 'to'))
+
+# metadata columns of a schedule, in the order the repository returns them
+SCHEDULE_FIELDS = ['schedule_id', 'month', 'created_at', 'seed', 'score', 'availability_hash', 'rpt_hash', 'job_id']
+
+def schedule_metadata(row):
+    metadata = dict(zip(SCHEDULE_FIELDS, row))
+    metadata['created_at'] = str(metadata['created_at'])
+    return metadata
+
+# endpoint saving a schedule generated by the client
+@api.route('/schedules', methods=['POST'])
+@write_results.idempotent
+def save_schedule():
+    data = request.json
+    user_email = data.get('user_email')
+    month = data.get('month')
+    schedule = data.get('schedule')
+
+    if not valid_month(month) or not isinstance(schedule, dict):
+        return jsonify({"message": "month and schedule are required"}), 400
+    try:
+        employees, days = encode_schedule(schedule, month)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify({"message": "Invalid schedule"}), 400
+
+    db = connect_to_db()
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
+
+    try:
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
+
+        schedule_id = db.save_schedule(user_id, month, employees, days, seed=data.get('seed'), score=data.get('score'),
+                                       availability_hash=data.get('availability_hash'), rpt_hash=data.get('rpt_hash'))
+        storage.wrote(user_id)
+        return jsonify({"message": "Schedule saved", "schedule_id": schedule_id}), 201
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        db.close()
+
+# endpoint listing the saved schedules of a month, without their days
+@api.route('/schedules', methods=['GET'])
+def list_schedules():
+    user_email = request.args.get('user_email')
+    month = request.args.get('month')
+
+    if not valid_month(month):
+        return jsonify({"message": "Invalid month"}), 400
+
+    db = connect_to_db(read_only=True)
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
+
+    try:
+        user_id = resolve_user_id(db, user_email)
+        if user_id is None:
+            return jsonify({"message": "User not found"}), 404
+
+        schedules = [schedule_metadata(row) for row in db.schedules(user_id, month)]
+        return jsonify({"schedules": schedules}), 200
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
     finally:
-        cursor.close()
         db.close()
 
+# endpoint returning a saved schedule, the whole month or the days between the from and to dates
+@api.route('/schedules/<int:schedule_id>', methods=['GET'])
+def get_schedule(schedule_id):
+    return read_schedule(schedule_id)
+
+# endpoint returning the slots one employee works on each day of a saved schedule
+@api.route('/schedules/<int:schedule_id>/employees/<employee_id>', methods=['GET'])
+def get_employee_schedule(schedule_id, employee_id):
+    return read_schedule(schedule_id, employee_id)
+
+def read_schedule(schedule_id, employee_id=None):
+    """Decode only the requested days of a schedule, and of each day only one employee if given"""
+    user_email = request.args.get('user_email')
+    try:
+        start, end = date_range()
+    except ValueError:
+        return jsonify({"message": "Invalid date"}), 400
+
+    db = connect_to_db(read_only=True)
+    if db is None:
+        return jsonify({"message": "Database connection failed"}), 500
+
+    try:
+        user_id = resolve_user_id(db, user_email)
+        row = db.schedule(schedule_id)
+
+        # schedules of other users are reported as missing
+        if row is None or user_id is None or row[-2] != user_id:
+            return jsonify({"message": "Schedule not found"}), 404
+
+        employees = row[-1]
+        response = schedule_metadata(row)
+        if employee_id is None:
+            response["schedule"] = {label: decode_day(blob, employees) for _, label, blob in db.schedule_days(schedule_id, start, end)}
+        else:
+            response["employee_id"] = employee_id
+            response["schedule"] = {label: employee_slots(blob, employees, employee_id)
+                                    for _, label, blob in db.schedule_days(schedule_id, start, end)}
+        return jsonify(response), 200
+    except StorageError as err:
+        return jsonify({"message": f"Database error: {err}"}), 500
+    finally:
+        db.close()
+
+# liveness probe, answers as long as the process serves requests
+@api.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"}), 200
+
+# readiness probe, the load balancer only sends traffic while the database is reachable
+@api.route('/readyz', methods=['GET'])
+def readyz():
+    if shutting_down.is_set():
+        return jsonify({"status": "shutting down"}), 503
+
+    db = connect_to_db()
+    if db is None:
+        return jsonify({"status": "database unavailable"}), 503
+
+    try:
+        db.ping()
+        return jsonify({"status": "ready"}), 200
+    except StorageError as err:
+        return jsonify({"status": f"database error: {err}"}), 503
+    finally:
+        db.close()
+
+# set once the process started shutting down
+shutting_down = threading.Event()
+
+def create_app():
+    """Create the Flask application and start the background workers of this process"""
+    app = Flask(__name__)
+    # availability and RPT spreadsheets uploaded to /schedule/jobs
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_SIZE', 16*1024*1024))
+    # gzip large responses for clients that accept it
+    app.after_request(compress_response)
+    app.register_blueprint(api)
+    # behind load balancers the client address comes from X-Forwarded-For, only the hops we run are trusted
+    proxy_hops = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+    if proxy_hops > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops, x_host=proxy_hops)
+
+    storage.start()
+    registered_names.start()
+    write_results.start()
+    roster_log.start()
+    mail_queue.start()
+    roster_events.start()
+    return app
+
+def shutdown():
+    """Stop the background workers and close connections, called when a server process exits"""
+    shutting_down.set()
+    roster_events.close_all()
+    mail_queue.stop()
+    schedule_jobs.shutdown()
+    hasher.shutdown()
+    storage.close()
+
 if __name__ == '__main__':
-    # start the Flask application on a specified port
-    app.run(host='0.0.0.0', port=1) # I can't expose my port that's why I wrote random port number here
+    # start the Flask development server on a specified port, see gunicorn.conf.py for production
+    create_app().run(host='0.0.0.0', port=1) # I can't expose my port that's why I wrote random port number here
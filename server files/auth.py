@@ -0,0 +1,59 @@
+import os, secrets
+from flask import request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+class SessionTokens:
+    """Signed, expiring session tokens carrying the user's ID.
+
+    An access token authorises API calls for a short time, a refresh token is kept by the
+    client (in its keyring) and exchanged for new tokens without sending the password.
+    """
+
+    def __init__(self, secret_key, access_ttl=3600, refresh_ttl=30*24*3600) -> None:
+        self.access = URLSafeTimedSerializer(secret_key, salt='access')
+        self.refresh = URLSafeTimedSerializer(secret_key, salt='refresh')
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+
+    def issue(self, user_id, email) -> dict:
+        """Return a new access and refresh token pair for the user"""
+        claims = {"uid": user_id, "email": email}
+        return {
+            "access_token": self.access.dumps(claims),
+            "refresh_token": self.refresh.dumps(claims),
+            "expires_in": self.access_ttl
+        }
+
+    def verify_access(self, token):
+        """Return the claims of a valid access token or None"""
+        return self._load(self.access, token, self.access_ttl)
+
+    def verify_refresh(self, token):
+        """Return the claims of a valid refresh token or None"""
+        return self._load(self.refresh, token, self.refresh_ttl)
+
+    def from_request(self):
+        """Return the bearer token sent with the current request or None if there is none"""
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            return header[len('Bearer '):]
+        return None
+
+    def _load(self, serializer, token, max_age):
+        if not isinstance(token, str):
+            return None
+        try:
+            # SignatureExpired is a subclass of BadSignature
+            return serializer.loads(token, max_age=max_age)
+        except BadSignature:
+            return None
+
+
+def load_secret_key():
+    """Return SECRET_KEY from the environment, tokens then stay valid across restarts and workers"""
+    secret_key = os.environ.get('SECRET_KEY')
+    if not secret_key:
+        # only acceptable for the single process of the development server, gunicorn refuses to start without it
+        print("Warning: SECRET_KEY is not set, sessions will not survive a restart.")
+        secret_key = secrets.token_hex(32)
+    return secret_key
@@ -0,0 +1,65 @@
+import threading, time
+from storage import StorageError
+
+def net_changes(changes):
+    """Collapse logged roster changes into the rows to store and the IDs to remove.
+
+    Changes are (version, action, employee_id, old_employee_id, name, working_time, student)
+    oldest first, an employee changed ten times is sent once with its last state.
+    Returns (upserts, deletes), deletes are applied before upserts.
+    """
+    rows = {}
+    for _, action, employee_id, old_employee_id, employee_name, working_time, student in changes:
+        if action == 'delete':
+            rows[employee_id] = None
+            continue
+        if action == 'update' and old_employee_id != employee_id:
+            rows[old_employee_id] = None
+        rows[employee_id] = (employee_id, employee_name, working_time, student)
+    upserts = [row for row in rows.values() if row is not None]
+    deletes = [employee_id for employee_id, row in rows.items() if row is None]
+    return upserts, deletes
+
+
+class ChangeLogCompactor:
+    """Keeps the roster change log short, in the background.
+
+    Changes older than `retention` seconds and all but the newest `max_changes` of a user are
+    deleted every `interval` seconds. A client whose version is older than what is left gets
+    410 from /data/changes and downloads the whole roster once.
+    """
+
+    def __init__(self, storage, retention=30*24*3600, max_changes=10000, interval=3600) -> None:
+        self.storage = storage
+        self.retention = retention
+        self.max_changes = max_changes
+        self.interval = interval
+        self.stats = {"compactions": 0, "deleted": 0}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._compact, name='changelog-compaction', daemon=True)
+            self.thread.start()
+
+    def compact(self) -> int:
+        """Delete old changes now, return how many"""
+        with self.storage.session() as repository:
+            deleted = repository.compact_roster_changes(time.time() - self.retention, self.max_changes)
+        with self.lock:
+            self.stats["compactions"] += 1
+            self.stats["deleted"] += deleted
+        return deleted
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+    def _compact(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.compact()
+            except StorageError as err:
+                print(f"Could not compact the roster change log: {err}")
@@ -0,0 +1,126 @@
+import queue, threading, time
+import mysql.connector
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection became free within the checkout timeout"""
+
+
+class PooledConnection:
+    """Connection checked out from the pool, close() gives it back instead of closing it"""
+
+    def __init__(self, pool, connection) -> None:
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        # safe to call more than once, only the first call returns the connection
+        if self._connection is not None:
+            self._pool._release(self._connection)
+            self._connection = None
+
+
+class ConnectionPool:
+    """Bounded pool of MySQL connections shared by all request threads.
+
+    Connections are opened lazily up to `size`. A connection idle for longer than
+    `health_check_interval` seconds is pinged (and reopened if needed) before it is handed out.
+    """
+
+    def __init__(self, size=10, checkout_timeout=5, health_check_interval=30, **connect_args) -> None:
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_args = connect_args
+
+        # most recently used connection first, it is the least likely to have timed out
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.stats = {"created": 0, "checkouts": 0, "in_use": 0, "timeouts": 0,
+                      "health_checks": 0, "reconnects": 0, "discarded": 0, "wait_seconds": 0.0}
+
+    def get_connection(self) -> PooledConnection:
+        """Check out a connection, raises PoolTimeoutError or mysql.connector.Error"""
+        started = time.perf_counter()
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            self._count("timeouts")
+            raise PoolTimeoutError(f"No database connection free within {self.checkout_timeout} s")
+
+        try:
+            connection = self._idle_connection() or self._connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_seconds"] += time.perf_counter() - started
+        return PooledConnection(self, connection)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {**self.stats, "size": self.size, "idle": self.idle.qsize()}
+
+    def close_all(self):
+        """Close every idle connection, used on shutdown"""
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.close()
+            except mysql.connector.Error:
+                pass
+
+    def _idle_connection(self):
+        """Return a healthy idle connection or None if there is none"""
+        try:
+            connection, last_used = self.idle.get_nowait()
+        except queue.Empty:
+            return None
+
+        if time.monotonic() - last_used > self.health_check_interval:
+            self._count("health_checks")
+            try:
+                connection.ping(reconnect=True, attempts=1, delay=0)
+            except mysql.connector.Error:
+                # server closed it (e.g. wait_timeout), a fresh one is opened instead
+                self._count("reconnects")
+                self._discard(connection)
+                return None
+        return connection
+
+    def _connect(self):
+        connection = mysql.connector.connect(**self.connect_args)
+        self._count("created")
+        return connection
+
+    def _release(self, connection):
+        with self.lock:
+            self.stats["in_use"] -= 1
+        try:
+            # never hand an unfinished transaction to the next request
+            if connection.in_transaction:
+                connection.rollback()
+        except mysql.connector.Error:
+            self._discard(connection)
+        else:
+            self.idle.put((connection, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    def _discard(self, connection):
+        self._count("discarded")
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
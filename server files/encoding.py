@@ -0,0 +1,44 @@
+import gzip
+from decimal import Decimal
+from flask import Response, jsonify, request
+
+try:
+    import msgpack
+except ImportError:
+    # msgpack is optional, clients then simply get JSON
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+# responses smaller than this are sent as they are, compressing them costs more than it saves
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+def _msgpack_default(value):
+    """Encode the types MySQL returns that msgpack does not know, the same way JSON does"""
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Cannot serialise {type(value).__name__}")
+
+def encode_response(payload, status=200):
+    """Return payload as msgpack if the client accepts it, otherwise as JSON"""
+    if msgpack is not None and request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        body = msgpack.packb(payload, default=_msgpack_default, use_bin_type=True)
+        return Response(body, status=status, mimetype=MSGPACK_MIMETYPE)
+    return jsonify(payload), status
+
+def compress_response(response):
+    """Gzip the response body if the client supports it and the body is large enough"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+
+    response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,125 @@
+import json, queue, threading
+
+try:
+    import redis
+except ImportError:
+    # redis is only needed when the events are shared through REDIS_URL
+    redis = None
+
+class TooManyStreamsError(Exception):
+    """Raised when the process already serves the maximum number of event streams"""
+
+
+class RosterEvents:
+    """Delivers roster changes to the open event streams of the same user.
+
+    Every stream has its own bounded queue, a client too slow to keep up loses its stream
+    and catches up by synchronising. Without Redis only the streams of this process receive
+    the changes made through it; with REDIS_URL changes are published to every process.
+    """
+
+    CHANNEL = 'roster-events'
+
+    def __init__(self, max_streams=100, queue_size=100, redis_url=None) -> None:
+        self.max_streams = max_streams
+        self.queue_size = queue_size
+        # user_id -> set of queues of the open streams
+        self.streams = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stats = {"published": 0, "delivered": 0, "dropped_streams": 0}
+        self.redis = None
+        self.listener = None
+        if redis_url:
+            if redis is None:
+                raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+            self.redis = redis.Redis.from_url(redis_url)
+
+    def start(self):
+        """Start listening to the changes of other processes, only needed with Redis"""
+        if self.redis is not None and self.listener is None:
+            self.listener = threading.Thread(target=self._listen, name='roster-events', daemon=True)
+            self.listener.start()
+
+    def publish(self, user_id, event):
+        """Send a change to every stream of the user, in this process and, with Redis, in the others"""
+        self._count("published")
+        if self.redis is not None:
+            try:
+                self.redis.publish(self.CHANNEL, json.dumps({"user_id": user_id, "event": event}))
+                return
+            except redis.RedisError as e:
+                # the streams of this process still get the change
+                print(f"Could not publish roster event: {e}")
+        self._deliver(user_id, event)
+
+    def subscribe(self, user_id) -> queue.Queue:
+        """Open a stream, raises TooManyStreamsError if the process is at its limit"""
+        stream = queue.Queue(self.queue_size)
+        with self.lock:
+            if self.count >= self.max_streams:
+                raise TooManyStreamsError("Too many open event streams")
+            self.streams.setdefault(user_id, set()).add(stream)
+            self.count += 1
+        return stream
+
+    def unsubscribe(self, user_id, stream):
+        with self.lock:
+            streams = self.streams.get(user_id)
+            if streams is not None and stream in streams:
+                streams.discard(stream)
+                self.count -= 1
+                if not streams:
+                    del self.streams[user_id]
+
+    def close_all(self):
+        """End every open stream, used on shutdown"""
+        with self.lock:
+            streams = [stream for user_streams in self.streams.values() for stream in user_streams]
+        for stream in streams:
+            self._end(stream)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {**self.stats, "streams": self.count, "users": len(self.streams)}
+
+    def _deliver(self, user_id, event):
+        with self.lock:
+            streams = list(self.streams.get(user_id, ()))
+        for stream in streams:
+            try:
+                stream.put_nowait(event)
+                self._count("delivered")
+            except queue.Full:
+                # the client fell behind, end its stream, it reconnects and synchronises
+                self._count("dropped_streams")
+                self.unsubscribe(user_id, stream)
+                self._end(stream)
+
+    def _end(self, stream):
+        # None tells the stream to close, make room for it if the queue is full
+        while True:
+            try:
+                stream.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    stream.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                for message in pubsub.listen():
+                    data = json.loads(message['data'])
+                    self._deliver(data['user_id'], data['event'])
+            except redis.RedisError as e:
+                print(f"Roster event listener lost Redis, reconnecting: {e}")
+                threading.Event().wait(1)
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
@@ -0,0 +1,43 @@
+import multiprocessing, os
+
+# production serving settings, start with "gunicorn -c gunicorn.conf.py wsgi:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', 1)}"
+
+# several processes use all cores, threads keep a process busy while requests wait for MySQL
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+
+# every worker imports the app itself, so each one gets its own connection pool and mail workers
+preload_app = False
+
+# requests running when a worker is told to stop get this long to finish
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+# restart workers now and then, so a slow leak cannot build up
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = 1000
+
+accesslog = '-'
+
+def on_starting(server):
+    """Check the configuration and bring the database schema up to date once, before any worker starts"""
+    # without it every worker signs with a random key of its own, tokens and Idempotency-Key fingerprints
+    # of one worker would be rejected by the others
+    if not os.environ.get('SECRET_KEY'):
+        raise RuntimeError("SECRET_KEY must be set, every worker process has to sign with the same key")
+    # a SQLite database gets its schema when the file is opened
+    if os.environ.get('DB_MIGRATE_ON_START', '1') != '0' and os.environ.get('STORAGE_BACKEND', 'mysql') == 'mysql':
+        from migrations import connect, migrate
+        connection = connect()
+        try:
+            migrate(connection)
+        finally:
+            connection.close()
+
+def worker_exit(server, worker):
+    """Stop the worker's background threads and close its database connections"""
+    from app import shutdown
+    shutdown()
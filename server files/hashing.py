@@ -0,0 +1,99 @@
+import multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+from metrics import BCRYPT_SECONDS, BCRYPT_REJECTED
+
+class HasherBusyError(Exception):
+    """Raised when too many password checks are already waiting or one did not finish in time"""
+
+
+# functions executed in the worker processes
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _check_password(password, stored_hash):
+    return bcrypt.checkpw(password, stored_hash)
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded pool of worker processes.
+
+    Request threads only wait for the result, so a burst of logins cannot take the
+    CPU from every other endpoint. At most `workers + max_queue` operations are
+    accepted at once, the rest are rejected with HasherBusyError. So is an operation
+    that does not finish within `timeout` seconds, it keeps its slot until it ends.
+    """
+
+    def __init__(self, workers=2, max_queue=32, rounds=12, timeout=30) -> None:
+        self.workers = workers
+        self.rounds = rounds
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.executor = None
+        self.executor_pid = None
+        self.lock = threading.Lock()
+
+    def hash(self, password) -> bytes:
+        """Return the bcrypt hash of the password with the configured work factor"""
+        return self._run('hash', _hash_password, password.encode('utf-8'), self.rounds)
+
+    def verify(self, password, stored_hash) -> bool:
+        """Check the password against a stored hash"""
+        # ensure the password hash is encoded properly
+        if isinstance(stored_hash, str):
+            stored_hash = stored_hash.encode('utf-8')
+        return self._run('verify', _check_password, password.encode('utf-8'), stored_hash)
+
+    def needs_rehash(self, stored_hash) -> bool:
+        """Check if the hash was made with a different work factor than the configured one"""
+        if isinstance(stored_hash, bytes):
+            stored_hash = stored_hash.decode('utf-8')
+        # bcrypt hashes look like $2b$12$..., the number being the work factor
+        try:
+            return int(stored_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def _run(self, operation, function, *args):
+        if not self.slots.acquire(blocking=False):
+            BCRYPT_REJECTED.inc()
+            raise HasherBusyError("Too many password operations in progress")
+        try:
+            future = self._executor().submit(function, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            self._reset()
+            raise HasherBusyError("Password hashing pool restarted")
+        # the slot stays taken until the worker is done, a timed out operation still occupies it
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            with BCRYPT_SECONDS.time(operation=operation):
+                return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HasherBusyError(f"Password {operation} took longer than {self.timeout} s")
+        except BrokenProcessPool:
+            # a worker process died, the next operation gets a new pool
+            self._reset()
+            raise HasherBusyError("Password hashing pool restarted")
+
+    def _reset(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+    def _executor(self):
+        # created on first use in each server process, a pool inherited through fork would not work
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.executor_pid = os.getpid()
+            return self.executor
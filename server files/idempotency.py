@@ -0,0 +1,148 @@
+import functools, hashlib, hmac, threading, time
+from flask import Response, g, jsonify, make_response, request
+from storage import DuplicateError, StorageError
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+class IdempotencyStore:
+    """Answers of write requests by their Idempotency-Key header, a repeated request gets the first answer again.
+
+    The key is claimed in the idempotency_keys table before the request runs, so a retry arriving
+    while the first attempt still runs gets 409 with Retry-After instead of running twice. Answers
+    below 500 are stored for `ttl` seconds, server errors release the key so a retry runs again.
+    A claim whose request never finished (its process died) can be taken over after `lease` seconds.
+    """
+
+    def __init__(self, storage, secret_key, ttl=24*3600, lease=120, max_body=64*1024, purge_interval=300) -> None:
+        self.storage = storage
+        self.secret_key = secret_key.encode() if isinstance(secret_key, str) else secret_key
+        self.ttl = ttl
+        self.lease = lease
+        self.max_body = max_body
+        self.purge_interval = purge_interval
+        self.stats = {"executed": 0, "replayed": 0, "in_progress": 0, "mismatched": 0, "purged": 0}
+        self.lock = threading.Lock()
+        self.purger = None
+
+    def start(self):
+        """Start deleting expired keys in the background"""
+        if self.purger is None:
+            self.purger = threading.Thread(target=self._purge, name='idempotency-purge', daemon=True)
+            self.purger.start()
+
+    def idempotent(self, view):
+        """Decorator for write routes, requests without the header run as before"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return view(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({"message": f"Invalid {HEADER}"}), 400
+
+            scope = self._scope()
+            # the same key with another request is a client bug, not a retry. Keyed, the body of
+            # /register holds a password that must not be recoverable from a plain hash
+            fingerprint = hmac.new(self.secret_key, f"{request.method} {request.path}\n".encode() + self._body(),
+                                   hashlib.sha256).hexdigest()
+            try:
+                earlier = self._claim(scope, key, fingerprint)
+            except StorageError as err:
+                return jsonify({"message": f"Database error: {err}"}), 500
+            if earlier is not None:
+                return self._replay(earlier, fingerprint)
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                self._release(scope, key)
+                raise
+            self._count("executed")
+            if response.status_code >= 500 or response.is_streamed or response.content_length is None \
+                    or response.content_length > self.max_body:
+                self._release(scope, key)
+            else:
+                self._finish(scope, key, response)
+            return response
+        return wrapper
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+    def _scope(self):
+        # keys are only unique per client, requests without a session token are scoped by the email they name
+        if g.user_id is not None:
+            return f"user:{g.user_id}"
+        data = request.get_json(silent=True) or request.form
+        return f"email:{data.get('user_email') or data.get('email') or ''}"
+
+    def _body(self) -> bytes:
+        # every attempt of a multipart upload has another random boundary, compare the parts instead
+        if request.mimetype != 'multipart/form-data':
+            return request.get_data()
+        parts = [f"{name}={value}".encode() for name, value in sorted(request.form.items(multi=True))]
+        for name, upload in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            parts.append(f"{name}:{upload.filename}=".encode() + upload.read())
+            upload.seek(0)
+        return b'\n'.join(parts)
+
+    def _claim(self, scope, key, fingerprint):
+        """Return None if this request may run, otherwise the row of the earlier request"""
+        now = time.time()
+        with self.storage.session() as repository:
+            # the earlier row may be released between the failed insert and the select, then try again
+            for _ in range(3):
+                try:
+                    repository.add_idempotency_key(scope, key, fingerprint, now)
+                    return None
+                except DuplicateError:
+                    pass
+                if repository.take_over_idempotency_key(scope, key, fingerprint, now, now - self.lease):
+                    return None
+                earlier = repository.idempotency_key(scope, key)
+                if earlier is not None:
+                    return earlier
+        raise StorageError(f"Could not claim {HEADER} {key}")
+
+    def _replay(self, earlier, fingerprint):
+        stored_fingerprint, status_code, mimetype, body = earlier
+        if stored_fingerprint != fingerprint:
+            self._count("mismatched")
+            return jsonify({"message": f"{HEADER} was already used for a different request"}), 422
+        if status_code is None:
+            self._count("in_progress")
+            return jsonify({"message": "A request with this key is still running"}), 409, {"Retry-After": "1"}
+        self._count("replayed")
+        return Response(bytes(body), status=status_code, mimetype=mimetype, headers={"Idempotent-Replayed": "true"})
+
+    def _finish(self, scope, key, response):
+        try:
+            with self.storage.session() as repository:
+                repository.finish_idempotency_key(scope, key, response.status_code, response.mimetype, response.get_data())
+        except StorageError as err:
+            # the write is done, a retry after the lease would run it again
+            print(f"Could not store the answer for {HEADER} {key}: {err}")
+
+    def _release(self, scope, key):
+        try:
+            with self.storage.session() as repository:
+                repository.delete_idempotency_key(scope, key)
+        except StorageError as err:
+            print(f"Could not release {HEADER} {key}, it expires after the lease: {err}")
+
+    def _purge(self):
+        while True:
+            time.sleep(self.purge_interval)
+            try:
+                with self.storage.session() as repository:
+                    purged = repository.purge_idempotency_keys(time.time() - self.ttl)
+                with self.lock:
+                    self.stats["purged"] += purged
+            except StorageError as err:
+                print(f"Could not purge idempotency keys: {err}")
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
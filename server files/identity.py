@@ -0,0 +1,68 @@
+import threading, time
+from collections import OrderedDict
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, max_size=10000, ttl=300) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value or None if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            # drop the least recently used entries above the limit
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+class UserResolver:
+    """Resolves user emails to user IDs, remembering the answers.
+
+    A user's ID never changes, so the TTL only bounds how long an entry for
+    a deleted account can live. Unknown emails are not cached, the user may register any moment.
+    """
+
+    def __init__(self, max_size=10000, ttl=300) -> None:
+        self.cache = TTLCache(max_size, ttl)
+
+    def user_id(self, repository, email):
+        """Return the ID of the user with the given email or None if there is no such user"""
+        user_id = self.cache.get(email)
+        if user_id is not None:
+            return user_id
+
+        user_id = repository.user_id(email)
+        if user_id is None:
+            return None
+
+        self.cache.set(email, user_id)
+        return user_id
+
+    def forget(self, email):
+        self.cache.delete(email)
@@ -0,0 +1,113 @@
+import datetime, hashlib, io, json, multiprocessing, os, random, sys, threading, uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from schedulecodec import encode_schedule
+
+class JobQueueFullError(Exception):
+    """Raised when the process already holds the maximum number of unfinished jobs"""
+
+
+class StaticRoster:
+    """Employee table handed to ScheduleCreator in place of the API client"""
+
+    def __init__(self, rows) -> None:
+        self.rows = rows
+
+    def getEmployeeTable(self, user_email):
+        return self.rows
+
+
+def run_schedule(user_email, availability, rpt, roster, seed):
+    """Generate a schedule in a worker process, return it as {day: {"HH:MM": [employee IDs]}} and its score"""
+    try:
+        from scheduleCreator import ScheduleCreator
+    except ImportError:
+        # running from the repository instead of the Docker image, the module lives in src/
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+        from scheduleCreator import ScheduleCreator
+
+    # the same seed and input files give the same schedule again
+    random.seed(seed)
+    creator = ScheduleCreator(user_email, io.BytesIO(availability), io.BytesIO(rpt), StaticRoster(roster))
+    schedule = {day: {str(hour): employees for hour, employees in hours.items()} for day, hours in creator.schedule.items()}
+    return schedule, creator.score
+
+
+class ScheduleJobs:
+    """Runs schedule generation jobs on a pool of worker processes.
+
+    Job state lives in the schedule_jobs table, so any server process can answer status
+    requests. A finished schedule is also saved to the schedules table with its seed and the
+    hashes of its input files. Each process runs at most `workers` jobs at once and accepts up to `max_pending`
+    unfinished jobs, the ones waiting for a free worker stay 'queued'.
+    """
+
+    def __init__(self, storage, workers=2, max_pending=20, timeout=600) -> None:
+        self.storage = storage
+        self.workers = workers
+        self.timeout = timeout
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.threads = ThreadPoolExecutor(workers, thread_name_prefix='schedule-job')
+        self.processes = None
+        self.processes_pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, user_id, user_email, availability, rpt, roster, month=None) -> str:
+        """Queue a job and return its ID, raises JobQueueFullError if this process is at capacity
+
+        `month` ("YYYY-MM") is the month the schedule is saved for, by default the month of its first day this year.
+        """
+        if not self.pending.acquire(blocking=False):
+            raise JobQueueFullError("Too many schedule jobs in progress")
+
+        job_id = uuid.uuid4().hex
+        try:
+            with self.storage.session() as repository:
+                repository.create_job(job_id, user_id)
+            self.threads.submit(self._run, job_id, user_id, user_email, availability, rpt, roster, month)
+        except Exception:
+            self.pending.release()
+            raise
+        return job_id
+
+    def shutdown(self):
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            if self.processes is not None:
+                self.processes.shutdown(wait=False, cancel_futures=True)
+                self.processes = None
+
+    def _run(self, job_id, user_id, user_email, availability, rpt, roster, month):
+        try:
+            with self.storage.session() as repository:
+                repository.start_job(job_id)
+            seed = random.getrandbits(32)
+            schedule, score = self._processes().submit(run_schedule, user_email, availability, rpt, roster, seed).result(timeout=self.timeout)
+
+            if month is None:
+                # day labels are "dd-mm", they carry no year
+                today = datetime.date.today()
+                month = f"{today.year}-{next(iter(schedule)).split('-')[1]}" if schedule else today.strftime('%Y-%m')
+            employees, days = encode_schedule(schedule, month)
+            with self.storage.session() as repository:
+                repository.save_schedule(user_id, month, employees, days, seed=seed, score=score,
+                                         availability_hash=hashlib.sha256(availability).hexdigest(),
+                                         rpt_hash=hashlib.sha256(rpt).hexdigest(), job_id=job_id)
+                repository.finish_job(job_id, json.dumps(schedule))
+            self.storage.wrote(user_id)
+        except Exception as e:
+            print(f"Schedule job {job_id} failed: {e}")
+            try:
+                with self.storage.session() as repository:
+                    repository.fail_job(job_id, str(e)[:1000])
+            except Exception as err:
+                print(f"Could not record failure of job {job_id}: {err}")
+        finally:
+            self.pending.release()
+
+    def _processes(self):
+        # created on first use in each server process, a pool inherited through fork would not work
+        with self.lock:
+            if self.processes is None or self.processes_pid != os.getpid():
+                self.processes = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.processes_pid = os.getpid()
+            return self.processes
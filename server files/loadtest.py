@@ -0,0 +1,246 @@
+"""Load test of the API.
+
+Replays a mix of the calls the desktop client makes from many simulated managers at once and
+reports throughput, latency percentiles and error rates per endpoint. Run it against a server
+started with a local database, e.g. STORAGE_BACKEND=sqlite or "docker compose up mysql_db" and DB_*
+variables pointing at it:
+
+    STORAGE_BACKEND=sqlite python loadtest.py --launch --concurrency 20 --duration 60
+    python loadtest.py --url http://127.0.0.1:8000 --mix get=20,add=1 --json results.json
+"""
+import argparse, json, math, os, random, secrets, subprocess, sys, threading, time, uuid
+import urllib.error, urllib.request
+
+# relative weights of the operations, reads hugely outnumber writes for a real manager
+DEFAULT_MIX = {"login": 1, "get": 20, "check": 5, "add": 2, "update": 2, "delete": 2, "register_check": 2}
+ROSTER_SIZE = 30
+
+
+class Results:
+    """Latencies and errors of every call, grouped by endpoint"""
+
+    def __init__(self) -> None:
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, error=None):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if error is not None:
+                errors = self.errors.setdefault(endpoint, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def summary(self, elapsed) -> dict:
+        with self.lock:
+            summary = {}
+            for endpoint, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                errors = self.errors.get(endpoint, {})
+                summary[endpoint] = {
+                    "requests": len(latencies),
+                    "throughput": round(len(latencies) / elapsed, 1),
+                    "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+                    "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+                    "error_rate": round(sum(errors.values()) / len(latencies), 4),
+                    "errors": {str(error): count for error, count in errors.items()},
+                }
+            return summary
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values), math.ceil(percent / 100 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+class VirtualManager:
+    """One simulated user of the desktop client with an account and a roster of their own"""
+
+    def __init__(self, base_url, results, number) -> None:
+        self.base_url = base_url
+        self.results = results
+        self.email = f"loadtest-{uuid.uuid4().hex[:12]}-{number}@example.com"
+        self.password = uuid.uuid4().hex
+        self.access_token = None
+        self.employees = []
+        self.next_employee = 0
+
+    def call(self, endpoint, method, path, payload=None, record=True):
+        """Send one request, return (status, body) with status None if the server could not be reached"""
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        request.add_header('Content-Type', 'application/json')
+        request.add_header('X-Request-ID', uuid.uuid4().hex)
+        if self.access_token is not None:
+            request.add_header('Authorization', f"Bearer {self.access_token}")
+
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, content = e.code, e.read()
+        except (urllib.error.URLError, OSError) as e:
+            if record:
+                self.results.record(endpoint, time.perf_counter() - started, type(e).__name__)
+            return None, None
+
+        if record:
+            # 409 and 410 are answers the client expects, e.g. a roster that does not exist yet. 429 is not,
+            # a rate limited run does not measure what the server can do
+            self.results.record(endpoint, time.perf_counter() - started, status if status >= 500 or status in (400, 401, 404, 429) else None)
+        try:
+            return status, json.loads(content)
+        except ValueError:
+            return status, None
+
+    def setup(self):
+        """Register the account, log in and fill the roster, not measured"""
+        status, _ = self.call('setup', 'POST', '/register', {"username": self.email.split('@')[0], "email": self.email,
+                                                             "password": self.password}, record=False)
+        if status != 201:
+            raise RuntimeError(f"Registration of {self.email} failed with status {status}")
+        if self.login(record=False) != 200:
+            raise RuntimeError(f"Login of {self.email} failed")
+        for _ in range(ROSTER_SIZE):
+            self.add(record=False)
+
+    def login(self, record=True):
+        status, body = self.call('/login', 'POST', '/login', {"email": self.email, "password": self.password}, record)
+        if status == 200:
+            self.access_token = body['access_token']
+        return status
+
+    def get(self):
+        self.call('/data/get', 'POST', '/data/get', {"user_email": self.email})
+
+    def check(self):
+        self.call('/data/checkemployee', 'POST', '/data/checkemployee', {"user_email": self.email})
+
+    def add(self, record=True):
+        employee_id = f"{self.next_employee:05d}"
+        self.next_employee += 1
+        status, _ = self.call('/data/add', 'POST', '/data/add', {"user_email": self.email, "employee_id": employee_id,
+                                                                "employee_name": f"Employee {employee_id}", "work_time": "0.5",
+                                                                "student_or_second_job": 0}, record)
+        if status == 201:
+            self.employees.append(employee_id)
+
+    def update(self):
+        if not self.employees:
+            return self.add()
+        employee_id = random.choice(self.employees)
+        self.call('/data/update', 'POST', '/data/update', {"user_email": self.email, "old_employee_id": employee_id,
+                                                           "employee_id": employee_id, "employee_name": f"Renamed {employee_id}",
+                                                           "work_time": random.choice(["0.25", "0.5", "0.75", "1"]),
+                                                           "student_or_second_job": random.randint(0, 1)})
+
+    def delete(self):
+        if not self.employees:
+            return self.add()
+        employee_id = self.employees.pop(random.randrange(len(self.employees)))
+        self.call('/data/delete', 'POST', '/data/delete', {"user_email": self.email, "employee_id": employee_id})
+
+    def register_check(self):
+        value = random.choice([self.email, f"free-{uuid.uuid4().hex[:12]}@example.com"])
+        self.call('/register/check', 'POST', '/register/check', {"type": "email", "value": value})
+
+    def run(self, mix, deadline, think_time):
+        operations = list(mix)
+        weights = [mix[operation] for operation in operations]
+        while time.monotonic() < deadline:
+            getattr(self, random.choices(operations, weights)[0])()
+            if think_time:
+                time.sleep(random.uniform(0, 2 * think_time))
+
+
+def parse_mix(text):
+    """Parse "get=20,add=1" into weights, unknown operations are rejected"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name}, choose from {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def launch_server(port, workers):
+    """Start gunicorn with the local configuration and wait until it is ready"""
+    environment = {**os.environ, "PORT": str(port), "WEB_WORKERS": str(workers),
+                   # cheap hashes, the test measures the API and not bcrypt
+                   "BCRYPT_ROUNDS": os.environ.get('BCRYPT_ROUNDS', '4'),
+                   # gunicorn refuses to start without one, all workers share it
+                   "SECRET_KEY": os.environ.get('SECRET_KEY') or secrets.token_hex(32),
+                   # every manager calls from this address, the per-client limits would measure themselves
+                   "RATE_LIMIT_SCALE": os.environ.get('RATE_LIMIT_SCALE', '0'),
+                   "MAX_CLIENT_REQUESTS": os.environ.get('MAX_CLIENT_REQUESTS', '1000')}
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=environment)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=1):
+                return server
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("Server did not become ready, is the database reachable?")
+
+
+def print_summary(summary, elapsed, concurrency):
+    total = sum(endpoint["requests"] for endpoint in summary.values())
+    print(f"\n{total} requests in {elapsed:.1f} s from {concurrency} managers, {total / elapsed:.1f} requests/s\n")
+    print(f"{'endpoint':<22}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>9}")
+    for name, endpoint in summary.items():
+        print(f"{name:<22}{endpoint['requests']:>10}{endpoint['throughput']:>9}{endpoint['p50_ms']:>9}"
+              f"{endpoint['p95_ms']:>9}{endpoint['p99_ms']:>9}{endpoint['error_rate']:>9.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the schedule creator API")
+    parser.add_argument('--url', default=None, help="base URL of a running server")
+    parser.add_argument('--launch', action='store_true', help="start the server with gunicorn for the test")
+    parser.add_argument('--port', type=int, default=8765, help="port of the launched server")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers of the launched server")
+    parser.add_argument('--concurrency', type=int, default=10, help="simulated managers calling at once")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+    parser.add_argument('--think-time', type=float, default=0, help="average pause between calls of a manager")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help="operation weights, e.g. get=20,add=1")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = launch_server(args.port, args.workers) if args.launch else None
+    base_url = (args.url or f"http://127.0.0.1:{args.port}").rstrip('/')
+    try:
+        results = Results()
+        managers = [VirtualManager(base_url, results, number) for number in range(args.concurrency)]
+        print(f"Creating {len(managers)} accounts with {ROSTER_SIZE} employees each...")
+        for manager in managers:
+            manager.setup()
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=manager.run, args=(args.mix, started + args.duration, args.think_time))
+                   for manager in managers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        summary = results.summary(elapsed)
+        print_summary(summary, elapsed, args.concurrency)
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump({"concurrency": args.concurrency, "duration": elapsed, "mix": args.mix, "endpoints": summary}, file, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
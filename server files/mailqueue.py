@@ -0,0 +1,167 @@
+import random, smtplib, sqlite3, threading, time
+from contextlib import contextmanager
+from mailserver import SmtpConnection, build_confirmation_email, smtp_settings
+
+class MailQueue:
+    """Sends emails in background worker threads from a persistent SQLite outbox.
+
+    Emails survive a restart of the server and are retried with exponential backoff.
+    Each worker keeps its own SMTP connection open between emails. Several server
+    processes may share one outbox file, a worker claims an email before sending it.
+    """
+
+    # seconds a claimed email stays reserved for the worker sending it
+    CLAIM_TIMEOUT = 120
+
+    def __init__(self, outbox_path='mail_outbox.db', workers=2, max_attempts=6, poll_interval=5) -> None:
+        self.outbox_path = outbox_path
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.workers = []
+        self.stats = {"sent": 0, "retried": 0, "failed": 0}
+        self.stats_lock = threading.Lock()
+
+        with self._outbox() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    recipient TEXT NOT NULL,
+                                    message TEXT NOT NULL,
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    next_attempt REAL NOT NULL,
+                                    claimed_until REAL NOT NULL DEFAULT 0,
+                                    status TEXT NOT NULL DEFAULT 'pending',
+                                    last_error TEXT)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)")
+
+    def start(self):
+        """Start the worker threads"""
+        for number in range(self.worker_count):
+            worker = threading.Thread(target=self._work, name=f"mail-worker-{number}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=10):
+        """Let the workers finish the email they are sending and stop them"""
+        self.stop_event.set()
+        self.wake_event.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def enqueue(self, recipient, message):
+        """Store an email in the outbox, it is sent by a worker shortly after"""
+        with self._outbox() as connection:
+            connection.execute("INSERT INTO outbox (recipient, message, next_attempt) VALUES (?, ?, ?)",
+                               (recipient, message, time.time()))
+        self.wake_event.set()
+
+    def send_confirmation_email(self, recipient_email):
+        """Queue the confirmation email sent to the user after successful registration"""
+        settings = smtp_settings()
+        self.enqueue(recipient_email, build_confirmation_email(settings['sender_email'], recipient_email).as_string())
+
+    def depth(self) -> int:
+        """Return the number of emails waiting to be sent"""
+        with self._outbox() as connection:
+            return connection.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def metrics(self) -> dict:
+        with self.stats_lock:
+            return {**self.stats, "depth": self.depth()}
+
+    def _connect(self):
+        connection = sqlite3.connect(self.outbox_path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    @contextmanager
+    def _outbox(self):
+        """Open the outbox for one transaction"""
+        connection = self._connect()
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _claim(self):
+        """Reserve the next due email for this worker, return (id, recipient, message, attempts) or None"""
+        now = time.time()
+        connection = self._connect()
+        try:
+            # IMMEDIATE takes the write lock at once, so two workers never claim the same email
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("""SELECT id, recipient, message, attempts FROM outbox
+                                        WHERE status = 'pending' AND next_attempt <= ? AND claimed_until <= ?
+                                        ORDER BY next_attempt LIMIT 1""", (now, now)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE outbox SET claimed_until = ? WHERE id = ?", (now + self.CLAIM_TIMEOUT, row[0]))
+            connection.execute("COMMIT")
+            return row
+        finally:
+            connection.close()
+
+    def _finish(self, mail_id, attempts, error=None):
+        """Remove a sent email or schedule the next attempt of a failed one"""
+        try:
+            self._record(mail_id, attempts, error)
+        except sqlite3.Error as e:
+            # the worker carries on, the email is claimed again once CLAIM_TIMEOUT ran out
+            print(f"Mail outbox error, email {mail_id} is tried again after its claim expires: {e}")
+
+    def _record(self, mail_id, attempts, error):
+        with self._outbox() as connection:
+            if error is None:
+                connection.execute("DELETE FROM outbox WHERE id = ?", (mail_id,))
+                self._count("sent")
+            elif attempts >= self.max_attempts:
+                connection.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                                   (attempts, str(error), mail_id))
+                self._count("failed")
+                print(f"Giving up on email {mail_id} after {attempts} attempts: {error}")
+            else:
+                # exponential backoff with jitter, capped at an hour
+                delay = min(3600, 30 * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+                connection.execute("UPDATE outbox SET attempts = ?, next_attempt = ?, claimed_until = 0, last_error = ? WHERE id = ?",
+                                   (attempts, time.time() + delay, str(error), mail_id))
+                self._count("retried")
+                print(f"Failed to send email {mail_id}, retrying in {delay:.0f} s: {error}")
+
+    def _work(self):
+        smtp = None
+        while not self.stop_event.is_set():
+            try:
+                mail = self._claim()
+            except sqlite3.Error as e:
+                print(f"Mail outbox error: {e}")
+                mail = None
+
+            if mail is None:
+                # nothing due, wait for a new email or the next retry
+                self.wake_event.wait(self.poll_interval)
+                self.wake_event.clear()
+                continue
+
+            mail_id, recipient, message, attempts = mail
+            try:
+                if smtp is None:
+                    smtp = SmtpConnection(smtp_settings())
+                smtp.send(recipient, message)
+            except smtplib.SMTPAuthenticationError as e:
+                # handle error when authentication to the SMTP server fails
+                print("Failed to send email: Authentication error. Please check your email and password.")
+                self._finish(mail_id, attempts + 1, e)
+            except (smtplib.SMTPException, OSError, ValueError) as e:
+                self._finish(mail_id, attempts + 1, e)
+            else:
+                self._finish(mail_id, attempts + 1)
+
+        if smtp is not None:
+            smtp.close()
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
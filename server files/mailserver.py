@@ -4,19 +4,25 @@ from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
 import os
 
-def send_confirmation_email(recipient_email):
-    """Send a confirmation email to the user after successful registration"""
-    sender_email = os.getenv('EMAIL_ADDRESS')  # get the sender email from environment variables
-    sender_password = os.getenv('EMAIL_PASSWORD')  # get the sender password from environment variables
-    smtp_server = os.getenv('SMTP_SERVER', 'smtp.examplesmtp.com')  # default SMTP server if not set
-    smtp_port = os.getenv('SMTP_PORT', 1)  # default SMTP port if not set
-
-    if not sender_email or not sender_password:
+def smtp_settings():
+    """Read the SMTP configuration from environment variables"""
+    settings = {
+        'sender_email': os.getenv('EMAIL_ADDRESS'),  # get the sender email from environment variables
+        'sender_password': os.getenv('EMAIL_PASSWORD'),  # get the sender password from environment variables
+        'smtp_server': os.getenv('SMTP_SERVER', 'smtp.examplesmtp.com'),  # default SMTP server if not set
+        'smtp_port': int(os.getenv('SMTP_PORT', 1)),  # default SMTP port if not set
+        # a local SMTP stand-in used for testing usually speaks neither TLS nor AUTH
+        'starttls': os.getenv('SMTP_STARTTLS', '1') != '0',
+        'login': os.getenv('SMTP_LOGIN', '1') != '0',
+    }
+
+    if not settings['sender_email'] or (settings['login'] and not settings['sender_password']):
         # raise an error if email or password is not set in environment variables
         raise ValueError("Email address or password environment variables are not set.")
+    return settings
 
-    print(f"Sender email: {sender_email}")  # log the sender email for debugging
-
+def build_confirmation_email(sender_email, recipient_email):
+    """Create the confirmation email sent to the user after successful registration"""
     # email content setup
     subject = "Registration Confirmation"  # subject of the confirmation email
     body = f"""
@@ -36,23 +42,49 @@ def send_confirmation_email(recipient_email):
 
     # attach the email body to the message
     msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+
+class SmtpConnection:
+    """SMTP connection kept open between emails and reopened when the server drops it"""
+
+    def __init__(self, settings, timeout=30) -> None:
+        self.settings = settings
+        self.timeout = timeout
+        self.server = None
+
+    def send(self, recipient_email, message):
+        """Send an email, raises smtplib.SMTPException or OSError if it fails"""
+        try:
+            self._connection().sendmail(self.settings['sender_email'], recipient_email, message)
+        except smtplib.SMTPServerDisconnected:
+            # the server closed an idle connection, try once more on a new one
+            self.server = None
+            self._connection().sendmail(self.settings['sender_email'], recipient_email, message)
+        except (smtplib.SMTPException, OSError):
+            # state of the connection is unknown, start over next time
+            self.close()
+            raise
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
 
-    try:
-        # connect to the SMTP server
-        with smtplib.SMTP(smtp_server, int(smtp_port)) as server:
-            server.starttls()  # initiate TLS encryption for the connection
-            server.login(sender_email, sender_password)  # login to the SMTP server
-            server.sendmail(sender_email, recipient_email, msg.as_string())  # send the email
-            print("Confirmation email sent successfully.")  # log success
-    except smtplib.SMTPAuthenticationError:
-        # handle error when authentication to the SMTP server fails
-        print("Failed to send email: Authentication error. Please check your email and password.")
-    except smtplib.SMTPConnectError:
-        # handle error when the connection to the SMTP server fails
-        print("Failed to send email: Could not connect to the SMTP server. Check server address and port.")
-    except smtplib.SMTPException as e:
-        # handle other SMTP-related errors
-        print(f"Failed to send email due to SMTP error: {e}")
-    except Exception as e:
-        # handle any other unexpected errors
-        print(f"An unexpected error occurred: {e}")
+    def _connection(self):
+        if self.server is None:
+            # connect to the SMTP server
+            server = smtplib.SMTP(self.settings['smtp_server'], self.settings['smtp_port'], timeout=self.timeout)
+            try:
+                if self.settings['starttls']:
+                    server.starttls()  # initiate TLS encryption for the connection
+                if self.settings['login']:
+                    server.login(self.settings['sender_email'], self.settings['sender_password'])  # login to the SMTP server
+            except (smtplib.SMTPException, OSError):
+                server.close()
+                raise
+            self.server = server
+        return self.server
@@ -0,0 +1,103 @@
+import hashlib, threading, time
+from storage import StorageError
+
+FIELDS = ('username', 'email')
+
+class MembershipIndex:
+    """Every taken username and email in memory, so /register/check needs no query.
+
+    Values are kept as 64-bit hashes of the form the users table compares, two different names
+    share one with a chance of about one in 10^19 per pair. The index is loaded from the users
+    table in the background and reloaded every `refresh_interval` seconds, registrations through
+    this process are added right away. Names registered through other processes are only seen
+    after the next reload, the unique keys of the users table still turn those away on /register.
+    """
+
+    def __init__(self, storage, refresh_interval=600, page_size=5000) -> None:
+        self.storage = storage
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        # field -> set of hashes, None until the first load finished
+        self.values = None
+        self.unique_key = None
+        # registrations made while a load runs, added to its result before it replaces the index
+        self.loading = None
+        self.lock = threading.Lock()
+        self.stats = {"answered": 0, "unavailable": 0, "loads": 0, "load_seconds": 0.0}
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._refresh, name='membership-index', daemon=True)
+            self.thread.start()
+
+    def contains(self, field, value):
+        """Return True if the username or email is taken, None while the index is not loaded"""
+        with self.lock:
+            if self.values is None:
+                self.stats["unavailable"] += 1
+                return None
+            self.stats["answered"] += 1
+            return isinstance(value, str) and self._hash(value) in self.values[field]
+
+    def add(self, field, value):
+        """Mark a username or email as taken"""
+        if not isinstance(value, str):
+            return
+        with self.lock:
+            if self.loading is not None:
+                self.loading.append((field, value))
+            if self.values is not None:
+                self.values[field].add(self._hash(value))
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {**self.stats, "ready": self.values is not None,
+                    "users": len(self.values['email']) if self.values is not None else 0}
+
+    def load(self):
+        """Read every user into a new index and swap it in"""
+        started = time.perf_counter()
+        with self.lock:
+            self.loading = []
+        try:
+            values = {field: set() for field in FIELDS}
+            after = 0
+            # a full scan, served by a replica if there is one
+            repository = self.storage.read_repository()
+            try:
+                unique_key = repository.unique_key
+                while True:
+                    rows = repository.user_names(after, self.page_size)
+                    for _, username, email in rows:
+                        values['username'].add(self._hash(username, unique_key))
+                        values['email'].add(self._hash(email, unique_key))
+                    if len(rows) < self.page_size:
+                        break
+                    after = rows[-1][0]
+            finally:
+                repository.close()
+
+            with self.lock:
+                for field, value in self.loading:
+                    values[field].add(self._hash(value, unique_key))
+                self.values = values
+                self.unique_key = unique_key
+                self.stats["loads"] += 1
+                self.stats["load_seconds"] = round(time.perf_counter() - started, 3)
+        finally:
+            with self.lock:
+                self.loading = None
+
+    def _refresh(self):
+        while True:
+            try:
+                self.load()
+            except StorageError as err:
+                # the last index stays in use, /register/check uses the database until the first load worked
+                print(f"Could not load the membership index: {err}")
+            time.sleep(self.refresh_interval if self.values is not None else 10)
+
+    def _hash(self, value, unique_key=None) -> int:
+        key = (unique_key or self.unique_key)(value)
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
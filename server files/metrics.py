@@ -0,0 +1,151 @@
+import bisect, os, re, threading, time
+from contextlib import contextmanager
+from functools import lru_cache
+
+# upper bounds in seconds, the same as the Prometheus client libraries use
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(name, labels, value) -> str:
+    if labels:
+        name += '{' + ','.join(f'{key}="{_escape(label)}"' for key, label in labels.items()) + '}'
+    return f"{name} {value}"
+
+
+class Counter:
+    """Value that only goes up, one per combination of label values"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, with their count and sum"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", {**labels, "le": bound}, cumulative))
+            samples.append((f"{self.name}_count", labels, cumulative))
+            samples.append((f"{self.name}_sum", labels, round(total, 6)))
+        return samples
+
+
+class Registry:
+    """Metrics of this process in the Prometheus text format.
+
+    Collectors are called on every scrape for values that other objects already keep,
+    like the pool or cache statistics. Every sample is labelled with the process ID,
+    each server process answers /metrics with its own numbers.
+    """
+
+    def __init__(self) -> None:
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        """Register a function returning [(name, type, help, [(labels, value)])], usable as decorator"""
+        self.collectors.append(function)
+        return function
+
+    def render(self) -> str:
+        process = {"pid": os.getpid()}
+        families = [(metric.name, metric.type, metric.help, metric.samples()) for metric in self.metrics]
+        for collector in self.collectors:
+            try:
+                families.extend((name, type, help, [(name, labels, value) for labels, value in values])
+                                for name, type, help, values in collector())
+            except Exception as e:
+                # one broken source must not take the other metrics down
+                print(f"Metrics collector {collector.__name__} failed: {e}")
+
+        lines = []
+        for name, type, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.extend(_format(sample, {**process, **labels}, value) for sample, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# instrumented by app.py for every route
+REQUESTS = registry.counter('api_requests_total', "Requests answered", ['route', 'method', 'status'])
+REQUEST_SECONDS = registry.histogram('api_request_duration_seconds', "Time spent answering requests", ['route'])
+THROTTLED = registry.counter('api_throttled_requests_total', "Requests answered with 429 by the rate limits and concurrency caps",
+                             ['route', 'reason'])
+# instrumented by storage.py for every statement
+DB_QUERY_SECONDS = registry.histogram('db_query_duration_seconds', "Time spent executing statements and fetching their rows",
+                                      ['statement', 'table'])
+DB_QUERY_ERRORS = registry.counter('db_query_errors_total', "Statements that failed", ['statement', 'table'])
+# instrumented by hashing.py, the time includes waiting for a free process
+BCRYPT_SECONDS = registry.histogram('bcrypt_duration_seconds', "Time spent hashing and checking passwords", ['operation'],
+                                    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+BCRYPT_REJECTED = registry.counter('bcrypt_rejected_total', "Password operations rejected because too many were waiting")
+
+@lru_cache(maxsize=512)
+def statement_labels(statement):
+    """Return (kind, table) of a SQL statement, e.g. ("select", "employee_data")"""
+    kind = statement.split(None, 1)[0].lower() if statement.strip() else ''
+    table = re.search(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", statement, re.IGNORECASE)
+    return kind, table.group(1) if table else ''
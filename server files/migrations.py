@@ -0,0 +1,304 @@
+import os, re, sys
+import mysql.connector
+from storage import MySQLRepository
+
+def ensure_index(cursor, table, name, columns, unique=False):
+    """Create an index unless the table already has one with this name (MySQL has no CREATE INDEX IF NOT EXISTS)"""
+    cursor.execute("""SELECT 1 FROM information_schema.statistics
+                      WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1""",
+                   (table, name))
+    if cursor.fetchone() is None:
+        cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({', '.join(columns)})")
+
+def drop_index(cursor, table, name):
+    """Drop an index if the table has one with this name"""
+    cursor.execute("""SELECT 1 FROM information_schema.statistics
+                      WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1""",
+                   (table, name))
+    if cursor.fetchone() is not None:
+        cursor.execute(f"DROP INDEX {name} ON {table}")
+
+def _create_tables(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS users (
+                          id INT AUTO_INCREMENT PRIMARY KEY,
+                          username VARCHAR(64) NOT NULL,
+                          email VARCHAR(255) NOT NULL,
+                          password VARCHAR(255) NOT NULL
+                      )""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS employee_data (
+                          user_id INT NOT NULL,
+                          employee_id VARCHAR(32) NOT NULL,
+                          employee_name VARCHAR(255) NOT NULL,
+                          working_time DECIMAL(3,2) NOT NULL,
+                          student_or_second_job TINYINT(1) NOT NULL DEFAULT 0,
+                          CONSTRAINT employee_data_user FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                      )""")
+
+def _index_access_paths(cursor):
+    # /login, /register/check and every user lookup filter users by email or username,
+    # the key names contain the column, /register reads them from duplicate entry errors
+    ensure_index(cursor, 'users', 'users_email', ['email'], unique=True)
+    ensure_index(cursor, 'users', 'users_username', ['username'], unique=True)
+    # roster reads filter by user_id and page by employee_id, writes address (user_id, employee_id)
+    ensure_index(cursor, 'employee_data', 'employee_data_user_employee', ['user_id', 'employee_id'], unique=True)
+
+def _create_schedule_jobs(cursor):
+    # state of the schedule generation jobs, shared by every server process
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schedule_jobs (
+                          id CHAR(32) PRIMARY KEY,
+                          user_id INT NOT NULL,
+                          status VARCHAR(16) NOT NULL,
+                          created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                          started_at TIMESTAMP NULL,
+                          finished_at TIMESTAMP NULL,
+                          result LONGTEXT NULL,
+                          error TEXT NULL,
+                          INDEX schedule_jobs_user (user_id),
+                          CONSTRAINT schedule_jobs_user FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                      )""")
+
+def _create_schedules(cursor):
+    # generated schedules, every day is stored on its own in the encoding of schedulecodec.py
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schedules (
+                          id INT AUTO_INCREMENT PRIMARY KEY,
+                          user_id INT NOT NULL,
+                          month CHAR(7) NOT NULL,
+                          created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                          employees TEXT NOT NULL,
+                          seed BIGINT NULL,
+                          score DOUBLE NULL,
+                          availability_hash CHAR(64) NULL,
+                          rpt_hash CHAR(64) NULL,
+                          job_id CHAR(32) NULL,
+                          INDEX schedules_user_month (user_id, month),
+                          INDEX schedules_job (job_id),
+                          CONSTRAINT schedules_user FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                      )""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schedule_days (
+                          schedule_id INT NOT NULL,
+                          day DATE NOT NULL,
+                          label CHAR(5) NOT NULL,
+                          slots VARBINARY(8192) NOT NULL,
+                          PRIMARY KEY (schedule_id, day),
+                          CONSTRAINT schedule_days_schedule FOREIGN KEY (schedule_id) REFERENCES schedules (id) ON DELETE CASCADE
+                      )""")
+
+def _create_idempotency_keys(cursor):
+    # results of write requests by their Idempotency-Key header, kept for a day by idempotency.py
+    cursor.execute("""CREATE TABLE IF NOT EXISTS idempotency_keys (
+                          scope VARCHAR(255) NOT NULL,
+                          idempotency_key VARCHAR(255) NOT NULL,
+                          fingerprint CHAR(64) NOT NULL,
+                          created_at DOUBLE NOT NULL,
+                          status_code SMALLINT NULL,
+                          mimetype VARCHAR(100) NULL,
+                          body MEDIUMBLOB NULL,
+                          PRIMARY KEY (scope, idempotency_key),
+                          INDEX idempotency_keys_created (created_at)
+                      )""")
+
+def _create_roster_changes(cursor):
+    # every roster write bumps the user's version and is logged under it, /data/changes serves the log.
+    # compacted_through is the last version removed from the log by compaction
+    cursor.execute("""CREATE TABLE IF NOT EXISTS roster_versions (
+                          user_id INT PRIMARY KEY,
+                          version BIGINT NOT NULL,
+                          compacted_through BIGINT NOT NULL DEFAULT 0,
+                          CONSTRAINT roster_versions_user FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                      )""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS roster_changes (
+                          user_id INT NOT NULL,
+                          version BIGINT NOT NULL,
+                          action VARCHAR(8) NOT NULL,
+                          employee_id VARCHAR(32) NOT NULL,
+                          old_employee_id VARCHAR(32) NULL,
+                          employee_name VARCHAR(255) NULL,
+                          working_time DECIMAL(3,2) NULL,
+                          student_or_second_job TINYINT(1) NULL,
+                          changed_at DOUBLE NOT NULL,
+                          PRIMARY KEY (user_id, version),
+                          INDEX roster_changes_changed (changed_at),
+                          CONSTRAINT roster_changes_user FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                      )""")
+
+def _pin_user_collation(cursor):
+    # the membership index of /register/check compares names the way this collation does, see
+    # MySQLRepository.unique_key. Pinned, so a server with another default collation keeps the same rules
+    cursor.execute("""ALTER TABLE users
+                      MODIFY username VARCHAR(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL,
+                      MODIFY email VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL""")
+
+def _drop_employee_user_index(cursor):
+    # the index MySQL made for the user_id foreign key, employee_data_user_employee (migration 2) starts
+    # with user_id and serves the key too. MySQL usually dropped it by itself when that index was created
+    drop_index(cursor, 'employee_data', 'employee_data_user')
+
+# (version, description, function) applied in order, never change a migration once it was released
+MIGRATIONS = [
+    (1, "create users and employee_data", _create_tables),
+    (2, "index the access paths of the API", _index_access_paths),
+    (3, "create schedule_jobs", _create_schedule_jobs),
+    (4, "create schedules and schedule_days", _create_schedules),
+    (5, "create idempotency_keys", _create_idempotency_keys),
+    (6, "create roster_versions and roster_changes", _create_roster_changes),
+    (7, "pin the collation of users.username and users.email", _pin_user_collation),
+    (8, "drop the redundant user_id index of employee_data", _drop_employee_user_index),
+]
+
+class _RecordedConnection:
+    """Connection of a StatementRecorder, nothing is sent anywhere"""
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StatementRecorder(MySQLRepository):
+    """Repository recording the statements its methods run instead of running them.
+
+    Every fetched value is the string '1', in rows as wide as the select list, so the methods
+    take the same path as with a hit and record the statements that follow it.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(_RecordedConnection(), None)
+        self.statements = []
+
+    def _run(self, statement, params=(), fetch=None, commit=False):
+        self.statements.append((self._sql(statement), params))
+        select = re.match(r"\s*SELECT\s+(.*?)\s+FROM\s", statement, re.DOTALL)
+        row = ('1',) * (len(select.group(1).split(',')) if select else 1)
+        if fetch == 'one':
+            return row
+        if fetch == 'all':
+            return [row]
+        return 1
+
+# every query method of the repositories with example arguments, full_scans checks the plans of
+# the statements they run. Methods left out fail test_query_plans.py
+STATEMENT_EXAMPLES = [
+    ('user_id', ('user@example.com',)),
+    ('credentials', ('user@example.com',)),
+    ('add_user', ('user', 'user@example.com', 'hash')),
+    ('set_password', (1, 'hash')),
+    ('user_exists', ('username', 'user')),
+    ('user_exists', ('email', 'user@example.com')),
+    ('user_names', (0, 5000)),
+    ('has_employees', (1,)),
+    ('employees', (1, ['employee_id', 'employee_name', 'working_time', 'student_or_second_job'])),
+    ('employees', (1, ['employee_id', 'employee_name', 'working_time', 'student_or_second_job'], 50, '0')),
+    ('add_employee', (1, '1', 'name', 1, 0)),
+    ('delete_employee', (1, '1')),
+    ('update_employee', (1, '1', '2', 'name', 1, 0)),
+    ('roster_version', (1,)),
+    ('roster_changes', (1, 0, 1000)),
+    ('compact_roster_changes', (0, 10000)),
+    ('create_job', ('0' * 32, 1)),
+    ('start_job', ('0' * 32,)),
+    ('finish_job', ('0' * 32, '{}')),
+    ('fail_job', ('0' * 32, 'error')),
+    ('job', ('0' * 32,)),
+    ('save_schedule', (1, '2024-01', [], [('2024-01-01', 'Mon', b'')])),
+    ('schedules', (1, '2024-01')),
+    ('schedule', (1,)),
+    ('schedule_days', (1, '2024-01-01', '2024-01-07')),
+    ('schedule_for_job', ('0' * 32,)),
+    ('add_idempotency_key', ('user:1', '0' * 32, 'fingerprint', 0)),
+    ('take_over_idempotency_key', ('user:1', '0' * 32, 'fingerprint', 0, 0)),
+    ('idempotency_key', ('user:1', '0' * 32)),
+    ('finish_idempotency_key', ('user:1', '0' * 32, 200, 'application/json', b'{}')),
+    ('delete_idempotency_key', ('user:1', '0' * 32)),
+    ('purge_idempotency_keys', (0,)),
+]
+
+def api_statements():
+    """Return (statement, params) of every statement the repositories run that reads rows, without duplicates.
+
+    INSERTs are left out, they read nothing and EXPLAIN reports them with type ALL.
+    """
+    recorder = StatementRecorder()
+    for method, args in STATEMENT_EXAMPLES:
+        getattr(recorder, method)(*args)
+    statements = {}
+    for statement, params in recorder.statements:
+        if not statement.lstrip().upper().startswith('INSERT'):
+            statements.setdefault(' '.join(statement.split()), params)
+    return list(statements.items())
+
+def migrate(connection, lock_timeout=60):
+    """Apply every migration newer than the schema version of the database, return the applied versions"""
+    cursor = connection.cursor()
+    try:
+        # several server processes may start at once, only one of them migrates
+        cursor.execute("SELECT GET_LOCK('schema_migrations', %s)", (lock_timeout,))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for another process to finish migrating")
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                              version INT PRIMARY KEY,
+                              description VARCHAR(255) NOT NULL,
+                              applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                          )""")
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        current = cursor.fetchone()[0]
+
+        applied = []
+        for version, description, function in MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"Applying migration {version}: {description}")
+            # MySQL commits DDL implicitly, so a migration must be safe to run again if it fails halfway
+            function(cursor)
+            cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+            connection.commit()
+            applied.append(version)
+        return applied
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('schema_migrations')")
+        cursor.fetchall()
+        cursor.close()
+
+def full_scans(connection):
+    """Return (statement, table) of the API statements whose EXPLAIN shows a full table scan"""
+    cursor = connection.cursor(dictionary=True)
+    offending = []
+    try:
+        for statement, params in api_statements():
+            cursor.execute("EXPLAIN " + statement, params)
+            for row in cursor.fetchall():
+                # type ALL means every row of the table is read
+                if row.get('type') == 'ALL':
+                    offending.append((statement, row.get('table')))
+        connection.rollback()
+    finally:
+        cursor.close()
+    return offending
+
+def connect():
+    return mysql.connector.connect(
+        host=os.environ.get('DB_HOST'),
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASSWORD'),
+        database=os.environ.get('DB_NAME')
+    )
+
+if __name__ == '__main__':
+    # "python migrations.py" migrates the database, "python migrations.py --explain" checks the query plans
+    connection = connect()
+    try:
+        if '--explain' in sys.argv:
+            offending = full_scans(connection)
+            for statement, table in offending:
+                print(f"Full scan of {table}: {statement}")
+            print("No full table scans." if not offending else f"{len(offending)} statements scan a whole table.")
+            sys.exit(1 if offending else 0)
+        else:
+            applied = migrate(connection)
+            print(f"Applied migrations {applied}." if applied else "Database schema is up to date.")
+    finally:
+        connection.close()
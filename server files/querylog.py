@@ -0,0 +1,118 @@
+import re, threading, time
+from functools import lru_cache
+from metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS, statement_labels
+
+@lru_cache(maxsize=512)
+def normalize_statement(statement) -> str:
+    """Reduce a statement to its shape: literals and placeholders become ?, lists of them one "?, ..." """
+    normalized = re.sub(r"'(?:[^'\\]|\\.)*'", "?", statement)
+    normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = normalized.replace('%s', '?')
+    normalized = re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", normalized)
+    return ' '.join(normalized.split())
+
+def parameter_shapes(params) -> str:
+    """Describe the parameters by type and length, their values may be passwords or personal data"""
+    shapes = []
+    for param in params or ():
+        if isinstance(param, (str, bytes)):
+            shapes.append(f"{type(param).__name__}[{len(param)}]")
+        else:
+            shapes.append(type(param).__name__)
+    return f"({', '.join(shapes)})"
+
+
+class QueryLog:
+    """Counts and timings of every normalised statement, statements slower than the threshold are logged.
+
+    At most `max_statements` different statements are tracked, further ones are counted as "(other)".
+    """
+
+    def __init__(self, slow_threshold=0.1, max_statements=500) -> None:
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def record(self, statement, params, execute_seconds, fetch_seconds, rows, error=None):
+        normalized = normalize_statement(statement)
+        seconds = execute_seconds + fetch_seconds
+        kind, table = statement_labels(statement)
+        DB_QUERY_SECONDS.observe(seconds, statement=kind, table=table)
+        if error is not None:
+            DB_QUERY_ERRORS.inc(statement=kind, table=table)
+
+        with self.lock:
+            if normalized not in self.statements and len(self.statements) >= self.max_statements:
+                normalized = '(other)'
+            stats = self.statements.setdefault(normalized, {"count": 0, "errors": 0, "slow": 0, "rows": 0,
+                                                            "execute_seconds": 0.0, "fetch_seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["errors"] += error is not None
+            stats["rows"] += rows or 0
+            stats["execute_seconds"] += execute_seconds
+            stats["fetch_seconds"] += fetch_seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            slow = seconds >= self.slow_threshold
+            stats["slow"] += slow
+
+        if slow:
+            print(f"Slow query {seconds * 1000:.1f} ms (execute {execute_seconds * 1000:.1f} ms, fetch {fetch_seconds * 1000:.1f} ms, "
+                  f"{rows or 0} rows{', ' + type(error).__name__ if error is not None else ''}): {normalized} params={parameter_shapes(params)}")
+
+    def top(self, limit=20, order='total') -> list:
+        """Return the statements with the most total time, highest maximum ("max") or most executions ("count")"""
+        keys = {"total": lambda item: item[1]["execute_seconds"] + item[1]["fetch_seconds"],
+                "max": lambda item: item[1]["max_seconds"],
+                "count": lambda item: item[1]["count"]}
+        with self.lock:
+            items = sorted(((statement, dict(stats)) for statement, stats in self.statements.items()), key=keys[order], reverse=True)
+        return [{"statement": statement, **{name: round(value, 6) for name, value in stats.items()},
+                 "mean_ms": round((stats["execute_seconds"] + stats["fetch_seconds"]) / stats["count"] * 1000, 3)}
+                for statement, stats in items[:limit]]
+
+
+class InstrumentedCursor:
+    """Cursor wrapper timing execute() and the fetches of each statement, reported to a QueryLog on the next execute or close"""
+
+    def __init__(self, cursor, log) -> None:
+        self.cursor = cursor
+        self.log = log
+        self.pending = None
+
+    def __getattr__(self, name):
+        # rowcount, lastrowid and the rest come from the wrapped cursor
+        return getattr(self.cursor, name)
+
+    def execute(self, statement, params=()):
+        self._report()
+        started = time.perf_counter()
+        try:
+            self.cursor.execute(statement, params)
+        except Exception as e:
+            self.log.record(statement, params, time.perf_counter() - started, 0.0, 0, e)
+            raise
+        self.pending = [statement, params, time.perf_counter() - started, 0.0, 0]
+
+    def fetchone(self):
+        return self._fetch(self.cursor.fetchone, lambda row: row is not None)
+
+    def fetchall(self):
+        return self._fetch(self.cursor.fetchall, len)
+
+    def close(self):
+        self._report()
+        self.cursor.close()
+
+    def _fetch(self, function, count):
+        started = time.perf_counter()
+        result = function()
+        if self.pending is not None:
+            self.pending[3] += time.perf_counter() - started
+            self.pending[4] += count(result)
+        return result
+
+    def _report(self):
+        if self.pending is not None:
+            self.log.record(*self.pending)
+            self.pending = None
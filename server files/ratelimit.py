@@ -0,0 +1,142 @@
+import threading, time
+
+try:
+    import redis
+except ImportError:
+    # redis is only needed when the limits are shared through REDIS_URL
+    redis = None
+
+class RateLimit:
+    """Token bucket rule, `rate` requests per second on average with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+
+
+class RateLimiter:
+    """Token buckets per client and route, kept in this process.
+
+    Every server process has its own buckets, so a client spread over several processes
+    gets up to that many times its limit. Buckets that refilled are forgotten, they
+    behave like new ones.
+    """
+
+    def __init__(self, limits, max_buckets=100000) -> None:
+        # route -> RateLimit, routes without one are not limited
+        self.limits = limits
+        self.max_buckets = max_buckets
+        # (client, route) -> (tokens, time they were counted)
+        self.buckets = {}
+        self.pruned = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, client, route) -> float:
+        """Take a token for one request, return 0 if it may run, otherwise the seconds until it may"""
+        limit = self.limits.get(route)
+        if limit is None:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, counted = self.buckets.get((client, route), (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - counted) * limit.rate)
+            if tokens >= 1:
+                self.buckets[(client, route)] = (tokens - 1, now)
+                if len(self.buckets) > self.max_buckets and now - self.pruned > 1:
+                    self._prune(now)
+                return 0
+            self.buckets[(client, route)] = (tokens, now)
+            return (1 - tokens) / limit.rate
+
+    def _prune(self, now):
+        self.pruned = now
+        self.buckets = {key: (tokens, counted) for key, (tokens, counted) in self.buckets.items()
+                        if tokens + (now - counted) * self.limits[key[1]].rate < self.limits[key[1]].burst}
+
+
+class RedisRateLimiter:
+    """Token buckets shared by every server process through Redis, a client gets its limit once.
+
+    Redis errors let the request through, an unreachable Redis must not take the API down with it.
+    """
+
+    # refills and takes a token atomically on the Redis clock, returns the wait as a string
+    # because Lua numbers are turned into integers on the way back
+    SCRIPT = """
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'counted')
+        local tokens = tonumber(bucket[1]) or burst
+        local counted = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - counted) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'counted', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+        return tostring(wait)
+    """
+
+    def __init__(self, url, limits) -> None:
+        self.limits = limits
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def acquire(self, client, route) -> float:
+        limit = self.limits.get(route)
+        if limit is None:
+            return 0
+        try:
+            return float(self.script(keys=[f"ratelimit:{client}:{route}"], args=[limit.rate, limit.burst]))
+        except redis.RedisError as e:
+            print(f"Rate limit not checked: {e}")
+            return 0
+
+
+def create_rate_limiter(redis_url=None, limits=None):
+    """Return a RateLimiter, shared through Redis if a URL is given"""
+    if redis_url:
+        if redis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        return RedisRateLimiter(redis_url, limits or {})
+    return RateLimiter(limits or {})
+
+
+class ConcurrencyLimiter:
+    """Caps the requests running at once in this process, in total and per client.
+
+    Requests over a cap are turned away at once instead of queueing for a thread or a
+    database connection, so one busy client cannot hold every thread of the process.
+    """
+
+    def __init__(self, max_active, max_per_client) -> None:
+        self.max_active = max_active
+        self.max_per_client = max_per_client
+        self.active = 0
+        self.clients = {}
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, client):
+        """Admit a request, return None if it may run, otherwise the cap it hit"""
+        with self.lock:
+            if self.active >= self.max_active:
+                return 'concurrency'
+            if self.clients.get(client, 0) >= self.max_per_client:
+                return 'client_concurrency'
+            self.active += 1
+            self.clients[client] = self.clients.get(client, 0) + 1
+            self.peak = max(self.peak, self.active)
+            return None
+
+    def release(self, client):
+        with self.lock:
+            self.active -= 1
+            if self.clients[client] <= 1:
+                del self.clients[client]
+            else:
+                self.clients[client] -= 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {"active": self.active, "peak": self.peak, "max_active": self.max_active}
@@ -0,0 +1,175 @@
+import threading, time
+from storage import Storage, StorageError
+
+try:
+    import redis
+except ImportError:
+    # redis is only needed when the write times are shared through REDIS_URL
+    redis = None
+
+class WriteTracker:
+    """Time of the last write of every session made through this process.
+
+    Entries older than `window` seconds are forgotten, by then every usable replica has the write.
+    """
+
+    def __init__(self, window=10) -> None:
+        self.window = window
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def record(self, session):
+        now = time.time()
+        with self.lock:
+            self.writes[session] = now
+            if len(self.writes) > 10000:
+                self.writes = {key: written for key, written in self.writes.items() if now - written < self.window}
+
+    def last_write(self, session):
+        """Return the wall clock time of the session's last write, None if it is older than the window"""
+        with self.lock:
+            written = self.writes.get(session)
+        return written if written is not None and time.time() - written < self.window else None
+
+
+class RedisWriteTracker:
+    """WriteTracker shared by every process through Redis, a write through one process is seen by all"""
+
+    def __init__(self, url, window=10) -> None:
+        self.window = window
+        self.redis = redis.Redis.from_url(url)
+
+    def record(self, session):
+        try:
+            self.redis.set(f"lastwrite:{session}", time.time(), px=int(self.window * 1000))
+        except redis.RedisError as e:
+            print(f"Could not record write of session {session}: {e}")
+
+    def last_write(self, session):
+        try:
+            written = self.redis.get(f"lastwrite:{session}")
+        except redis.RedisError as e:
+            # without the time of the last write only the primary is safe
+            print(f"Could not read last write of session {session}: {e}")
+            return time.time()
+        return float(written) if written is not None else None
+
+
+def create_write_tracker(redis_url=None, window=10):
+    """Return a WriteTracker, shared through Redis if a URL is given"""
+    if redis_url:
+        if redis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        return RedisWriteTracker(redis_url, window)
+    return WriteTracker(window)
+
+
+class ReplicatedStorage(Storage):
+    """Writes and consistent reads go to the primary, other reads to replicas.
+
+    Checker threads ask every replica how far it is behind every `check_interval` seconds.
+    read_repository() only picks a replica that is at most `max_lag` behind and has applied
+    the last write of the session, so a user always reads their own writes. Replicas that
+    fail are skipped until they pass a check again, without any usable replica reads go to
+    the primary.
+    """
+
+    def __init__(self, primary, replicas, max_lag=5, check_interval=1, redis_url=None) -> None:
+        super().__init__(primary.query_log)
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # after this long any usable replica has a write, see _usable()
+        self.writes = create_write_tracker(redis_url, max_lag + 1 + 3 * check_interval)
+        # per replica: (time of the last check, lag then, time up to which it has applied the primary's commits)
+        self.states = [(None, None, None)] * len(replicas)
+        self.next_replica = 0
+        self.stats = {"primary_reads": 0, "replica_reads": 0, "replica_errors": 0}
+        self.lock = threading.Lock()
+        self.checkers = []
+
+    def start(self):
+        # one checker per replica, a replica that hangs does not delay the checks of the others
+        if not self.checkers:
+            for index in range(len(self.replicas)):
+                checker = threading.Thread(target=self._check_replica, args=(index,), name=f'replica-lag-{index}', daemon=True)
+                checker.start()
+                self.checkers.append(checker)
+
+    def repository(self):
+        return self.primary.repository()
+
+    def read_repository(self, session=None):
+        written = self.writes.last_write(session) if session is not None else None
+        now = time.time()
+        with self.lock:
+            # round robin over the usable replicas
+            order = [(self.next_replica + offset) % len(self.replicas) for offset in range(len(self.replicas))]
+            self.next_replica = (self.next_replica + 1) % max(1, len(self.replicas))
+            candidates = [index for index in order if self._usable(self.states[index], now, written)]
+
+        for index in candidates:
+            try:
+                repository = self.replicas[index].repository()
+            except StorageError as err:
+                print(f"Replica {index} unavailable, skipping it until its next check: {err}")
+                self._set_state(index, (time.time(), None, None))
+                self._count("replica_errors")
+                continue
+            self._count("replica_reads")
+            return repository
+
+        self._count("primary_reads")
+        return self.primary.repository()
+
+    def wrote(self, session):
+        self.writes.record(session)
+
+    def metrics(self):
+        with self.lock:
+            replicas = [{"lag": state[1], "usable": self._usable(state, time.time(), None)} for state in self.states]
+            stats = dict(self.stats)
+        return {**self.primary.metrics(), "replication": {**stats, "replicas": replicas}}
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+        self.primary.close()
+
+    def _usable(self, state, now, written):
+        checked, lag, applied_until = state
+        if applied_until is None or now - checked > 3 * self.check_interval:
+            # never checked, failing, too far behind or the checker is stuck
+            return False
+        return written is None or applied_until > written
+
+    def _check_replica(self, index):
+        # reads go to the primary until the first check of the replica passed
+        while True:
+            self._check(index)
+            time.sleep(self.check_interval)
+
+    def _check(self, index):
+        checked = time.time()
+        try:
+            with self.replicas[index].session() as repository:
+                lag = repository.replication_lag()
+        except StorageError as err:
+            print(f"Replica {index} failed its lag check: {err}")
+            self._count("replica_errors")
+            lag = None
+
+        if lag is None or lag > self.max_lag:
+            self._set_state(index, (checked, lag, None))
+        else:
+            # the lag is counted in whole seconds, one more keeps read-your-writes on the safe side
+            self._set_state(index, (checked, lag, checked - lag - 1))
+
+    def _set_state(self, index, state):
+        with self.lock:
+            self.states[index] = state
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
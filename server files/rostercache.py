@@ -0,0 +1,161 @@
+import json, threading, time
+from collections import OrderedDict
+from decimal import Decimal
+
+try:
+    import redis
+except ImportError:
+    # redis is only needed when the cache is shared through REDIS_URL
+    redis = None
+
+def plain_rows(rows):
+    """Return database rows as lists of JSON types, Decimals become strings the way jsonify writes them"""
+    return [[str(value) if isinstance(value, Decimal) else value for value in row] for row in rows]
+
+
+class RosterCache:
+    """In-process LRU cache of roster query results, bounded by the approximate size of the entries.
+
+    Entries are grouped by user, a write to a roster drops every cached result of its user.
+    A result is only stored if no write happened since its query started, see generation().
+    """
+
+    def __init__(self, max_bytes=64*1024*1024, ttl=60) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # user_id -> {key: (value, size, expires)}, least recently used user first
+        self.users = OrderedDict()
+        self.generations = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def generation(self, user_id):
+        """Return a token to read before querying the database and pass to set()"""
+        with self.lock:
+            return self.generations.get(user_id, 0)
+
+    def get(self, user_id, key):
+        """Return the cached result or None if it is missing or expired"""
+        with self.lock:
+            entries = self.users.get(user_id)
+            entry = entries.get(key) if entries is not None else None
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._drop(user_id, key)
+                self.stats["misses"] += 1
+                return None
+            self.users.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def set(self, user_id, key, value, generation):
+        size = len(json.dumps(value))
+        with self.lock:
+            # the roster changed while the result was read, it may already be outdated
+            if self.generations.get(user_id, 0) != generation or size > self.max_bytes:
+                return
+            if key in self.users.get(user_id, {}):
+                self._drop(user_id, key)
+            self.users.setdefault(user_id, {})[key] = (value, size, time.monotonic() + self.ttl)
+            self.users.move_to_end(user_id)
+            self.size += size
+
+            # drop the rosters of the least recently used users above the limit
+            while self.size > self.max_bytes:
+                _, entries = self.users.popitem(last=False)
+                self.size -= sum(entry[1] for entry in entries.values())
+                self.stats["evictions"] += len(entries)
+
+    def invalidate(self, user_id):
+        """Forget every cached result of the user, called after each write to the roster"""
+        with self.lock:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            entries = self.users.pop(user_id, None)
+            if entries is not None:
+                self.size -= sum(entry[1] for entry in entries.values())
+            self.stats["invalidations"] += 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {**self.stats, "users": len(self.users), "bytes": self.size, "max_bytes": self.max_bytes}
+
+    def _drop(self, user_id, key):
+        entries = self.users[user_id]
+        self.size -= entries.pop(key)[1]
+        if not entries:
+            del self.users[user_id]
+
+
+class RedisRosterCache:
+    """Roster cache shared by every server process through Redis.
+
+    Each user has a generation counter, results are stored under the current generation
+    and a write increments it, so no process reads results older than the last write.
+    Memory is bounded by Redis itself, run it with a maxmemory policy such as allkeys-lru.
+    Redis errors are treated as cache misses.
+    """
+
+    def __init__(self, url, ttl=60) -> None:
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "errors": 0}
+
+    def generation(self, user_id):
+        try:
+            return int(self.client.get(f"roster:{user_id}:generation") or 0)
+        except redis.RedisError as e:
+            self._error(e)
+            return None
+
+    def get(self, user_id, key):
+        generation = self.generation(user_id)
+        value = None
+        if generation is not None:
+            try:
+                value = self.client.hget(f"roster:{user_id}:{generation}", key)
+            except redis.RedisError as e:
+                self._error(e)
+        self._count("hits" if value is not None else "misses")
+        return json.loads(value) if value is not None else None
+
+    def set(self, user_id, key, value, generation):
+        if generation is None:
+            return
+        try:
+            pipeline = self.client.pipeline()
+            pipeline.hset(f"roster:{user_id}:{generation}", key, json.dumps(value))
+            pipeline.expire(f"roster:{user_id}:{generation}", self.ttl)
+            pipeline.execute()
+        except redis.RedisError as e:
+            self._error(e)
+
+    def invalidate(self, user_id):
+        try:
+            # results of older generations are never read again and expire on their own
+            self.client.incr(f"roster:{user_id}:generation")
+        except redis.RedisError as e:
+            self._error(e)
+        self._count("invalidations")
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+    def _error(self, error):
+        print(f"Roster cache error: {error}")
+        self._count("errors")
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+def create_roster_cache(redis_url=None, max_bytes=64*1024*1024, ttl=60):
+    """Return a cache shared through Redis if a URL is given, otherwise one local to this process"""
+    if redis_url:
+        if redis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        return RedisRosterCache(redis_url, ttl)
+    return RosterCache(max_bytes, ttl)
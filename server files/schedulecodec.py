@@ -0,0 +1,67 @@
+import datetime, struct, zlib
+
+# Every day of a schedule is stored on its own, so a range or one employee only needs the rows of
+# the days asked for. A day is zlib compressed:
+#   number of slots (uint16), start of every slot in minutes after midnight (uint16 each),
+#   then per slot one bit per employee of the schedule, set if the employee works that slot.
+# Employees are numbered by their position in the employee list saved with the schedule.
+
+def _minutes(hour) -> int:
+    hours, minutes = str(hour).split(':')
+    return int(hours) * 60 + int(minutes)
+
+def _label(minutes) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def encode_day(hours, employees) -> bytes:
+    """Pack {"HH:MM": [employee IDs]} of one day, `employees` lists every employee of the schedule"""
+    index = {employee: number for number, employee in enumerate(employees)}
+    row_size = (len(employees) + 7) // 8
+    slots = sorted(hours, key=_minutes)
+
+    body = bytearray(struct.pack(f">H{len(slots)}H", len(slots), *map(_minutes, slots)))
+    for slot in slots:
+        row = bytearray(row_size)
+        for employee in hours[slot]:
+            number = index[str(employee)]
+            row[number // 8] |= 1 << (number % 8)
+        body += row
+    return zlib.compress(bytes(body), 9)
+
+def _unpack(blob, employee_count):
+    body = zlib.decompress(blob)
+    (slot_count,) = struct.unpack_from(">H", body)
+    slots = struct.unpack_from(f">{slot_count}H", body, 2)
+    return slots, body, 2 + 2 * slot_count, (employee_count + 7) // 8
+
+def decode_day(blob, employees) -> dict:
+    """Unpack a day into {"HH:MM": [employee IDs]}"""
+    slots, body, offset, row_size = _unpack(blob, len(employees))
+    day = {}
+    for position, slot in enumerate(slots):
+        row = body[offset + position * row_size:offset + (position + 1) * row_size]
+        day[_label(slot)] = [employee for number, employee in enumerate(employees) if row[number // 8] >> (number % 8) & 1]
+    return day
+
+def employee_slots(blob, employees, employee) -> list:
+    """Return the "HH:MM" slots one employee works on the day, without building the whole day"""
+    if employee not in employees:
+        return []
+    number = employees.index(employee)
+    slots, body, offset, row_size = _unpack(blob, len(employees))
+    return [_label(slot) for position, slot in enumerate(slots)
+            if body[offset + position * row_size + number // 8] >> (number % 8) & 1]
+
+def day_date(label, month) -> datetime.date:
+    """Date of a "dd-mm" day label of a schedule for "YYYY-MM", days in January of a December schedule are next year"""
+    day, day_month = map(int, label.split('-'))
+    year, schedule_month = map(int, month.split('-'))
+    if day_month < schedule_month:
+        year += 1
+    return datetime.date(year, day_month, day)
+
+def encode_schedule(schedule, month):
+    """Pack a whole {"dd-mm": {"HH:MM": [employee IDs]}} schedule, return (employees, [("YYYY-MM-DD", label, blob)])"""
+    employees = sorted({str(employee) for hours in schedule.values() for slot in hours.values() for employee in slot})
+    days = [(day_date(label, month).isoformat(), label, encode_day(hours, employees)) for label, hours in schedule.items()]
+    return employees, days
@@ -0,0 +1,544 @@
+import json, sqlite3, threading, time, unicodedata
+from contextlib import contextmanager
+import mysql.connector
+from dbpool import PoolTimeoutError
+from querylog import QueryLog, InstrumentedCursor
+
+class StorageError(Exception):
+    """Raised when the database cannot be reached or a statement fails"""
+
+
+class DuplicateError(StorageError):
+    """Raised when a row with the same unique key already exists, the message names the key"""
+
+
+class Repository:
+    """Queries of the API on one database connection, close() releases the connection.
+
+    Statements are written once with %s placeholders, backends translate them if their
+    driver uses another style. Every write is committed right away.
+    """
+
+    # base class of the errors raised by the driver
+    driver_errors = ()
+
+    def __init__(self, connection, query_log) -> None:
+        self.connection = connection
+        self.query_log = query_log
+
+    def close(self):
+        self.connection.close()
+
+    def ping(self):
+        self._run("SELECT 1", fetch='one')
+
+    def replication_lag(self):
+        """Seconds this database is behind the primary it replicates, None if it does not replicate"""
+        return None
+
+    # users
+
+    def user_id(self, email):
+        """Return the ID of the user with the given email or None"""
+        row = self._run("SELECT id FROM users WHERE email = %s", (email,), fetch='one')
+        return row[0] if row is not None else None
+
+    def credentials(self, email):
+        """Return (user ID, password hash) of the user with the given email or None"""
+        return self._run("SELECT id, password FROM users WHERE email = %s", (email,), fetch='one')
+
+    def add_user(self, username, email, password_hash):
+        """Store a new user, raises DuplicateError if the username or email is taken"""
+        self._run("INSERT INTO users (username, email, password) VALUES (%s, %s, %s)",
+                  (username, email, password_hash), commit=True)
+
+    def set_password(self, user_id, password_hash):
+        self._run("UPDATE users SET password = %s WHERE id = %s", (password_hash, user_id), commit=True)
+
+    def user_exists(self, field, value) -> bool:
+        """Check if a user with this username or email exists"""
+        if field not in ('username', 'email'):
+            raise ValueError(f"Cannot look users up by {field}")
+        return bool(self._run(f"SELECT EXISTS(SELECT 1 FROM users WHERE {field} = %s LIMIT 1)", (value,), fetch='one')[0])
+
+    def user_names(self, after=0, limit=5000) -> list:
+        """Return (id, username, email) of the users with an ID above `after`, ordered by ID"""
+        return self._run("SELECT id, username, email FROM users WHERE id > %s ORDER BY id LIMIT %s", (after, limit), fetch='all')
+
+    @staticmethod
+    def unique_key(value) -> str:
+        """Form of a username or email the unique keys of the users table compare"""
+        return value
+
+    # employees
+
+    def has_employees(self, user_id) -> bool:
+        return bool(self._run("SELECT EXISTS(SELECT 1 FROM employee_data WHERE user_id = %s LIMIT 1)", (user_id,), fetch='one')[0])
+
+    def employees(self, user_id, columns, limit=None, after=None) -> list:
+        """Return the given columns of the user's employees, a limit returns one page ordered by employee ID
+
+        `columns` must be validated by the caller, they are part of the statement.
+        """
+        query = f"SELECT {', '.join(columns)} FROM employee_data WHERE user_id = %s"
+        params = [user_id]
+        if limit is not None:
+            if after is not None:
+                query += " AND employee_id > %s"
+                params.append(after)
+            query += " ORDER BY employee_id LIMIT %s"
+            params.append(limit)
+        return self._run(query, tuple(params), fetch='all')
+
+    # roster writes return the new roster version, or None if they changed nothing
+
+    def add_employee(self, user_id, employee_id, employee_name, working_time, student_or_second_job):
+        return self._change_roster(
+            user_id, "INSERT INTO employee_data (user_id, employee_id, employee_name, working_time, student_or_second_job) VALUES (%s, %s, %s, %s, %s)",
+            (user_id, employee_id, employee_name, working_time, student_or_second_job),
+            ('add', employee_id, None, employee_name, working_time, student_or_second_job))
+
+    def delete_employee(self, user_id, employee_id):
+        return self._change_roster(
+            user_id, "DELETE FROM employee_data WHERE user_id = %s AND employee_id = %s", (user_id, employee_id),
+            ('delete', employee_id, None, None, None, None))
+
+    def update_employee(self, user_id, old_employee_id, employee_id, employee_name, working_time, student_or_second_job):
+        return self._change_roster(
+            user_id, "UPDATE employee_data SET employee_id = %s, employee_name = %s, working_time = %s, student_or_second_job = %s WHERE user_id = %s AND employee_id = %s",
+            (employee_id, employee_name, working_time, student_or_second_job, user_id, old_employee_id),
+            ('update', employee_id, old_employee_id, employee_name, working_time, student_or_second_job))
+
+    # roster change log
+
+    def roster_version(self, user_id):
+        """Return (version, compacted_through) of the user's roster, changes up to compacted_through are gone from the log"""
+        row = self._run("SELECT version, compacted_through FROM roster_versions WHERE user_id = %s", (user_id,), fetch='one')
+        return tuple(row) if row is not None else (0, 0)
+
+    def roster_changes(self, user_id, since, limit) -> list:
+        """Return up to `limit` logged changes after version `since` as
+        (version, action, employee_id, old_employee_id, employee_name, working_time, student_or_second_job), oldest first"""
+        return self._run("""SELECT version, action, employee_id, old_employee_id, employee_name, working_time, student_or_second_job
+                            FROM roster_changes WHERE user_id = %s AND version > %s ORDER BY version LIMIT %s""",
+                         (user_id, since, limit), fetch='all')
+
+    def compact_roster_changes(self, changed_before, max_changes) -> int:
+        """Drop changes older than `changed_before` and all but the newest `max_changes` of every user, return how many"""
+        cuts = self._run("SELECT user_id, MAX(version) FROM roster_changes WHERE changed_at < %s GROUP BY user_id",
+                         (changed_before,), fetch='all')
+        for (user_id,) in self._run("SELECT user_id FROM roster_changes GROUP BY user_id HAVING COUNT(*) > %s",
+                                    (max_changes,), fetch='all'):
+            row = self._run("SELECT version FROM roster_changes WHERE user_id = %s ORDER BY version DESC LIMIT 1 OFFSET %s",
+                            (user_id, max_changes), fetch='one')
+            cuts.append((user_id, row[0]))
+
+        deleted = 0
+        for user_id, version in cuts:
+            try:
+                # clients that synced before the cut have to fetch the whole roster again
+                self._run("UPDATE roster_versions SET compacted_through = %s WHERE user_id = %s AND compacted_through < %s",
+                          (version, user_id, version))
+                deleted += self._run("DELETE FROM roster_changes WHERE user_id = %s AND version <= %s", (user_id, version))
+                self.connection.commit()
+            except StorageError:
+                self.connection.rollback()
+                raise
+        return deleted
+
+    def _change_roster(self, user_id, statement, params, change):
+        """Apply a roster write and append it to the change log under the next version, in one transaction"""
+        try:
+            if self._run(statement, params) == 0:
+                self.connection.rollback()
+                return None
+            # the row lock of roster_versions orders the writes of one user, versions commit in sequence
+            if self._run("UPDATE roster_versions SET version = version + 1 WHERE user_id = %s", (user_id,)) == 0:
+                try:
+                    self._run("INSERT INTO roster_versions (user_id, version, compacted_through) VALUES (%s, 1, 0)", (user_id,))
+                except DuplicateError:
+                    # the first write of another request created the row meanwhile
+                    self._run("UPDATE roster_versions SET version = version + 1 WHERE user_id = %s", (user_id,))
+            version = self._run("SELECT version FROM roster_versions WHERE user_id = %s", (user_id,), fetch='one')[0]
+            self._run("""INSERT INTO roster_changes (user_id, version, action, employee_id, old_employee_id,
+                                                     employee_name, working_time, student_or_second_job, changed_at)
+                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""", (user_id, version, *change, time.time()))
+            self.connection.commit()
+        except StorageError:
+            self.connection.rollback()
+            raise
+        return version
+
+    # schedule jobs
+
+    def create_job(self, job_id, user_id):
+        self._run("INSERT INTO schedule_jobs (id, user_id, status) VALUES (%s, %s, 'queued')", (job_id, user_id), commit=True)
+
+    def start_job(self, job_id):
+        self._run("UPDATE schedule_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,), commit=True)
+
+    def finish_job(self, job_id, result):
+        self._run("UPDATE schedule_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, result = %s WHERE id = %s",
+                  (result, job_id), commit=True)
+
+    def fail_job(self, job_id, error):
+        self._run("UPDATE schedule_jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP, error = %s WHERE id = %s",
+                  (error, job_id), commit=True)
+
+    def job(self, job_id):
+        """Return (user ID, status, result, error) of the job or None"""
+        return self._run("SELECT user_id, status, result, error FROM schedule_jobs WHERE id = %s", (job_id,), fetch='one')
+
+    # schedules
+
+    def save_schedule(self, user_id, month, employees, days, seed=None, score=None,
+                      availability_hash=None, rpt_hash=None, job_id=None) -> int:
+        """Store a schedule with its encoded days [(date, label, blob)] in one transaction, return its ID"""
+        try:
+            schedule_id = self._run("""INSERT INTO schedules (user_id, month, employees, seed, score, availability_hash, rpt_hash, job_id)
+                                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                                    (user_id, month, json.dumps(employees), seed, score, availability_hash, rpt_hash, job_id),
+                                    fetch='lastrowid')
+            for day, label, blob in days:
+                self._run("INSERT INTO schedule_days (schedule_id, day, label, slots) VALUES (%s, %s, %s, %s)",
+                          (schedule_id, day, label, blob))
+            self.connection.commit()
+        except StorageError:
+            self.connection.rollback()
+            raise
+        return schedule_id
+
+    def schedules(self, user_id, month) -> list:
+        """Return the metadata of the user's schedules for a "YYYY-MM" month, newest first"""
+        return self._run("""SELECT id, month, created_at, seed, score, availability_hash, rpt_hash, job_id FROM schedules
+                            WHERE user_id = %s AND month = %s ORDER BY id DESC""", (user_id, month), fetch='all')
+
+    def schedule(self, schedule_id):
+        """Return the metadata of schedules() followed by the user ID and the employee list, or None"""
+        row = self._run("""SELECT id, month, created_at, seed, score, availability_hash, rpt_hash, job_id, user_id, employees
+                           FROM schedules WHERE id = %s""", (schedule_id,), fetch='one')
+        return (*row[:-1], json.loads(row[-1])) if row is not None else None
+
+    def schedule_days(self, schedule_id, start=None, end=None) -> list:
+        """Return [(date, label, blob)] of the schedule's days, optionally only those from start to end"""
+        query = "SELECT day, label, slots FROM schedule_days WHERE schedule_id = %s"
+        params = [schedule_id]
+        if start is not None:
+            query += " AND day >= %s"
+            params.append(start)
+        if end is not None:
+            query += " AND day <= %s"
+            params.append(end)
+        return self._run(query + " ORDER BY day", tuple(params), fetch='all')
+
+    def schedule_for_job(self, job_id):
+        """Return the ID of the schedule made by a job or None"""
+        row = self._run("SELECT id FROM schedules WHERE job_id = %s", (job_id,), fetch='one')
+        return row[0] if row is not None else None
+
+    # idempotency keys
+
+    def add_idempotency_key(self, scope, key, fingerprint, created_at):
+        """Claim a key for a request that is about to run, raises DuplicateError if it was used before"""
+        self._run("INSERT INTO idempotency_keys (scope, idempotency_key, fingerprint, created_at) VALUES (%s, %s, %s, %s)",
+                  (scope, key, fingerprint, created_at), commit=True)
+
+    def take_over_idempotency_key(self, scope, key, fingerprint, created_at, started_before) -> bool:
+        """Claim a key whose request started before `started_before` and never finished, e.g. because its process died"""
+        return self._run("""UPDATE idempotency_keys SET created_at = %s
+                            WHERE scope = %s AND idempotency_key = %s AND fingerprint = %s
+                            AND status_code IS NULL AND created_at < %s""",
+                         (created_at, scope, key, fingerprint, started_before), commit=True) == 1
+
+    def idempotency_key(self, scope, key):
+        """Return (fingerprint, status_code, mimetype, body) of the request that used the key or None"""
+        return self._run("""SELECT fingerprint, status_code, mimetype, body FROM idempotency_keys
+                            WHERE scope = %s AND idempotency_key = %s""", (scope, key), fetch='one')
+
+    def finish_idempotency_key(self, scope, key, status_code, mimetype, body):
+        self._run("""UPDATE idempotency_keys SET status_code = %s, mimetype = %s, body = %s
+                     WHERE scope = %s AND idempotency_key = %s""", (status_code, mimetype, body, scope, key), commit=True)
+
+    def delete_idempotency_key(self, scope, key):
+        self._run("DELETE FROM idempotency_keys WHERE scope = %s AND idempotency_key = %s", (scope, key), commit=True)
+
+    def purge_idempotency_keys(self, created_before) -> int:
+        """Delete the keys created before the given time, return how many were deleted"""
+        return self._run("DELETE FROM idempotency_keys WHERE created_at < %s", (created_before,), commit=True)
+
+    def _sql(self, statement):
+        return statement
+
+    def _translate(self, error) -> StorageError:
+        return StorageError(str(error))
+
+    def _run(self, statement, params=(), fetch=None, commit=False):
+        """Execute one statement, return the fetched row(s), the new row's ID or the number of affected rows"""
+        # timed per statement, slow statements are logged by the query log
+        cursor = InstrumentedCursor(self.connection.cursor(), self.query_log)
+        try:
+            cursor.execute(self._sql(statement), params)
+            if fetch == 'one':
+                result = cursor.fetchone()
+            elif fetch == 'all':
+                result = cursor.fetchall()
+            elif fetch == 'lastrowid':
+                result = cursor.lastrowid
+            else:
+                result = cursor.rowcount
+            if commit:
+                self.connection.commit()
+            return result
+        except self.driver_errors as err:
+            if commit:
+                self.connection.rollback()
+            raise self._translate(err) from err
+        finally:
+            cursor.close()
+
+
+class MySQLRepository(Repository):
+    driver_errors = mysql.connector.Error
+
+    @staticmethod
+    def unique_key(value):
+        # username and email are utf8mb4_0900_ai_ci (migration 7), which ignores accents and case
+        # but not trailing spaces (NO PAD)
+        decomposed = unicodedata.normalize('NFKD', value)
+        return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+    def purge_idempotency_keys(self, created_before):
+        # in batches, one large DELETE would hold its locks for long
+        deleted = 0
+        while True:
+            batch = self._run("DELETE FROM idempotency_keys WHERE created_at < %s LIMIT 5000", (created_before,), commit=True)
+            deleted += batch
+            if batch < 5000:
+                return deleted
+
+    def _translate(self, error):
+        if error.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
+            # the message names the violated key, e.g. "for key 'users.users_email'"
+            return DuplicateError(error.msg)
+        return StorageError(str(error))
+
+    def replication_lag(self):
+        # one row per replication channel, the slowest channel counts
+        cursor = InstrumentedCursor(self.connection.cursor(dictionary=True), self.query_log)
+        try:
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+            except mysql.connector.Error:
+                # MySQL before 8.0.22 only knows the old name
+                cursor.execute("SHOW SLAVE STATUS")
+            channels = cursor.fetchall()
+        except mysql.connector.Error as err:
+            raise StorageError(str(err)) from err
+        finally:
+            cursor.close()
+
+        # the lag is NULL while the replication threads are stopped
+        lags = [channel.get('Seconds_Behind_Source', channel.get('Seconds_Behind_Master')) for channel in channels]
+        if not lags or None in lags:
+            return None
+        return float(max(lags))
+
+
+class SQLiteRepository(Repository):
+    driver_errors = sqlite3.Error
+
+    def close(self):
+        # the connection stays open for the next request of this thread
+        pass
+
+    def _sql(self, statement):
+        return statement.replace('%s', '?')
+
+    def _translate(self, error):
+        if isinstance(error, sqlite3.IntegrityError) and 'UNIQUE' in str(error):
+            # the message names the columns, e.g. "UNIQUE constraint failed: users.email"
+            return DuplicateError(str(error))
+        return StorageError(str(error))
+
+
+class Storage:
+    """Backend holding the data of the API, repository() opens a Repository for one request"""
+
+    def __init__(self, query_log=None) -> None:
+        self.query_log = query_log or QueryLog()
+
+    def repository(self) -> Repository:
+        raise NotImplementedError
+
+    def read_repository(self, session=None) -> Repository:
+        """Repository for statements that only read, it sees every write of `session` (a user ID) made so far"""
+        return self.repository()
+
+    def wrote(self, session):
+        """Note that the session committed a write, for storages that read from replicas"""
+
+    def start(self):
+        """Start background work, called once the application is created"""
+
+    @contextmanager
+    def session(self):
+        """Repository for a block of code, released at its end"""
+        repository = self.repository()
+        try:
+            yield repository
+        finally:
+            repository.close()
+
+    def metrics(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class MySQLStorage(Storage):
+    """MySQL database reached through a connection pool, the schema is managed by migrations.py"""
+
+    def __init__(self, pool, query_log=None) -> None:
+        super().__init__(query_log)
+        self.pool = pool
+
+    def repository(self):
+        try:
+            return MySQLRepository(self.pool.get_connection(), self.query_log)
+        except (mysql.connector.Error, PoolTimeoutError) as err:
+            raise StorageError(str(err)) from err
+
+    def metrics(self):
+        return self.pool.metrics()
+
+    def close(self):
+        self.pool.close_all()
+
+
+# SQLite version of the schema of migrations.py, applied when the database file is opened
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS employee_data (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    employee_id TEXT NOT NULL,
+    employee_name TEXT NOT NULL,
+    working_time DECIMAL(3,2) NOT NULL,
+    student_or_second_job INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (user_id, employee_id)
+);
+CREATE TABLE IF NOT EXISTS schedule_jobs (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    status TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS schedule_jobs_user ON schedule_jobs (user_id);
+CREATE TABLE IF NOT EXISTS schedules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    month TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    employees TEXT NOT NULL,
+    seed INTEGER,
+    score REAL,
+    availability_hash TEXT,
+    rpt_hash TEXT,
+    job_id TEXT
+);
+CREATE INDEX IF NOT EXISTS schedules_user_month ON schedules (user_id, month);
+CREATE INDEX IF NOT EXISTS schedules_job ON schedules (job_id);
+CREATE TABLE IF NOT EXISTS schedule_days (
+    schedule_id INTEGER NOT NULL REFERENCES schedules (id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    label TEXT NOT NULL,
+    slots BLOB NOT NULL,
+    PRIMARY KEY (schedule_id, day)
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    status_code INTEGER,
+    mimetype TEXT,
+    body BLOB,
+    PRIMARY KEY (scope, idempotency_key)
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys (created_at);
+CREATE TABLE IF NOT EXISTS roster_versions (
+    user_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    compacted_through INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS roster_changes (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    employee_id TEXT NOT NULL,
+    old_employee_id TEXT,
+    employee_name TEXT,
+    working_time DECIMAL(3,2),
+    student_or_second_job INTEGER,
+    changed_at REAL NOT NULL,
+    PRIMARY KEY (user_id, version)
+);
+CREATE INDEX IF NOT EXISTS roster_changes_changed ON roster_changes (changed_at);
+"""
+
+class SQLiteStorage(Storage):
+    """Single SQLite file in WAL mode, for small single-store deployments, tests and benchmarks.
+
+    Each thread keeps its own connection open, so a query costs no connection setup.
+    WAL lets readers run while one writer commits, writers of all processes take turns.
+    """
+
+    def __init__(self, path='schedule_creator.db', busy_timeout=5, query_log=None) -> None:
+        super().__init__(query_log)
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        with self.session() as repository:
+            repository.connection.executescript(SQLITE_SCHEMA)
+
+    def repository(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            try:
+                connection = self._connect()
+            except sqlite3.Error as err:
+                raise StorageError(str(err)) from err
+            self.local.connection = connection
+        return SQLiteRepository(connection, self.query_log)
+
+    def metrics(self):
+        with self.lock:
+            return {"backend": "sqlite", "connections": len(self.connections)}
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+    def _connect(self):
+        # connections are only used by their thread, close() runs in another one on shutdown
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, commits only sync at checkpoints, a power cut may lose the last commits but never corrupts
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        with self.lock:
+            self.connections.append(connection)
+        return connection
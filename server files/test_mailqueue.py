@@ -0,0 +1,141 @@
+import socket, sqlite3, time
+import pytest
+from mailqueue import MailQueue
+
+aiosmtpd = pytest.importorskip("aiosmtpd.controller")
+
+MESSAGE = "Subject: Test\r\n\r\nHello"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Inbox:
+    """aiosmtpd handler keeping the recipients of every delivered email"""
+
+    def __init__(self) -> None:
+        self.recipients = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.recipients.extend(envelope.rcpt_tos)
+        return '250 OK'
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@pytest.fixture
+def port(monkeypatch):
+    # a plain local SMTP stand-in, without TLS and AUTH
+    port = free_port()
+    monkeypatch.setenv('EMAIL_ADDRESS', 'sender@example.com')
+    monkeypatch.setenv('SMTP_SERVER', '127.0.0.1')
+    monkeypatch.setenv('SMTP_PORT', str(port))
+    monkeypatch.setenv('SMTP_STARTTLS', '0')
+    monkeypatch.setenv('SMTP_LOGIN', '0')
+    return port
+
+
+@pytest.fixture
+def smtp_server(port):
+    inbox = Inbox()
+    controllers = [aiosmtpd.Controller(inbox, hostname='127.0.0.1', port=port)]
+    controllers[0].start()
+    yield controllers, inbox
+    controllers[-1].stop()
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = MailQueue(str(tmp_path / 'outbox.db'), workers=1, max_attempts=2, poll_interval=0.1)
+    yield queue
+    queue.stop()
+
+
+def outbox_rows(queue):
+    connection = sqlite3.connect(queue.outbox_path)
+    try:
+        return connection.execute("SELECT attempts, next_attempt, status, last_error FROM outbox").fetchall()
+    finally:
+        connection.close()
+
+
+def test_sends_queued_emails(smtp_server, queue):
+    _, inbox = smtp_server
+    queue.start()
+    for number in range(3):
+        queue.enqueue(f"user{number}@example.com", MESSAGE)
+
+    assert wait_for(lambda: len(inbox.recipients) == 3)
+    assert sorted(inbox.recipients) == [f"user{number}@example.com" for number in range(3)]
+    assert wait_for(lambda: queue.metrics() == {"sent": 3, "retried": 0, "failed": 0, "depth": 0})
+
+
+def test_reconnects_after_the_server_dropped_the_connection(port, smtp_server, queue):
+    controllers, inbox = smtp_server
+    queue.start()
+    queue.enqueue("first@example.com", MESSAGE)
+    assert wait_for(lambda: inbox.recipients == ["first@example.com"])
+
+    # a restart closes the connection the worker keeps open between emails
+    controllers[-1].stop()
+    controllers.append(aiosmtpd.Controller(controllers[0].handler, hostname='127.0.0.1', port=port))
+    controllers[-1].start()
+    queue.enqueue("second@example.com", MESSAGE)
+
+    assert wait_for(lambda: inbox.recipients == ["first@example.com", "second@example.com"])
+    assert queue.metrics()["retried"] == 0
+
+
+def test_retries_with_backoff_and_gives_up(port, queue):
+    # nothing listens on the port, every attempt fails
+    queue.enqueue("user@example.com", MESSAGE)
+    queue.start()
+    assert wait_for(lambda: queue.metrics()["retried"] == 1)
+
+    attempts, next_attempt, status, last_error = outbox_rows(queue)[0]
+    assert (attempts, status) == (1, 'pending')
+    assert last_error
+    # the first retry waits 30 s with +-50% jitter
+    assert 15 <= next_attempt - time.time() <= 45
+
+    # make the retry due now, the second failure is the last one
+    connection = sqlite3.connect(queue.outbox_path)
+    with connection:
+        connection.execute("UPDATE outbox SET next_attempt = 0")
+    connection.close()
+    queue.wake_event.set()
+
+    assert wait_for(lambda: queue.metrics()["failed"] == 1)
+    assert outbox_rows(queue)[0][2] == 'failed'
+    assert queue.metrics()["depth"] == 0
+
+
+def test_outbox_errors_do_not_stop_the_worker(smtp_server, queue, monkeypatch):
+    _, inbox = smtp_server
+    record = queue._record
+    failures = []
+
+    def fail_once(*args):
+        if not failures:
+            failures.append(args)
+            raise sqlite3.OperationalError("database is locked")
+        return record(*args)
+
+    monkeypatch.setattr(queue, '_record', fail_once)
+    queue.start()
+    queue.enqueue("first@example.com", MESSAGE)
+    assert wait_for(lambda: failures)
+
+    queue.enqueue("second@example.com", MESSAGE)
+    assert wait_for(lambda: "second@example.com" in inbox.recipients)
+    assert all(worker.is_alive() for worker in queue.workers)
@@ -0,0 +1,29 @@
+import inspect, os
+import pytest
+from migrations import STATEMENT_EXAMPLES, api_statements, connect, full_scans, migrate
+from storage import MySQLRepository
+
+# repository methods without a query of the API
+NOT_QUERIES = {'close', 'ping', 'replication_lag', 'unique_key'}
+
+
+def test_every_query_method_is_explained():
+    methods = {name for name, _ in inspect.getmembers(MySQLRepository, inspect.isfunction) if not name.startswith('_')}
+    assert methods - NOT_QUERIES - {method for method, _ in STATEMENT_EXAMPLES} == set()
+
+
+def test_statements_come_from_the_repository():
+    statements = [statement for statement, _ in api_statements()]
+    assert "DELETE FROM roster_changes WHERE user_id = %s AND version <= %s" in statements
+    assert "DELETE FROM idempotency_keys WHERE created_at < %s LIMIT 5000" in statements
+    assert not any(statement.startswith('INSERT') for statement in statements)
+
+
+@pytest.mark.skipif(not os.environ.get('DB_HOST'), reason="needs a MySQL database in DB_HOST, DB_USER, DB_PASSWORD and DB_NAME")
+def test_no_statement_scans_a_whole_table():
+    connection = connect()
+    try:
+        migrate(connection)
+        assert full_scans(connection) == []
+    finally:
+        connection.close()
@@ -0,0 +1,4 @@
+from app import create_app
+
+# entry point for the WSGI server, e.g. "gunicorn -c gunicorn.conf.py wsgi:app"
+app = create_app()
@@ -0,0 +1,238 @@
+import random, threading, time, uuid
+from email.utils import parsedate_to_datetime
+import requests
+from apistats import ApiStats, parse_server_timing
+
+class ApiUnavailableError(requests.ConnectionError):
+    """Raised without touching the network while the circuit breaker is open"""
+
+
+class EndpointPolicy:
+    """Timeouts and retry rules of one API endpoint.
+
+    timeout is a (connect, read) tuple passed to requests, budget is the most time
+    all attempts together may take. Only idempotent calls are ever retried. Writes with
+    idempotency_key are sent with an Idempotency-Key header, which makes them idempotent:
+    the server answers a repeated write with the answer of the first one.
+    """
+    def __init__(self, timeout=(3.05, 10), retries=0, idempotent=False, budget=15, idempotency_key=False) -> None:
+        self.timeout = timeout
+        self.idempotent = idempotent or idempotency_key
+        self.retries = retries if self.idempotent else 0
+        self.idempotency_key = idempotency_key
+        self.budget = budget
+
+
+class CircuitBreaker:
+    """Fails fast after repeated failures and lets a single probe through after a cool down"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Check if a request may be sent right now"""
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let one probe request find out if the API is back
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print("API reachable again, closing circuit.")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"API unavailable, failing fast for {self.reset_timeout} s.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class ApiClient:
+    """Sends requests to the API applying per-endpoint timeouts, retries and a shared circuit breaker"""
+
+    # responses worth retrying, the server or a proxy in front of it was temporarily unable to answer
+    RETRY_STATUSES = {502, 503, 504}
+
+    def __init__(self, base_url, policies=None, default_policy=None, breaker=None) -> None:
+        self.base_url = base_url
+        self.policies = policies or {}
+        self.default_policy = default_policy or EndpointPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        # one session keeps the TCP/TLS connection to the API alive between calls
+        self.session = requests.Session()
+        self.counters = {"requests": 0, "retries": 0, "timeouts": 0, "errors": 0, "short_circuited": 0, "throttled": 0}
+        self.counters_lock = threading.Lock()
+        self.endpoint_stats = ApiStats()
+        # session tokens issued by /login, sent with every call once set
+        self.access_token = None
+        self.refresh_token = None
+        self.token_lock = threading.Lock()
+
+    def set_tokens(self, access_token, refresh_token, **kwargs):
+        with self.token_lock:
+            self.access_token = access_token
+            self.refresh_token = refresh_token
+
+    def clear_tokens(self):
+        self.set_tokens(None, None)
+
+    def refresh_session(self) -> int:
+        """Exchange the refresh token for new tokens, return the status code (None if there is no session)"""
+        refresh_token = self.refresh_token
+        if refresh_token is None:
+            return None
+        response = self._send('POST', '/login/refresh', '/login/refresh', json={'refresh_token': refresh_token})
+        if response.status_code == 200:
+            self.set_tokens(**response.json())
+        return response.status_code
+
+    def post(self, path, **kwargs) -> requests.Response:
+        """POST to the endpoint, raises requests.RequestException if it could not be reached.
+
+        An expired access token is refreshed once and the call repeated.
+        """
+        return self.request("POST", path, **kwargs)
+
+    def get(self, path, **kwargs) -> requests.Response:
+        """GET from the endpoint, same behaviour as post()"""
+        return self.request("GET", path, **kwargs)
+
+    def request(self, method, path, endpoint=None, **kwargs) -> requests.Response:
+        """Call the endpoint with any method, `endpoint` names the policy and statistics of paths with IDs in them"""
+        endpoint = endpoint or path
+        access_token = self.access_token
+        response = self._send(method, path, endpoint, **kwargs)
+        if response.status_code == 401 and access_token is not None and not path.startswith('/login'):
+            with self.token_lock:
+                # another thread may have refreshed the tokens already
+                refreshed = self.access_token != access_token
+            if refreshed or self.refresh_session() == 200:
+                response = self._send(method, path, endpoint, **kwargs)
+        return response
+
+    def open_stream(self, path, timeout=(3.05, 60), **kwargs) -> requests.Response:
+        """Open a long-lived streamed GET, the caller reads it with iter_lines() and closes it.
+
+        Streams bypass retries, statistics and the circuit breaker, a dropped stream is simply
+        reopened by its reader. An expired access token is refreshed once.
+        """
+        access_token = self.access_token
+        response = self._open(path, timeout, **kwargs)
+        if response.status_code == 401 and access_token is not None:
+            response.close()
+            if self.refresh_session() == 200:
+                response = self._open(path, timeout, **kwargs)
+        return response
+
+    def _open(self, path, timeout, **kwargs) -> requests.Response:
+        kwargs["headers"] = {**kwargs.get("headers", {}), "X-Request-ID": uuid.uuid4().hex}
+        if self.access_token is not None:
+            kwargs["headers"]["Authorization"] = f"Bearer {self.access_token}"
+        return self.session.get(self.base_url+path, timeout=timeout, stream=True, **kwargs)
+
+    def _send(self, method, path, endpoint, **kwargs) -> requests.Response:
+        """Send one call applying the endpoint's timeouts, retries and the circuit breaker"""
+        policy = self.policies.get(endpoint, self.default_policy)
+        deadline = time.monotonic() + policy.budget
+        attempt = 0
+
+        # the server logs this ID, so a slow call can be found on both sides (retries keep the same one)
+        request_id = uuid.uuid4().hex
+        kwargs["headers"] = {**kwargs.get("headers", {}), "X-Request-ID": request_id}
+        if self.access_token is not None:
+            kwargs["headers"]["Authorization"] = f"Bearer {self.access_token}"
+        if policy.idempotency_key and method != "GET":
+            # callers that may repeat the write later, like the outbox, bring their own key
+            kwargs["headers"].setdefault("Idempotency-Key", uuid.uuid4().hex)
+
+        while True:
+            if not self.breaker.allow():
+                self._count("short_circuited")
+                raise ApiUnavailableError(f"Circuit open, not calling {path}")
+
+            self._count("requests")
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, self.base_url+path, timeout=policy.timeout, **kwargs)
+            except requests.RequestException as e:
+                self.endpoint_stats.record(endpoint, time.perf_counter() - started, error=type(e).__name__)
+                self._count("timeouts" if isinstance(e, requests.Timeout) else "errors")
+                self.breaker.record_failure()
+                error = e
+            else:
+                # bytes on the wire, the body may have arrived gzip compressed
+                received = int(response.headers.get("Content-Length", len(response.content)))
+                self.endpoint_stats.record(endpoint, time.perf_counter() - started, len(response.request.body or b""), received,
+                                           error=response.status_code if response.status_code >= 400 else None,
+                                           server_ms=parse_server_timing(response.headers.get("Server-Timing", "")))
+                in_progress = response.status_code == 409 and "Idempotency-Key" in kwargs["headers"] and "Retry-After" in response.headers
+                throttled = response.status_code == 429
+                if response.status_code not in self.RETRY_STATUSES and not in_progress and not throttled:
+                    self.breaker.record_success()
+                    return response
+                if in_progress or throttled:
+                    # an earlier attempt of this write is still running on the server, its answer comes with the retry,
+                    # or the server turned the call away unrun because we sent too much. Neither means it is down
+                    self.breaker.record_success()
+                    if throttled:
+                        self._count("throttled")
+                else:
+                    self._count("errors")
+                    self.breaker.record_failure()
+                error = None
+
+            # retry with full jitter backoff while the latency budget allows it, not before the server asked us to
+            delay = random.uniform(0, min(2, 0.1 * 2**attempt))
+            if error is None:
+                delay = max(delay, self.retry_after(response) or 0)
+            if attempt >= policy.retries or time.monotonic() + delay + policy.timeout[0] > deadline:
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+            self._count("retries")
+            time.sleep(delay)
+
+    @staticmethod
+    def retry_after(response):
+        """Return the seconds the Retry-After header of a response asks to wait, None without one"""
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def stats(self) -> dict:
+        """Return a copy of the request counters together with the breaker state"""
+        with self.counters_lock:
+            return {**self.counters, "circuit": self.breaker.state}
+
+    def dump_stats(self, path):
+        """Write counters and per-endpoint latency histograms to a JSON file"""
+        self.endpoint_stats.dump(path, {"counters": self.stats()})
+        print(f"API statistics saved to {path}")
+
+    def _count(self, name):
+        with self.counters_lock:
+            self.counters[name] += 1
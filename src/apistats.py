@@ -0,0 +1,116 @@
+import bisect, json, threading, time
+
+class LatencyHistogram:
+    """Counts request durations in fixed buckets (upper bounds in milliseconds)"""
+
+    BOUNDS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+    def __init__(self) -> None:
+        self.buckets = [0] * len(self.BOUNDS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, milliseconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction) -> float:
+        """Return the upper bound of the bucket holding the given fraction of requests"""
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 2)
+        return round(self.max, 2)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 2) if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max, 2),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in zip(self.BOUNDS, self.buckets)},
+        }
+
+
+class EndpointStats:
+    """Latency, payload sizes and errors of one endpoint"""
+
+    def __init__(self) -> None:
+        self.latency = LatencyHistogram()
+        # time the server reported spending on the request, the rest of latency is network
+        self.server_latency = LatencyHistogram()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = {}
+
+    def to_dict(self) -> dict:
+        return {
+            "latency": self.latency.to_dict(),
+            "server_latency": self.server_latency.to_dict(),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "errors": dict(self.errors),
+        }
+
+
+def parse_server_timing(header) -> float:
+    """Return the longest duration in milliseconds from a Server-Timing header, None if there is none.
+
+    The server reports the whole request as one metric and its parts (like database time) as others,
+    so the longest one is the time spent on the server.
+    """
+    durations = []
+    for metric in header.split(","):
+        for param in metric.split(";")[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "dur":
+                try:
+                    durations.append(float(value))
+                except ValueError:
+                    pass
+    return max(durations) if durations else None
+
+
+class ApiStats:
+    """Per-endpoint statistics of the API calls made by the client"""
+
+    def __init__(self) -> None:
+        self.endpoints = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, bytes_sent=0, bytes_received=0, error=None, server_ms=None):
+        """Record one attempt, error is an HTTP status or exception name if the attempt failed"""
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.latency.add(seconds * 1000)
+            if server_ms is not None:
+                stats.server_latency.add(server_ms)
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            if error is not None:
+                stats.errors[str(error)] = stats.errors.get(str(error), 0) + 1
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "since": self.started,
+                "endpoints": {endpoint: stats.to_dict() for endpoint, stats in self.endpoints.items()},
+            }
+
+    def dump(self, path, extra=None):
+        """Write the statistics as JSON to the given file"""
+        data = self.to_dict()
+        if extra:
+            data.update(extra)
+        with open(path, "w") as stats_file:
+            json.dump(data, stats_file, indent=2)
@@ -1,12 +1,44 @@
-import requests
+import datetime, hashlib, json, os, random, requests, threading, time
 import sensitive_data
+try:
+    import msgpack
+except ImportError:
+    # without msgpack the roster is simply downloaded as JSON
+    msgpack = None
+from apiclient import ApiClient, EndpointPolicy
+from localstore import LocalStore
+from settings import LOCAL_DB_PATH, SYNC_INTERVAL, PAGE_SIZE, REMOTE_PAGE_SIZE, ROSTER_STREAM, ROSTER_POLL_INTERVAL
+
+# latency budgets of the endpoints, calls made while the user waits get the shortest ones.
+# Writes carry an Idempotency-Key, so they are retried like reads
+ENDPOINT_POLICIES = {
+    '/login': EndpointPolicy(timeout=(3.05, 8), budget=10),
+    '/login/refresh': EndpointPolicy(timeout=(2, 5), retries=1, idempotent=True, budget=8),
+    '/register': EndpointPolicy(timeout=(3.05, 15), retries=1, idempotency_key=True, budget=35),
+    '/register/check': EndpointPolicy(timeout=(1, 2), retries=1, idempotent=True, budget=4),
+    '/data/checkemployee': EndpointPolicy(timeout=(2, 5), retries=2, idempotent=True, budget=10),
+    '/data/get': EndpointPolicy(timeout=(2, 10), retries=2, idempotent=True, budget=20),
+    '/data/changes': EndpointPolicy(timeout=(2, 10), retries=2, idempotent=True, budget=20),
+    '/data/add': EndpointPolicy(timeout=(2, 5), retries=2, idempotency_key=True, budget=15),
+    '/data/update': EndpointPolicy(timeout=(2, 5), retries=2, idempotency_key=True, budget=15),
+    '/data/delete': EndpointPolicy(timeout=(2, 5), retries=2, idempotency_key=True, budget=15),
+    '/schedule/jobs': EndpointPolicy(timeout=(3.05, 30), retries=1, idempotency_key=True, budget=70),
+    '/schedule/jobs/<job_id>': EndpointPolicy(timeout=(2, 10), retries=2, idempotent=True, budget=15),
+    '/schedules': EndpointPolicy(timeout=(2, 10), retries=2, idempotency_key=True, budget=25),
+    '/schedules/<schedule_id>': EndpointPolicy(timeout=(2, 10), retries=2, idempotent=True, budget=15),
+    '/schedules/<schedule_id>/employees/<employee_id>': EndpointPolicy(timeout=(2, 5), retries=2, idempotent=True, budget=10),
+}
+
+# client shared by every class below, so they also share the circuit breaker
+api = ApiClient(sensitive_data.API_URL, ENDPOINT_POLICIES)
+
+# columns of the employee table the client works with, user_id is left on the server
+EMPLOYEE_COLUMNS = ['employee_id', 'employee_name', 'working_time', 'student_or_second_job']
+MSGPACK_MIMETYPE = 'application/x-msgpack'
 
 class Login:
     """User verification using API"""
 
-    def __init__(self):
-        self.api_url = sensitive_data.API_URL+'/login'
-
     # send user information to endpoint
     def connect(self, email, password):
         data = {
@@ -14,17 +46,38 @@ class Login:
             'password': password
         }
 
-        response = requests.post(self.api_url, json=data)
-        print(response.json())
+        try:
+            response = api.post('/login', json=data)
+        except requests.RequestException as e:
+            print(f"Login failed, server unavailable: {e}")
+            return None
+        result = response.json()
+        print(result.get('message'))
+
+        # following calls are authorised by the session token instead of the email
+        if response.status_code == 200:
+            api.set_tokens(result['access_token'], result['refresh_token'])
         return(response.status_code)
+
+    def resume(self, refresh_token):
+        """Start a session from a saved refresh token, without sending the password"""
+        api.set_tokens(None, refresh_token)
+        try:
+            status = api.refresh_session()
+        except requests.RequestException as e:
+            print(f"Unable to resume session, server unavailable: {e}")
+            return None
+        if status != 200:
+            api.clear_tokens()
+        return status
+
+    def logout(self):
+        api.clear_tokens()
     
 
 class Register:
     """User registration using API"""
 
-    def __init__(self):
-        self.api_url = sensitive_data.API_URL+'/register'
-
     def register(self, username, email, password):
         data = {
             'username': username,
@@ -32,8 +85,11 @@ class Register:
             'password': password
         }
 
-        
-        response = requests.post(self.api_url, json=data)
+        try:
+            response = api.post('/register', json=data)
+        except requests.RequestException as e:
+            print(f"Registration failed, server unavailable: {e}")
+            return None
         result = response.json()
         print(result)
 
@@ -45,7 +101,12 @@ class Register:
             'value': value
         }
 
-        response = requests.post(self.api_url+'/check', json=data)
+        try:
+            response = api.post('/register/check', json=data)
+        except requests.RequestException as e:
+            # registration itself is still rejected by the server if the value is taken
+            print(f"Unable to check {type}, server unavailable: {e}")
+            return False
         print(response)
         print(response.status_code)
         
@@ -56,54 +117,540 @@ class Register:
             return False
         
 class EmployeeData:
+    """Employee records served from a local SQLite mirror, synchronised with the API in the background"""
+    _store = None
+    _syncer = None
+    _init_lock = threading.Lock()
+    _sync_lock = threading.Lock()
+
     def __init__(self):
-        self.api_url = sensitive_data.API_URL+'/data'
+        # every instance shares one local database and one sync thread
+        with EmployeeData._init_lock:
+            if EmployeeData._store is None:
+                EmployeeData._store = LocalStore(LOCAL_DB_PATH)
+                EmployeeData._syncer = OutboxSync(EmployeeData._store, self)
+                EmployeeData._syncer.start()
+        self.store = EmployeeData._store
+        self.syncer = EmployeeData._syncer
 
     def checkIfTableExist(self, user_email):
+        if self._ensure_synced(user_email):
+            return 200 if self.store.rows(user_email) else 410
+
         data = {
             "user_email": user_email
         }
-        response = requests.post(self.api_url+'/checkemployee', json=data)
+        try:
+            response = api.post('/data/checkemployee', json=data)
+        except requests.RequestException as e:
+            print(f"Unable to reach the server: {e}")
+            return None
         return response.status_code
     
     def getEmployeeTable(self, user_email):
-        data = {
-            "user_email": user_email
-        }
-        employee_data = requests.post(self.api_url+'/get', json=data).json()
-        try:
-            return employee_data["result"]
-        except KeyError:
-            return []
+        self._ensure_synced(user_email)
+        return self.store.rows(user_email)
+
+    def iterEmployeePages(self, user_email, page_size=PAGE_SIZE):
+        """Yield the roster in pages of page_size rows ordered by employee ID, numeric IDs in numeric order"""
+        self._ensure_synced(user_email)
+        after = None
+        while True:
+            page = self.store.page(user_email, after, page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
 
     def addEmployee(self, user_email, employee_id, employee_name, working_time, student_or_second_job):
         data = {
-            "user_email": user_email,
             "employee_id": employee_id,
             "employee_name": employee_name,
             "work_time": working_time,
             "student_or_second_job": student_or_second_job
         }
-        response = requests.post(self.api_url+'/add', json=data)
-        print(response)
+        self._queue(user_email, "add", data)
     
     def deleteEmployee(self, user_email, employee_id):
         data = {
-            "user_email": user_email,
             "employee_id": employee_id,
         }
-        response = requests.post(self.api_url+'/delete', json=data)
-        print(response)
+        self._queue(user_email, "delete", data)
 
     def updateEmployeeData(self, user_email, old_employee_id, employee_id, employee_name, working_time, student_or_second_job):
         data = {
-            "user_email": user_email,
             "old_employee_id": old_employee_id,
             "employee_id": employee_id,
             "employee_name": employee_name,
             "work_time": working_time,
             "student_or_second_job": student_or_second_job
         }
-        response = requests.post(self.api_url+'/update', json=data)
-        print(response)
-        
\ No newline at end of file
+        self._queue(user_email, "update", data)
+
+    # answers after which a queued write is sent again later, the server did not run it
+    TRANSIENT_STATUSES = {429, 502, 503, 504}
+
+    def sync(self, user_email):
+        """Push the outbox of the user to the API and refresh the local mirror.
+
+        A queued write is only sent if the server still holds the row we based it on,
+        otherwise it is recorded as a conflict and the server version wins. Writes the server
+        refuses (400, 404, 409, 422) are recorded as conflicts as well.
+        Raises requests.RequestException if the API is unreachable.
+        """
+        with EmployeeData._sync_lock:
+            self._sync(user_email)
+
+    def _sync(self, user_email):
+        self._pull(user_email)
+        remote = self.store.snapshot(user_email)
+        pushed = set()
+        # employees with a write the server failed on, their later writes wait for it
+        held = set()
+        rejected = False
+
+        for entry_id, action, payload, base_row in self.store.pending(user_email):
+            key = str(payload["old_employee_id"] if action == "update" else payload["employee_id"])
+            if key in held or str(payload["employee_id"]) in held:
+                held.update((key, str(payload["employee_id"])))
+                continue
+
+            # the answer to an earlier attempt may have been lost after the server applied the write
+            if key not in pushed and self._landed(action, payload, remote):
+                self.store.remove_pending(entry_id)
+                pushed.update((key, str(payload["employee_id"])))
+                continue
+
+            # employees already written in this sync hold our own version, the rest must be unchanged since the edit
+            if key not in pushed and remote.get(key) != base_row:
+                print(f"Sync conflict on employee {key}, keeping server version.")
+                self.store.record_conflict(user_email, action, payload, remote.get(key), "changed on another device")
+                self.store.remove_pending(entry_id)
+                rejected = True
+                continue
+
+            # the key stays the same however often the entry is sent, the server applies it once
+            response = api.post(f"/data/{action}", json={"user_email": user_email, **payload},
+                                headers={"Idempotency-Key": self.store.request_key(entry_id)})
+            status = response.status_code
+            if status in self.TRANSIENT_STATUSES or status == 401 or (status == 409 and "Retry-After" in response.headers):
+                # the server is busy, the session could not be refreshed or an earlier attempt still runs:
+                # the write did not happen, leave the rest of the outbox for the next attempt
+                break
+            if status >= 500:
+                # the server failed on the write, keep it and send it again with the next sync
+                print(f"Sync of {action} on employee {key} failed with status {status}, keeping it queued.")
+                held.update((key, str(payload["employee_id"])))
+                continue
+            if status >= 400:
+                # the server refused the write for good, e.g. the employee ID is taken or the employee is gone
+                print(f"Server rejected {action} of employee {key} with status {status}.")
+                self.store.record_conflict(user_email, action, payload, remote.get(key), self._message(response))
+                self.store.remove_pending(entry_id)
+                rejected = True
+                continue
+            self.store.remove_pending(entry_id)
+
+            # keep our copy of the remote roster in step with what the server now holds
+            remote.pop(key, None)
+            if action != "delete":
+                row = LocalStore.normalize((payload["employee_id"], payload["employee_name"],
+                                            payload["work_time"], payload["student_or_second_job"]))
+                remote[row[0]] = row
+                pushed.add(row[0])
+            pushed.add(key)
+
+        if pushed or rejected:
+            # our own writes come back as changes, the mirror then holds what the server stored
+            # and no longer shows rejected writes
+            self._pull(user_email)
+
+    @staticmethod
+    def _message(response):
+        try:
+            return response.json().get("message")
+        except ValueError:
+            return None
+
+    def _pull(self, user_email):
+        """Bring the mirrored remote roster up to date.
+
+        Only the changes since the mirrored version are downloaded. The whole roster is fetched
+        on the first sync and when the server no longer has those changes.
+        """
+        version = self.store.version(user_email)
+        while version is not None:
+            response = api.get('/data/changes', params={"user_email": user_email, "since": version},
+                               headers=self._accept_headers())
+            if response.status_code in (404, 410):
+                # compacted past our version, or a server without the change log
+                break
+            response.raise_for_status()
+            changes = self._decode(response)
+            self.store.apply_changes(user_email, changes["upserts"], changes["deletes"], changes["version"])
+            if not changes["more"]:
+                return
+            version = changes["version"]
+
+        remote_rows, version = self._fetch_remote_table(user_email)
+        self.store.replace_snapshot(user_email, remote_rows, version)
+
+    def set_user(self, user_email, on_conflict=None):
+        """Keep the roster of the logged in user synchronised in the background, None after a logout.
+
+        `on_conflict(user_email)` is called from the sync thread after a sync that left conflicts
+        the user was not shown yet, conflicts() with unseen=True returns them.
+        """
+        self.syncer.follow(user_email, on_conflict)
+
+    def conflicts(self, user_email, unseen=False):
+        """Return the user's local writes that were rejected, see LocalStore.conflicts"""
+        return self.store.conflicts(user_email, unseen)
+
+    def watch(self, user_email, on_change=None):
+        """Follow roster changes made elsewhere, return the started RosterPoller, or RosterStream with ROSTER_STREAM.
+
+        `on_change(user_email)` is called from the watching thread after every applied change.
+        """
+        watcher = RosterStream(self, user_email, on_change) if ROSTER_STREAM else RosterPoller(self, user_email, on_change)
+        watcher.start()
+        return watcher
+
+    def apply_remote_change(self, user_email, action, payload):
+        """Apply one pushed change, in step with running syncs so a snapshot fetched earlier cannot overwrite it"""
+        with EmployeeData._sync_lock:
+            if not self.store.is_synced(user_email):
+                return False
+            self.store.apply_remote(user_email, action, payload)
+        return True
+
+    @staticmethod
+    def _landed(action, payload, remote):
+        """Check if the server already holds the result of a queued write"""
+        if action == "delete":
+            return str(payload["employee_id"]) not in remote
+        row = LocalStore.normalize((payload["employee_id"], payload["employee_name"],
+                                    payload["work_time"], payload["student_or_second_job"]))
+        moved = action == "update" and str(payload["old_employee_id"]) != row[0] and str(payload["old_employee_id"]) in remote
+        return remote.get(row[0]) == row and not moved
+
+    def _ensure_synced(self, user_email):
+        """Download the roster once if it is not mirrored yet, return True if local data can be used"""
+        if not self.store.is_synced(user_email):
+            try:
+                self.sync(user_email)
+            except requests.RequestException as e:
+                print(f"Unable to reach the server: {e}")
+        return self.store.is_synced(user_email)
+
+    def _queue(self, user_email, action, data):
+        key = data["old_employee_id"] if action == "update" else data["employee_id"]
+        self.store.enqueue(user_email, action, data, key)
+        print(f"Queued {action} of employee {data['employee_id']}")
+        self.syncer.wake()
+
+    def _fetch_remote_table(self, user_email):
+        """Return the roster from the API as [employee_id, name, working_time, student] rows and its version"""
+        rows = []
+        version = None
+        for page_version, page in self._iter_remote_pages(user_email):
+            # the first page is the oldest, changes made while the later ones were read are pulled again
+            if version is None:
+                version = page_version
+            rows.extend(page)
+        return rows, version
+
+    def _iter_remote_pages(self, user_email, page_size=REMOTE_PAGE_SIZE):
+        """Stream the roster from the API page by page as (version, rows), following the employee ID cursor.
+
+        Only the needed columns are requested, as msgpack if it is installed, and gzip
+        compressed (requests asks for and decodes gzip on its own). The version is None
+        if the server does not keep one.
+        """
+        headers = self._accept_headers()
+        after = None
+        while True:
+            data = {
+                "user_email": user_email,
+                "columns": EMPLOYEE_COLUMNS,
+                "limit": page_size,
+                "after": after
+            }
+            response = api.post('/data/get', json=data, headers=headers)
+            if response.status_code == 409:
+                # user has no employee records yet
+                yield response.json().get("version"), []
+                return
+            response.raise_for_status()
+            employee_data = self._decode(response)
+
+            # servers without projection send every column, pick ours by name
+            columns = employee_data.get("columns", ['user_id', *EMPLOYEE_COLUMNS])
+            indexes = [columns.index(column) for column in EMPLOYEE_COLUMNS]
+            yield employee_data.get("version"), [[row[i] for i in indexes] for row in employee_data["result"]]
+
+            # servers without pagination send everything at once and no cursor
+            after = employee_data.get("next_cursor")
+            if after is None:
+                return
+
+    @staticmethod
+    def _accept_headers():
+        return {"Accept": f"{MSGPACK_MIMETYPE}, application/json;q=0.9"} if msgpack else {}
+
+    @staticmethod
+    def _decode(response):
+        if response.headers.get('Content-Type', '').startswith(MSGPACK_MIMETYPE):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+
+class ScheduleJobs:
+    """Schedule generation on the server, the client only uploads the files and polls for the result"""
+
+    def submit(self, user_email, availability_path, rpt_path):
+        """Upload the availability and RPT files, return the ID of the queued job or None"""
+        try:
+            # read into memory, so a retry sends the files again
+            with open(availability_path, 'rb') as availability, open(rpt_path, 'rb') as rpt:
+                files = {'availability': (os.path.basename(availability_path), availability.read()),
+                         'rpt': (os.path.basename(rpt_path), rpt.read())}
+            response = api.post('/schedule/jobs', data={'user_email': user_email}, files=files)
+        except requests.RequestException as e:
+            print(f"Schedule job not submitted, server unavailable: {e}")
+            return None
+        result = response.json()
+        print(result.get('message'))
+
+        return result.get('job_id') if response.status_code == 202 else None
+
+    def status(self, user_email, job_id):
+        """Return the job as {"status": ..., "schedule": ...}, the schedule is only there once the status is done.
+        None if the server could not be reached"""
+        try:
+            response = api.get(f'/schedule/jobs/{job_id}', endpoint='/schedule/jobs/<job_id>', params={'user_email': user_email})
+        except requests.RequestException as e:
+            print(f"Schedule job status unknown, server unavailable: {e}")
+            return None
+        return response.json()
+
+    def wait(self, user_email, job_id, poll_interval=2, timeout=600):
+        """Poll until the job is done or failed, return its last status or None if the server could not be reached"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.status(user_email, job_id)
+            if job is None or job.get('status') not in ('queued', 'running') or time.monotonic() + poll_interval > deadline:
+                return job
+            time.sleep(poll_interval)
+
+
+class Schedules:
+    """Generated schedules saved on the server, so they outlive the program"""
+
+    def save(self, user_email, month, schedule, seed=None, score=None, availability_path=None, rpt_path=None):
+        """Save a {day: {hour: [employee IDs]}} schedule for a "YYYY-MM" month, return its ID or None.
+
+        The input files are only hashed, the hashes tell which files a saved schedule was made from.
+        """
+        data = {
+            'user_email': user_email,
+            'month': month,
+            'schedule': {day: {str(hour): employees for hour, employees in hours.items()} for day, hours in schedule.items()},
+            'seed': seed,
+            'score': score,
+            'availability_hash': self._file_hash(availability_path),
+            'rpt_hash': self._file_hash(rpt_path)
+        }
+
+        try:
+            response = api.post('/schedules', json=data)
+        except requests.RequestException as e:
+            print(f"Schedule not saved, server unavailable: {e}")
+            return None
+        result = response.json()
+        print(result.get('message'))
+
+        return result.get('schedule_id') if response.status_code == 201 else None
+
+    @staticmethod
+    def month_of(schedule):
+        """Return the "YYYY-MM" month of a schedule, its day labels are "dd-mm" without a year"""
+        today = datetime.date.today()
+        return f"{today.year}-{next(iter(schedule)).split('-')[1]}" if schedule else today.strftime('%Y-%m')
+
+    @staticmethod
+    def _file_hash(path):
+        if path is None:
+            return None
+        with open(path, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def month(self, user_email, month):
+        """Return the metadata of the schedules saved for a month, newest first, None if the server could not be reached"""
+        try:
+            response = api.get('/schedules', params={'user_email': user_email, 'month': month})
+        except requests.RequestException as e:
+            print(f"Schedules not loaded, server unavailable: {e}")
+            return None
+        return response.json().get('schedules', [])
+
+    def get(self, user_email, schedule_id, start=None, end=None, employee_id=None):
+        """Return a saved schedule, only the days from start to end ("YYYY-MM-DD") and one employee if given"""
+        params = {'user_email': user_email, 'from': start, 'to': end}
+        try:
+            if employee_id is None:
+                response = api.get(f'/schedules/{schedule_id}', endpoint='/schedules/<schedule_id>', params=params)
+            else:
+                response = api.get(f'/schedules/{schedule_id}/employees/{employee_id}',
+                                   endpoint='/schedules/<schedule_id>/employees/<employee_id>', params=params)
+        except requests.RequestException as e:
+            print(f"Schedule not loaded, server unavailable: {e}")
+            return None
+        return response.json() if response.status_code == 200 else None
+
+
+class OutboxSync(threading.Thread):
+    """Background thread that periodically synchronises the roster of the logged in user with the API.
+
+    Writes are sent with the session of that user, outboxes of other accounts on this machine
+    wait until their user logs in again.
+    """
+
+    def __init__(self, store, employee_data) -> None:
+        super().__init__(daemon=True)
+        self.store = store
+        self.employee_data = employee_data
+        self.user_email = None
+        self.on_conflict = None
+        self.wake_event = threading.Event()
+
+    def wake(self):
+        """Run the next sync right away instead of waiting for the interval"""
+        self.wake_event.set()
+
+    def follow(self, user_email, on_conflict=None):
+        """Sync the roster of this user from now on, None stops syncing until the next login"""
+        self.user_email = user_email
+        self.on_conflict = on_conflict
+        if user_email is not None:
+            self.wake()
+
+    def run(self):
+        while True:
+            self.wake_event.wait(SYNC_INTERVAL)
+            self.wake_event.clear()
+
+            user_email, on_conflict = self.user_email, self.on_conflict
+            if user_email is None:
+                continue
+            try:
+                self.employee_data.sync(user_email)
+            except requests.RequestException as e:
+                print(f"Sync postponed, server unavailable: {e}")
+            if on_conflict is not None and self.store.has_unseen_conflicts(user_email):
+                on_conflict(user_email)
+
+
+class RosterPoller(threading.Thread):
+    """Background thread pulling the roster changes of one user every ROSTER_POLL_INTERVAL seconds.
+
+    A poll asks /data/changes for what happened since the mirrored version, it holds a server
+    thread only while it runs, unlike an open stream.
+    """
+
+    def __init__(self, employee_data, user_email, on_change=None, interval=ROSTER_POLL_INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self.employee_data = employee_data
+        self.user_email = user_email
+        self.on_change = on_change
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        # versions pulled by the outbox sync in between count as changes as well
+        version = self.employee_data.store.version(self.user_email)
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.employee_data.sync(self.user_email)
+            except requests.RequestException as e:
+                print(f"Roster poll postponed, server unavailable: {e}")
+                continue
+            current = self.employee_data.store.version(self.user_email)
+            if current != version and self.on_change is not None:
+                self.on_change(self.user_email)
+            version = current
+
+
+class RosterStream(threading.Thread):
+    """Background thread reading the server-sent roster events of one user into the local mirror.
+
+    Every (re)connect triggers a sync, which picks up whatever changed while the stream was closed.
+    """
+
+    def __init__(self, employee_data, user_email, on_change=None) -> None:
+        super().__init__(daemon=True)
+        self.employee_data = employee_data
+        self.user_email = user_email
+        self.on_change = on_change
+        self.stop_event = threading.Event()
+        self.response = None
+
+    def stop(self):
+        """Close the stream, the thread ends shortly after"""
+        self.stop_event.set()
+        response = self.response
+        if response is not None:
+            response.close()
+
+    def run(self):
+        failures = 0
+        while not self.stop_event.is_set():
+            # a busy or rate limiting server says when to come back
+            retry_after = 0
+            try:
+                self.response = api.open_stream('/data/stream', params={'user_email': self.user_email})
+                if self.response.status_code != 200:
+                    retry_after = api.retry_after(self.response) or 0
+                    raise requests.HTTPError(f"Roster stream refused with status {self.response.status_code}")
+                failures = 0
+                self.employee_data.syncer.wake()
+                self._read(self.response)
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+                failures += 1
+                print(f"Roster stream interrupted: {e}")
+            finally:
+                if self.response is not None:
+                    self.response.close()
+            # reconnect with full jitter, so clients cut off together do not come back together
+            self.stop_event.wait(max(retry_after, random.uniform(0, min(60, 2**failures))))
+
+    def _read(self, response):
+        # events are "field: value" lines ended by an empty line, lines starting with ":" are keepalives
+        response.encoding = 'utf-8'
+        event, data = None, []
+        for line in response.iter_lines(decode_unicode=True):
+            if self.stop_event.is_set():
+                return
+            if not line:
+                if event == 'roster' and data:
+                    self._apply(json.loads('\n'.join(data)))
+                event, data = None, []
+            elif not line.startswith(':'):
+                field, _, value = line.partition(':')
+                value = value[1:] if value.startswith(' ') else value
+                if field == 'event':
+                    event = value
+                elif field == 'data':
+                    data.append(value)
+
+    def _apply(self, change):
+        action = change.pop("action")
+        if self.employee_data.apply_remote_change(self.user_email, action, change) and self.on_change is not None:
+            self.on_change(self.user_email)
@@ -1,15 +1,40 @@
-import sys, os, re
+import sys, os, re, random, threading
 import keyring, configparser
-from PySide6.QtCore import QSize, Qt, QEvent, QTimer, Slot, QStandardPaths
+from PySide6.QtCore import QSize, Qt, QEvent, QTimer, Signal, Slot, QStandardPaths
 from PySide6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QFormLayout, QLabel,
     QLineEdit, QCheckBox, QPushButton, QHBoxLayout, QStackedWidget,
-    QToolTip, QFrame, QSlider, QScrollArea, QMenu, QComboBox, QFileDialog
+    QToolTip, QFrame, QSlider, QScrollArea, QMenu, QComboBox, QFileDialog, QMessageBox
 )
 from PySide6.QtGui import (QPainter, QPixmap, QFont, QFontDatabase, QGuiApplication,
                            QPalette, QColor, QIcon, QLinearGradient, QAction, QDragEnterEvent, QDropEvent
 )
-from database import Login, Register, EmployeeData
+from database import Login, Register, EmployeeData, ScheduleJobs, Schedules, api
+from scheduleCreator import ScheduleCreator
+
+def resume_saved_session(email):
+    """Log in with the session saved in keyring, return False if the user has to log in again"""
+    secret = keyring.get_password("schedule_creator", email)
+    if not secret:
+        print("No saved session found in keyring.")
+        return False
+
+    login = Login()
+    status = login.resume(secret)
+    if status == 401:
+        # older versions saved the password instead of a refresh token
+        status = login.connect(email, secret)
+
+    if status == 200:
+        # replace the saved secret with the fresh refresh token
+        keyring.set_password("schedule_creator", email, api.refresh_token)
+    elif status is not None:
+        print("Saved session expired, please log in again.")
+        return False
+
+    # without a connection the program still works on the local copy of the data
+    print(f"Automatically logged in as {email}")
+    return True
 
 class LoginWindow(QWidget):
     """Defines the login window UI and its behavior"""
@@ -197,15 +222,15 @@ class LoginWindow(QWidget):
             status = login.connect(email, password)
 
             if status == 200 and self.remember_me_checkbox.isChecked():
-                self.save_login_info(email, password)
+                self.save_login_info(email, api.refresh_token)
             #except:
             #    print("Unable to connect to database!")
     
     # if user selects 'remember me' than this method will be runned
-    def save_login_info(self, email, password):
-        """Save login credentials using keyring"""
-        # save password using keyring
-        keyring.set_password("schedule_creator", email, password)
+    def save_login_info(self, email, refresh_token):
+        """Save the session using keyring"""
+        # save the refresh token instead of the password, it lets the next launch skip the password check
+        keyring.set_password("schedule_creator", email, refresh_token)
         print("Login info saved in keyring.")
 
         # save email address in ini file
@@ -222,16 +247,8 @@ class LoginWindow(QWidget):
             if 'USER' in config:
                 email = config['USER']['Email']
 
-                # get password from keyring
-                password = keyring.get_password("schedule_creator", email)
-                if password:
-                    login = Login()
-                    login.connect(email, password)
-                    print(f"Automatically logged in as {email}")
-                    return True
-                else:
-                    print("No password found in keyring.")
-                    return False
+                # resume the session saved in keyring
+                return resume_saved_session(email)
 
     def forgot_password_clicked(self):
         """Handle 'Forgot your password?' click"""
@@ -571,6 +588,13 @@ class RegisterWindow(QWidget):
 
 class MainProgram(QWidget):
     """Defines the main program UI and behavior after a successful login"""
+    # emitted from the roster stream thread, Qt delivers it on the GUI thread
+    roster_changed = Signal(str)
+    # emitted from the sync thread when the server rejected some of the user's offline edits
+    conflicts_recorded = Signal(str)
+    # emitted from the generating thread with the message shown to the user
+    schedule_generated = Signal(str)
+
     def __init__(self, user, parent=None) -> None:
         super().__init__(parent)
         self.employee_data = EmployeeData()
@@ -593,6 +617,15 @@ class MainProgram(QWidget):
         self.font11.setHintingPreference(QFont.HintingPreference.PreferNoHinting)
 
         self.setup_ui()
+
+        # changes made on other machines show up without waiting for the next sync
+        self.roster_changed.connect(self.roster_changed_remotely)
+        self.conflicts_recorded.connect(self.show_conflicts)
+        self.schedule_generated.connect(self.schedule_finished)
+        self.employee_data.set_user(self.user_mail, self.conflicts_recorded.emit)
+        # edits rejected by the first sync or while the user was logged out
+        self.show_conflicts(self.user_mail)
+        self.roster_watcher = self.employee_data.watch(self.user_mail, self.roster_changed.emit)
         
 
     def setup_ui(self):
@@ -1108,6 +1141,10 @@ class MainProgram(QWidget):
         self.scroll_area = QScrollArea()
         self.scroll_area.setWidgetResizable(True)
         self.scroll_area.setFixedWidth(525)
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self.employee_list_scrolled)
+        # a taller window can leave nothing to scroll, the next page is then loaded right away
+        self.scroll_area.verticalScrollBar().rangeChanged.connect(self.fill_employee_list)
+        self.employee_pages = None
 
         scroll_area_centered = QHBoxLayout()
         scroll_area_centered.addStretch()
@@ -1296,6 +1333,7 @@ class MainProgram(QWidget):
                                     border: none;
                                     border-radius: 10px;
                                     """)
+        self.generate_button.clicked.connect(self.generate_schedule)
 
         centered_generate_button = self.center_widget(self.generate_button)
         centered_generate_button.setContentsMargins(0, 50, 0, 0)
@@ -1308,6 +1346,43 @@ class MainProgram(QWidget):
 
         return main_layout
     
+    def generate_schedule(self):
+        """Generate a schedule from the uploaded files in the background, on the server if it can be reached"""
+        self.generate_button.setEnabled(False)
+        threading.Thread(target=self._generate_schedule, args=(self.av_file_path, self.rpt_file_path), daemon=True).start()
+
+    def _generate_schedule(self, availability_path, rpt_path):
+        # a job on the server saves the schedule itself
+        jobs = ScheduleJobs()
+        job_id = jobs.submit(self.user_mail, availability_path, rpt_path)
+        job = jobs.wait(self.user_mail, job_id) if job_id is not None else None
+        if job is not None and job.get('status') == 'done':
+            self.schedule_generated.emit("The schedule was generated and saved.")
+            return
+
+        # without the server the schedule is made here, with a seed that makes it again from the same files
+        seed = random.getrandbits(32)
+        random.seed(seed)
+        try:
+            creator = ScheduleCreator(self.user_mail, availability_path, rpt_path, self.employee_data)
+        except Exception as e:
+            print(f"Schedule generation failed: {e}")
+            self.schedule_generated.emit("The schedule could not be generated, please check the uploaded files.")
+            return
+
+        schedule_id = Schedules().save(self.user_mail, Schedules.month_of(creator.schedule), creator.schedule,
+                                       seed, creator.score, availability_path, rpt_path)
+        coverage = f"{creator.score:.0%} of the required staffing is covered."
+        if schedule_id is None:
+            self.schedule_generated.emit(f"The schedule was generated but could not be saved on the server. {coverage}")
+        else:
+            self.schedule_generated.emit(f"The schedule was generated and saved. {coverage}")
+
+    @Slot(str)
+    def schedule_finished(self, message):
+        self.generate_button.setEnabled(True)
+        QMessageBox.information(self, "Schedule", message)
+
     def open_file_dialog(self, drag_n_drop_label, drag_n_drop_widget, upload_field):
         # get desktop path
         desktop_path = QStandardPaths.writableLocation(QStandardPaths.DesktopLocation)
@@ -1412,82 +1487,40 @@ class MainProgram(QWidget):
         self.update_scroll_area()
 
         
+    @Slot(str)
+    def roster_changed_remotely(self, user_email):
+        """Redraw the employee list after a pushed change, unless the user is editing a record"""
+        if user_email == self.user_mail and not self.is_editing and hasattr(self, 'list_area_layout'):
+            self.update_scroll_area()
+
+    @Slot(str)
+    def show_conflicts(self, user_email):
+        """Tell the user which of their edits the server did not accept, each one is shown once"""
+        if user_email != self.user_mail:
+            return
+        conflicts = self.employee_data.conflicts(user_email, unseen=True)
+        if not conflicts:
+            return
+
+        lines = []
+        for action, payload, _, _, reason in conflicts:
+            employee = payload.get("employee_name") or payload["employee_id"]
+            lines.append(f"{action.capitalize()} of {employee} (ID {payload['employee_id']}): {reason or 'rejected by the server'}")
+        QMessageBox.warning(self, "Changes not saved",
+                            "Some of your changes could not be saved and were discarded:\n\n" + "\n".join(lines))
+        if not self.is_editing and hasattr(self, 'list_area_layout'):
+            self.update_scroll_area()
+
     def update_scroll_area(self):
-        """Creates and updates the employee list in the scroll area"""
-        # get employee data from database
-        employee_list = self.employee_data.getEmployeeTable(self.user_mail)
-        # remove user_id (first column) as it is not needed in the display
-        employee_list = [row[1:] for row in employee_list]
-        
+        """Creates the employee list in the scroll area and loads its first page"""
         list_area_widget = QWidget()
         list_area_widget.setStyleSheet("background: none;")
-        list_area_layout = QVBoxLayout(list_area_widget)
-        
-        if len(employee_list) > 0:
-            # iterate over employee data and create rows
-            for data in employee_list:
-                row_layout = QHBoxLayout()
-                config_button = QPushButton()
-                config_button.setIcon(QIcon(QPixmap("img/more.png")))
-                config_button.setCursor(Qt.CursorShape.PointingHandCursor)
-                config_button.setStyleSheet("""
-                                            background: none;
-                                            border: none;
-                                            outline: none;
-                                            """)
-                # set the employee ID as the button's property for later use
-                config_button.setProperty("employee_id", data[0])
-                config_button.clicked.connect(self.show_context_menu)
-
-                # create labels for each employee's data (ID, name, working time, student status)
-                emp_list_id = QLabel(data[0])
-                emp_list_name = QLabel(data[1])
-                emp_list_wt = QLabel(data[2])
-                emp_list_student = QLabel("Yes" if data[3] == 1 else "No")
-
-                # assign properties to each QLabel for reference during editing
-                emp_list_id.setProperty('employee_id', data[0])
-                emp_list_id.setProperty('type', 'id')
-
-                emp_list_name.setProperty('employee_id', data[0])
-                emp_list_name.setProperty('type', 'name')
-
-                emp_list_wt.setProperty('employee_id', data[0])
-                emp_list_wt.setProperty('type', 'wt')
-
-                emp_list_student.setProperty('employee_id', data[0])
-                emp_list_student.setProperty('type', 'student')
-
-                # style labels and set their fixed size
-                for label in [emp_list_id, emp_list_name, emp_list_wt, emp_list_student]:
-                    label.setStyleSheet("color: black; background: none;")
-                    label.setFont(self.font11)
-                    label.setFixedWidth(100)
-                
-                # add labels and config button to the row layout
-                row_layout.addSpacing(10)
-                row_layout.addWidget(emp_list_id)
-                row_layout.addSpacing(15)
-                row_layout.addWidget(emp_list_name)
-                row_layout.addSpacing(25)
-                row_layout.addWidget(emp_list_wt)
-                row_layout.addWidget(emp_list_student)
-                row_layout.addWidget(config_button)
-                row_layout.addStretch()
-
-                # add a horizontal line between rows
-                row_line = QFrame()
-                row_line.setFrameShape(QFrame.HLine)
-                row_line.setFrameShadow(QFrame.Sunken)
-                row_line.setStyleSheet("background-color: rgba(0,0,0,0.10);")
-                row_line.setFixedHeight(1)
-
-                # add the row layout and line to the main layout
-                list_area_layout.addLayout(row_layout)
-                list_area_layout.addWidget(row_line)
-
-            # add a stretch at the end to avoid cutting off the last row
-            list_area_layout.addStretch()
+        self.list_area_layout = QVBoxLayout(list_area_widget)
+        # add a stretch at the end to avoid cutting off the last row
+        self.list_area_layout.addStretch()
+
+        # employees are fetched page by page, further pages are loaded as the user scrolls down
+        self.employee_pages = self.employee_data.iterEmployeePages(self.user_mail)
 
         # add the list of employees to the scroll area
         self.scroll_area.setWidget(list_area_widget)
@@ -1515,6 +1548,97 @@ class MainProgram(QWidget):
                                         width: 4px;
                                     }
                                 """)
+        self.load_more_employees()
+
+    def load_more_employees(self):
+        """Add the next page of employees to the list"""
+        if self.employee_pages is None:
+            return
+
+        page = next(self.employee_pages, None)
+        if page is None:
+            # every employee is already shown
+            self.employee_pages = None
+            return
+
+        for data in page:
+            self.add_employee_row(data)
+        # the scroll bar knows its new range once the layout has run
+        QTimer.singleShot(0, self.fill_employee_list)
+
+    def fill_employee_list(self, *_):
+        """Load further pages while the list does not fill the scroll area, they would never be scrolled to"""
+        # a hidden list is loaded again by show_emp_list
+        if self.employee_pages is not None and self.scroll_area.isVisible() and self.scroll_area.verticalScrollBar().maximum() == 0:
+            self.load_more_employees()
+
+    def employee_list_scrolled(self, value):
+        """Load the next page when the user gets close to the end of the list"""
+        if value >= self.scroll_area.verticalScrollBar().maximum() - 100:
+            self.load_more_employees()
+
+    def add_employee_row(self, data):
+        """Create a row with the employee's data and a config button at the end of the list"""
+        row_layout = QHBoxLayout()
+        config_button = QPushButton()
+        config_button.setIcon(QIcon(QPixmap("img/more.png")))
+        config_button.setCursor(Qt.CursorShape.PointingHandCursor)
+        config_button.setStyleSheet("""
+                                    background: none;
+                                    border: none;
+                                    outline: none;
+                                    """)
+        # set the employee ID as the button's property for later use
+        config_button.setProperty("employee_id", data[0])
+        config_button.clicked.connect(self.show_context_menu)
+
+        # create labels for each employee's data (ID, name, working time, student status)
+        emp_list_id = QLabel(data[0])
+        emp_list_name = QLabel(data[1])
+        emp_list_wt = QLabel(data[2])
+        emp_list_student = QLabel("Yes" if data[3] == 1 else "No")
+
+        # assign properties to each QLabel for reference during editing
+        emp_list_id.setProperty('employee_id', data[0])
+        emp_list_id.setProperty('type', 'id')
+
+        emp_list_name.setProperty('employee_id', data[0])
+        emp_list_name.setProperty('type', 'name')
+
+        emp_list_wt.setProperty('employee_id', data[0])
+        emp_list_wt.setProperty('type', 'wt')
+
+        emp_list_student.setProperty('employee_id', data[0])
+        emp_list_student.setProperty('type', 'student')
+
+        # style labels and set their fixed size
+        for label in [emp_list_id, emp_list_name, emp_list_wt, emp_list_student]:
+            label.setStyleSheet("color: black; background: none;")
+            label.setFont(self.font11)
+            label.setFixedWidth(100)
+        
+        # add labels and config button to the row layout
+        row_layout.addSpacing(10)
+        row_layout.addWidget(emp_list_id)
+        row_layout.addSpacing(15)
+        row_layout.addWidget(emp_list_name)
+        row_layout.addSpacing(25)
+        row_layout.addWidget(emp_list_wt)
+        row_layout.addWidget(emp_list_student)
+        row_layout.addWidget(config_button)
+        row_layout.addStretch()
+
+        # add a horizontal line between rows
+        row_line = QFrame()
+        row_line.setFrameShape(QFrame.HLine)
+        row_line.setFrameShadow(QFrame.Sunken)
+        row_line.setStyleSheet("background-color: rgba(0,0,0,0.10);")
+        row_line.setFixedHeight(1)
+
+        # add the row layout and line before the stretch at the end of the list
+        index = self.list_area_layout.count() - 1
+        self.list_area_layout.insertLayout(index, row_layout)
+        self.list_area_layout.insertWidget(index + 1, row_line)
     
     @Slot()
     def show_context_menu(self):
@@ -1701,6 +1825,9 @@ class MainProgram(QWidget):
 
     def logout(self):
         """Log out the user and clear saved login information"""
+        self.roster_watcher.stop()
+        self.employee_data.set_user(None)
+        Login().logout()
         self.clear_login_info()
     
     def clear_login_info(self):
@@ -1712,7 +1839,7 @@ class MainProgram(QWidget):
 
             if 'USER' in config:
                 email = config['USER']['Email']
-                # delete password from keyring
+                # delete the saved session from keyring
                 keyring.delete_password("schedule_creator", email)
                 print("Login info cleared from keyring.")
 
@@ -1802,16 +1929,8 @@ class WindowControl(QStackedWidget):
             if 'USER' in config:
                 self.email = config['USER']['Email']
 
-                # retrieve the password from keyring
-                password = keyring.get_password("schedule_creator", self.email)
-                if password:
-                    login = Login()
-                    login.connect(self.email, password)
-                    print(f"Automatically logged in as {self.email}")
-                    return True
-                else:
-                    print("No password found in keyring.")
-                    return False
+                # resume the session saved in keyring
+                return resume_saved_session(self.email)
 
     def center(self):
         """Center the window on the screen"""
@@ -0,0 +1,233 @@
+import sqlite3, json, threading, time, uuid
+from decimal import Decimal, InvalidOperation
+
+class LocalStore:
+    """Local SQLite mirror of the employee table with an outbox of pending writes.
+
+    `remote_employees` holds the last roster received from the API, `employees` is what
+    the user sees (the remote roster with the pending outbox applied on top of it).
+    """
+
+    def __init__(self, path) -> None:
+        # connection is shared between the GUI thread and the sync thread, access is serialised by the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.lock, self.connection:
+            for table in ("employees", "remote_employees"):
+                self.connection.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                                            user_email TEXT NOT NULL,
+                                            employee_id TEXT NOT NULL,
+                                            employee_name TEXT,
+                                            working_time TEXT,
+                                            student_or_second_job INTEGER,
+                                            PRIMARY KEY (user_email, employee_id))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        user_email TEXT NOT NULL,
+                                        action TEXT NOT NULL,
+                                        payload TEXT NOT NULL,
+                                        base_row TEXT,
+                                        created_at REAL NOT NULL,
+                                        request_key TEXT)""")
+            # outboxes made before writes carried an Idempotency-Key
+            if "request_key" not in [column[1] for column in self.connection.execute("PRAGMA table_info(outbox)")]:
+                self.connection.execute("ALTER TABLE outbox ADD COLUMN request_key TEXT")
+                self.connection.execute("UPDATE outbox SET request_key = lower(hex(randomblob(16)))")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS conflicts (
+                                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        user_email TEXT NOT NULL,
+                                        action TEXT NOT NULL,
+                                        payload TEXT NOT NULL,
+                                        remote_row TEXT,
+                                        detected_at REAL NOT NULL,
+                                        reason TEXT,
+                                        notified INTEGER NOT NULL DEFAULT 0)""")
+            # conflicts recorded before they were shown to the user
+            columns = [column[1] for column in self.connection.execute("PRAGMA table_info(conflicts)")]
+            if "reason" not in columns:
+                self.connection.execute("ALTER TABLE conflicts ADD COLUMN reason TEXT")
+            if "notified" not in columns:
+                self.connection.execute("ALTER TABLE conflicts ADD COLUMN notified INTEGER NOT NULL DEFAULT 0")
+            # version is the server's roster version the remote roster is at, /data/changes continues from it
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+                                        user_email TEXT PRIMARY KEY,
+                                        last_sync REAL,
+                                        version INTEGER)""")
+            if "version" not in [column[1] for column in self.connection.execute("PRAGMA table_info(sync_state)")]:
+                self.connection.execute("ALTER TABLE sync_state ADD COLUMN version INTEGER")
+
+    def is_synced(self, user_email) -> bool:
+        """Check if the roster of the user was downloaded at least once"""
+        with self.lock:
+            row = self.connection.execute("SELECT last_sync FROM sync_state WHERE user_email = ?", (user_email,)).fetchone()
+            return row is not None and row[0] is not None
+
+    def version(self, user_email):
+        """Return the roster version the remote roster is at, None if it has to be downloaded whole"""
+        with self.lock:
+            row = self.connection.execute("SELECT last_sync, version FROM sync_state WHERE user_email = ?", (user_email,)).fetchone()
+            return row[1] if row is not None and row[0] is not None else None
+
+    def rows(self, user_email) -> list:
+        """Return the local view of the roster as [employee_id, name, working_time, student] rows"""
+        with self.lock:
+            cursor = self.connection.execute("""SELECT employee_id, employee_name, working_time, student_or_second_job
+                                                FROM employees WHERE user_email = ? ORDER BY rowid""", (user_email,))
+            return [list(row) for row in cursor]
+
+    def page(self, user_email, after=None, limit=50) -> list:
+        """Return up to limit rows of the local view ordered by employee ID, starting after the given ID.
+
+        Shorter IDs come first, so numeric IDs are in numeric order ("2" before "10").
+        """
+        after = after or ""
+        with self.lock:
+            cursor = self.connection.execute("""SELECT employee_id, employee_name, working_time, student_or_second_job
+                                                FROM employees WHERE user_email = ? AND (length(employee_id), employee_id) > (?, ?)
+                                                ORDER BY length(employee_id), employee_id LIMIT ?""",
+                                             (user_email, len(after), after, limit))
+            return [list(row) for row in cursor]
+
+    def snapshot(self, user_email) -> dict:
+        """Return the last known remote roster as {employee_id: row}"""
+        with self.lock:
+            cursor = self.connection.execute("""SELECT employee_id, employee_name, working_time, student_or_second_job
+                                                FROM remote_employees WHERE user_email = ?""", (user_email,))
+            # rows stored before working times had two decimals compare like new ones
+            return {row[0]: self.normalize(row) for row in cursor}
+
+    def enqueue(self, user_email, action, payload, key):
+        """Apply a write to the local view and queue it for the API.
+
+        The remote row of the employee the write is based on is stored with it for conflict detection.
+        """
+        with self.lock, self.connection:
+            base_row = self.snapshot(user_email).get(str(key))
+            self._apply(self.connection, "employees", user_email, action, payload)
+            self.connection.execute("INSERT OR IGNORE INTO sync_state (user_email) VALUES (?)", (user_email,))
+            # sent as Idempotency-Key, a write resent after a lost answer is not applied twice
+            self.connection.execute("""INSERT INTO outbox (user_email, action, payload, base_row, created_at, request_key)
+                                       VALUES (?, ?, ?, ?, ?, ?)""",
+                                    (user_email, action, json.dumps(payload), json.dumps(base_row), time.time(), uuid.uuid4().hex))
+
+    def pending(self, user_email) -> list:
+        """Return queued writes of the user as (id, action, payload, base_row) in the order they were made"""
+        with self.lock:
+            cursor = self.connection.execute("SELECT id, action, payload, base_row FROM outbox WHERE user_email = ? ORDER BY id", (user_email,))
+            return [(entry_id, action, json.loads(payload), self._row(base_row)) for entry_id, action, payload, base_row in cursor]
+
+    def request_key(self, entry_id):
+        """Return the Idempotency-Key of a queued write"""
+        with self.lock:
+            row = self.connection.execute("SELECT request_key FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+            return row[0] if row is not None else None
+
+    def remove_pending(self, entry_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def record_conflict(self, user_email, action, payload, remote_row, reason=None):
+        """Keep a rejected local write, so it is not lost silently"""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO conflicts (user_email, action, payload, remote_row, detected_at, reason) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (user_email, action, json.dumps(payload), json.dumps(remote_row), time.time(), reason))
+
+    def conflicts(self, user_email, unseen=False) -> list:
+        """Return (action, payload, remote_row, detected_at, reason) of the user's rejected writes, oldest first.
+
+        With `unseen` only the ones not returned that way before, they count as shown to the user afterwards.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(f"""SELECT id, action, payload, remote_row, detected_at, reason FROM conflicts
+                                                 WHERE user_email = ?{' AND notified = 0' if unseen else ''} ORDER BY id""", (user_email,))
+            rows = cursor.fetchall()
+            if unseen and rows:
+                self.connection.execute("UPDATE conflicts SET notified = 1 WHERE user_email = ? AND id <= ?", (user_email, rows[-1][0]))
+            return [(action, json.loads(payload), json.loads(remote_row), detected_at, reason)
+                    for _, action, payload, remote_row, detected_at, reason in rows]
+
+    def has_unseen_conflicts(self, user_email) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT EXISTS(SELECT 1 FROM conflicts WHERE user_email = ? AND notified = 0)",
+                                           (user_email,)).fetchone()[0] == 1
+
+    def replace_snapshot(self, user_email, remote_rows, version=None):
+        """Store a fresh remote roster at the given version and rebuild the local view from it and the remaining outbox"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM remote_employees WHERE user_email = ?", (user_email,))
+            self._store_remote(user_email, remote_rows)
+            self._rebuild_view(user_email)
+            self._synced(user_email, version)
+
+    def apply_changes(self, user_email, upserts, deletes, version):
+        """Apply changes from /data/changes to the remote roster and rebuild the local view, outbox changes stay on top"""
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM remote_employees WHERE user_email = ? AND employee_id = ?",
+                                        [(user_email, str(employee_id)) for employee_id in deletes])
+            self._store_remote(user_email, upserts)
+            self._rebuild_view(user_email)
+            self._synced(user_email, version)
+
+    def apply_remote(self, user_email, action, payload):
+        """Apply a change pushed by the API to the remote roster and rebuild the local view, outbox changes stay on top"""
+        with self.lock, self.connection:
+            self._apply(self.connection, "remote_employees", user_email, action, payload)
+            self._rebuild_view(user_email)
+
+    def _store_remote(self, user_email, remote_rows):
+        self.connection.executemany("""INSERT OR REPLACE INTO remote_employees
+                                       (user_email, employee_id, employee_name, working_time, student_or_second_job)
+                                       VALUES (?, ?, ?, ?, ?)""",
+                                    [(user_email, *self.normalize(row)) for row in remote_rows])
+
+    def _synced(self, user_email, version):
+        self.connection.execute("""INSERT INTO sync_state (user_email, last_sync, version) VALUES (?, ?, ?)
+                                   ON CONFLICT(user_email) DO UPDATE SET last_sync = excluded.last_sync, version = excluded.version""",
+                                (user_email, time.time(), version))
+
+    def _rebuild_view(self, user_email):
+        self.connection.execute("DELETE FROM employees WHERE user_email = ?", (user_email,))
+        self.connection.execute("""INSERT INTO employees SELECT * FROM remote_employees WHERE user_email = ?""", (user_email,))
+        for _, action, payload, _ in self.pending(user_email):
+            self._apply(self.connection, "employees", user_email, action, payload)
+
+    @staticmethod
+    def _row(text):
+        """Decode a JSON stored row back to a tuple"""
+        row = json.loads(text) if text else None
+        return LocalStore.normalize(row) if row is not None else None
+
+    @staticmethod
+    def normalize(row) -> tuple:
+        """Bring a (employee_id, name, working_time, student) row to the form it is stored in"""
+        employee_id, employee_name, working_time, student = row
+        return (str(employee_id), employee_name, LocalStore.working_time(working_time), int(bool(student)))
+
+    @staticmethod
+    def working_time(value) -> str:
+        """Write a working time the way the server's DECIMAL(3,2) column returns it, 0.5 becomes 0.50"""
+        try:
+            return f"{Decimal(str(value)):.2f}"
+        except InvalidOperation:
+            return str(value)
+
+    def _apply(self, connection, table, user_email, action, payload):
+        """Apply one outbox action to the given table"""
+        if action == "add":
+            connection.execute(f"""INSERT OR REPLACE INTO {table}
+                                   (user_email, employee_id, employee_name, working_time, student_or_second_job)
+                                   VALUES (?, ?, ?, ?, ?)""",
+                               (user_email, *self.normalize((payload["employee_id"], payload["employee_name"],
+                                                             payload["work_time"], payload["student_or_second_job"]))))
+        elif action == "update":
+            connection.execute(f"""UPDATE {table} SET employee_id = ?, employee_name = ?, working_time = ?, student_or_second_job = ?
+                                   WHERE user_email = ? AND employee_id = ?""",
+                               (*self.normalize((payload["employee_id"], payload["employee_name"],
+                                                 payload["work_time"], payload["student_or_second_job"])),
+                                user_email, str(payload["old_employee_id"])))
+        elif action == "delete":
+            connection.execute(f"DELETE FROM {table} WHERE user_email = ? AND employee_id = ?",
+                               (user_email, str(payload["employee_id"])))
@@ -1,7 +1,7 @@
-from scheduleCreator import ScheduleCreator
 from PySide6.QtWidgets import QApplication
 from gui import WindowControl
-import database, sys
+from settings import API_STATS_FILE
+import database, sys, atexit
 
 # main application
 class App:
@@ -9,22 +9,17 @@ class App:
         self.db = database.EmployeeData()
         self.gui_app = QApplication(sys.argv)
         self.window_controller = WindowControl()
+        # keep latency statistics of the session for finding slow API calls
+        atexit.register(database.api.dump_stats, API_STATS_FILE)
 
     # main method
     def run(self):
         self.window_controller.show()
         self.gui_app.exec()
-        self.window_controller.main_program.generate_button.clicked.connect(self._generate_schedule)
         #self.db.main()
         # call main method of ScheduleCreater class
         #self.schedule_creator.main()
 
-    def _generate_schedule(self):
-        user_mail = self.window_controller.email
-        availability_path = self.window_controller.main_program.av_file_path
-        rpt_path = self.window_controller.main_program.rpt_file_path
-        self.schedule_creator = ScheduleCreator(user_mail, availability_path, rpt_path, self.db)
-
 if __name__ == "__main__":
     app = App()
     app.run()
\ No newline at end of file
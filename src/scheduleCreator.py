@@ -2,7 +2,6 @@ import pandas as pd
 import numpy as np
 import re
 from settings import *
-import database
 import random
 from dtime import Time
 
@@ -35,8 +34,6 @@ class ScheduleCreator:
         column = [0,1,2,3], where 0 = employee id, 1 = employee name, 2 = working time, 3 = is student/second job.
         """
         employee_list = self.emp_db.getEmployeeTable(self.user_mail)
-        # [[user_id, emp_id, name, wt, student]]
-        employee_list = [row[1:] for row in employee_list]
         # [[emp_id, name, wt, student]]
         
         # create nested list with desired columns
@@ -58,6 +55,8 @@ class ScheduleCreator:
 
         # main schedule dictionary
         schedule = dict()
+        # employee-hours the RPT file asks for and how many of them the schedule provides
+        required = staffed = 0
         for day in self.df.columns[1:]:
             print(f"Day {day}:")
             # create a nested dictionary as a value for every day in dataframe
@@ -135,7 +134,12 @@ class ScheduleCreator:
                 
                 
                 print(f"{hour}: {schedule[day][hour]}  {len(schedule[day][hour])}/{min_employee}")
+                # extra employees in one hour do not make up for missing ones in another
+                required += int(min_employee)
+                staffed += min(len(schedule[day][hour]), int(min_employee))
             print("\n")
+        # share of the required staffing that is covered, 1.0 when every hour has enough employees
+        self.score = round(staffed / required, 4) if required else 1.0
         return schedule
     
     def _available_employees(self, emp_hour, hour) -> list:
@@ -211,4 +215,6 @@ class ScheduleCreator:
         self._read()
         self._beautify()
         schedule = self.build_schedule()
-        self._show_monthly_hours(schedule)
\ No newline at end of file
+        self._show_monthly_hours(schedule)
+        self.schedule = schedule
+        return schedule
\ No newline at end of file
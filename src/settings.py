@@ -4,4 +4,20 @@ OPEN_HOUR = Time(10)
 CLOSE_HOUR = Time(21,30)
 MAX_UNAVAILABILITY = 2
 MAX_HOURS = 8
-FULL_TIME = 160
\ No newline at end of file
+FULL_TIME = 160
+
+# local mirror of the employee table
+LOCAL_DB_PATH = "local_data.db"
+SYNC_INTERVAL = 30
+
+# changes made on other machines are pulled from /data/changes every ROSTER_POLL_INTERVAL seconds.
+# With ROSTER_STREAM they are pushed over /data/stream instead, every open stream holds a server thread
+ROSTER_STREAM = False
+ROSTER_POLL_INTERVAL = 15
+
+# number of employees fetched at once
+PAGE_SIZE = 50
+REMOTE_PAGE_SIZE = 500
+
+# file the API call statistics are written to when the program exits
+API_STATS_FILE = "api_stats.json"